@@ -46,6 +46,13 @@ from livekit.agents import room_io, metrics
 from livekit.agents.voice import MetricsCollectedEvent
 from livekit.plugins.turn_detector.multilingual import MultilingualModel
 import utils.database as db
+from utils import write_behind
+from utils.geocoding import close_geocoder, geocode_cache
+from utils.listing_embeddings import listing_embeddings
+from utils.llm_clients import llm_clients
+from utils.query_parser import extraction_cache, query_parser
+from utils.whitelist import whitelist
+from utils.phone import phone_from_room_name
 from prompts.it_inbound_prompt import SYSTEM_PROMPT, immobiliare_agenzia
 from datetime import datetime, timedelta, timezone as tz
 from utils.agents_utils import get_google_token
@@ -100,27 +107,23 @@ class RealEstateItalianAgent(Agent):
         except Exception as e:
             logger.warning(f"Could not delete room (may already be deleted): {e}")
     async def _check_whitelisted(self) -> bool:
-        """Check if caller is whitelisted using the database"""
+        """Check if caller is whitelisted using the worker's cached whitelist"""
         job_ctx = get_job_context()
         room_name = job_ctx.room.name if job_ctx.room else ""
-        phone_number = "Unknown"
-        
-        if room_name.startswith("call-"):
-            parts = room_name.split("_")
-            if len(parts) >= 2:
-                phone_number = parts[1]
+        phone_number = phone_from_room_name(room_name) or "Unknown"
         
         # If no whitelist entries exist, allow all (not configured)
-        all_whitelisted = db.get_all_whitelisted()
-        if not all_whitelisted:
+        if await whitelist.is_empty():
             return True
         
-        return db.is_whitelisted(phone_number)
+        return await whitelist.contains(phone_number)
 
 server = AgentServer()
 
 def prewarm(proc: JobProcess):
     proc.userdata["vad"] = silero.VAD.load()
+    # Async LLM clients for in-tool calls, kept warm for the worker's lifetime
+    llm_clients.prewarm()
 
 @server.rtc_session()
 async def entrypoint(ctx: JobContext):
@@ -180,7 +183,19 @@ async def entrypoint(ctx: JobContext):
     async def log_usage():
         summary = usage_collector.get_summary()
         logger.info(f"Usage: {summary}")
+        logger.info(f"DB pool: {db.get_pool_stats()}")
+        logger.info(f"Geocode cache: {geocode_cache.stats()}")
+        logger.info(f"Query parser: {query_parser.stats()}")
+        logger.info(f"Extraction cache: {extraction_cache.stats()}")
+        logger.info(f"Listing embeddings: {listing_embeddings.stats()}")
     ctx.add_shutdown_callback(log_usage)
+
+    async def flush_write_behind():
+        # Log after the final drain so the counts include it
+        await write_behind.shutdown()
+        logger.info(f"Write-behind: {write_behind.get_write_behind_stats()}")
+    ctx.add_shutdown_callback(flush_write_behind)
+    ctx.add_shutdown_callback(close_geocoder)
     #TODO THE CHAT ROOM SHOULD BE FROM OUR FLYNUMBER, MAKE SURE THAT WORKS AND
     # UNDERSTAND DEEPLY HOW IT DOES
     await session.start(
@@ -27,6 +27,7 @@ from tools.calendar_tools import (
     check_available_slots
 )
 from tools.real_estate_tools import note_info, immobiliare_offers
+from utils import write_behind
 
 logger = logging.getLogger("grok-agent")
 logger.setLevel(logging.INFO)
@@ -86,6 +87,12 @@ async def entrypoint(ctx: JobContext):
 
     agent = RealEstateItalianOutboundAgent()
 
+    async def flush_write_behind():
+        # Log after the final drain so the counts include it
+        await write_behind.shutdown()
+        logger.info(f"Write-behind: {write_behind.get_write_behind_stats()}")
+    ctx.add_shutdown_callback(flush_write_behind)
+
     session = AgentSession(
         stt=deepgram.STT(model="nova-3", language="it-IT"),
         llm=openai.LLM(
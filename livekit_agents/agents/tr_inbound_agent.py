@@ -19,7 +19,6 @@ import requests
 import google.auth
 from google.auth.transport.requests import Request
 from google.oauth2 import service_account
-from geopy.distance import geodesic
 from dotenv import load_dotenv
 from pydantic import BaseModel
 from livekit.agents import (
@@ -40,6 +39,15 @@ from livekit.agents import room_io, metrics
 from livekit.agents.voice import MetricsCollectedEvent
 from livekit.plugins.turn_detector.multilingual import MultilingualModel
 from utils import database as db
+from utils import write_behind
+from utils.database import ListingFilters
+from utils.geocoding import close_geocoder, geocode, geocode_cache
+from utils.listing_embeddings import listing_embeddings
+from utils.llm_clients import llm_clients
+from utils.listing_cards import alternative_json, json_array, nearby_json
+from utils.listing_search import listing_search
+from utils.listings_cache import ListingsUnavailable
+from utils.phone import phone_from_room_name
 from prompts.tr_inbound_prompt import SYSTEM_PROMPT
 from datetime import datetime, timedelta, timezone as tz
 
@@ -49,6 +57,8 @@ logger.setLevel(logging.INFO)
 
 load_dotenv()
 CALENDAR = os.getenv("CALENDAR_ID")
+# Callers' numbers without a country code are Turkish
+PHONE_COUNTRY_CODE = "90"
 
 def get_google_token():
     """Get OAuth token from service account credentials."""
@@ -83,11 +93,7 @@ class MyAgent(Agent):
         """
         # Extract phone number from room name (format: call-_393517843713_...)
         room_name = context.session.room.name if context.session.room else ""
-        phone_number = "Unknown"
-        if room_name.startswith("call-"):
-            parts = room_name.split("_")
-            if len(parts) >= 2:
-                phone_number = parts[1]
+        phone_number = phone_from_room_name(room_name, default_country_code=PHONE_COUNTRY_CODE) or "Unknown"
         
         token = get_google_token()
         start = datetime.fromisoformat(date)
@@ -125,48 +131,60 @@ class MyAgent(Agent):
     async def get_apartment_info(
         self, context: RunContext, apartment_address: str
     ):
-        
-        response_openstreetmap = requests.get(
-            url="https://nominatim.openstreetmap.org/search",
-            params={
-                "q": f"{apartment_address}, Bartin, Turkey",
-                "format": "json",
-                "limit": 1
-            },
-            headers={"User-Agent": "RinovaAI/1.0 (rinova.capmapai.com)"}
-        )        
-        geo_data = response_openstreetmap.json()
-        
-        # 2. If geocoding failed, use LLM to match listing name
-        if not geo_data: 
-            listings = db.getCurrentListings()
-            response = requests.post(
-                url="https://openrouter.ai/api/v1/chat/completions",
-                headers={
-                    "Authorization": "Bearer " + os.getenv("OPENROUTER_API_KEY"),
-                    "HTTP-Referer": "https://rinova.capmapai.com",
-                    "X-Title": "Rinova AI",
-                },
-                data=json.dumps({
-                "model": "google/gemini-3-flash-preview",
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": f"""You are AItaxonomy, a real estate mapping assistant.
-                            You have these listings: {listings}
-                            The user asked about: "{apartment_address}"
-                            
-                            Your task: Find the best matching listing name.
-                            - If you find a match, output ONLY the listing name.
-                            - If no match, output 3 random listing names from the list, separated by commas.
-                            
-                            Output only the listing name(s), nothing else."""
-                        }
-                    ],
-                })
+        try:
+            return await self._find_apartment(apartment_address)
+        except ListingsUnavailable as e:
+            # Database outage before the first snapshot: a temporary error, not "no listings"
+            logger.error(f"Listings unavailable: {e}")
+            return json.dumps({
+                "status": "temporary_error",
+                "message": "Şu anda ilanlara ulaşamıyorum. Lütfen birkaç dakika sonra tekrar deneyin."
+            })
+
+    async def _find_apartment(self, apartment_address: str) -> str:
+        # 1. Known mahalle / landmarks: precomputed nearest listings (utils.zone_listings);
+        #    anything else is geocoded (memory / Postgres cache before Nominatim, see utils.geocoding)
+        user_coords = None
+        top3 = await listing_search.nearest_to_zone(apartment_address, "Bartin, Turkey", ListingFilters(), k=3)
+        if top3 is None:
+            user_coords = await geocode(apartment_address, "Bartin, Turkey")
+
+        # 2. If geocoding failed, try the trigram index on listing names, then the LLM
+        if top3 is None and not user_coords: 
+            matches = await listing_search.similar_names(apartment_address, ListingFilters(), limit=1)
+            if matches:
+                card = await listing_search.card(matches[0])
+                if card:
+                    return card
+
+            # Semantic match on the local embedding index; the LLM only while it isn't ready
+            semantic = await listing_search.semantic_match(apartment_address, ListingFilters(), k=3)
+            if semantic is not None:
+                best, closest = semantic
+                card = await listing_search.card(best) if best else None
+                if card:
+                    return card
+                return json.dumps({"status": "suggestions", "suggestions": closest})
+
+            listings = ", ".join(await listing_search.names(ListingFilters())) or "No listings found."
+            completion = await llm_clients.openrouter().chat.completions.create(
+                model="google/gemini-3-flash-preview",
+                messages=[
+                    {
+                        "role": "user",
+                        "content": f"""You are AItaxonomy, a real estate mapping assistant.
+                        You have these listings: {listings}
+                        The user asked about: "{apartment_address}"
+                        
+                        Your task: Find the best matching listing name.
+                        - If you find a match, output ONLY the listing name.
+                        - If no match, output 3 random listing names from the list, separated by commas.
+                        
+                        Output only the listing name(s), nothing else."""
+                    }
+                ],
             )
-            data = response.json()
-            listing_names = data['choices'][0]['message']['content']
+            listing_names = completion.choices[0].message.content
             
             # If multiple listings returned (no match), return suggestions
             if "," in listing_names:
@@ -176,47 +194,27 @@ class MyAgent(Agent):
                 })
             
             # Single match found - try to get it, or return all listings as suggestions
-            listing = db.getListing(listing_names.strip())
-            if listing:
-                return listing.json()
+            card = await listing_search.card(listing_names.strip())
+            if card:
+                return card
             else:
                 # Fallback: return all available listings
-                all_listings = db.getCurrentListings()
                 return json.dumps({
                     "status": "suggestions",
-                    "suggestions": [name.strip() for name in all_listings.split(",")[:3]]
+                    "suggestions": (await listing_search.names(ListingFilters()))[:3]
                 })
 
-        # 3. Geocoding succeeded - find closest listings by distance
-        user_coords = (float(geo_data[0]["lat"]), float(geo_data[0]["lon"]))
-        
-        listings = db.getAllListingsWithCoords()
-        
-        # Calculate distance for each listing
-        for listing in listings:
-            listing['distance_km'] = geodesic(
-                user_coords, 
-                (listing['latitude'], listing['longitude'])
-            ).km
-        
-        # Sort by distance and get top 3
-        top3 = sorted(listings, key=lambda x: x['distance_km'])[:3]
-
-        # Return raw data - let LLM decide how to present it
-        return json.dumps({
-            "status": "found_nearby" if top3[0]['distance_km'] >= 0.1 else "exact_match",
-            "closest": {
-                "name": top3[0]['name'],
-                "address": top3[0]['address'],
-                "distance_meters": int(top3[0]['distance_km'] * 1000),
-                "price": top3[0]['price'],
-                "description": top3[0]['description'][:300]
-            },
-            "alternatives": [
-                {"name": l['name'], "distance_meters": int(l['distance_km'] * 1000)} 
-                for l in top3[1:3]
-            ]
-        })
+        # 3. Location known - find closest listings by distance
+        # Top 3 by distance
+        if top3 is None:
+            top3 = await listing_search.nearest(*user_coords, filters=ListingFilters(), k=3)
+
+        # Return raw data - let LLM decide how to present it (cards are pre-serialized, see utils.listing_cards)
+        status = "found_nearby" if top3[0]['distance_km'] >= 0.1 else "exact_match"
+        return (
+            f'{{"status": "{status}", "closest": {nearby_json(top3[0])}, '
+            f'"alternatives": {json_array(alternative_json(l) for l in top3[1:3])}}}'
+        )
 
 
         
@@ -430,6 +428,8 @@ server = AgentServer()
 
 def prewarm(proc: JobProcess):
     proc.userdata["vad"] = silero.VAD.load()
+    # Async LLM clients for in-tool calls, kept warm for the worker's lifetime
+    llm_clients.prewarm()
 
 server.setup_fnc = prewarm
 
@@ -466,7 +466,17 @@ async def entrypoint(ctx: JobContext):
     async def log_usage():
         summary = usage_collector.get_summary()
         logger.info(f"Usage: {summary}")
+        logger.info(f"DB pool: {db.get_pool_stats()}")
+        logger.info(f"Geocode cache: {geocode_cache.stats()}")
+        logger.info(f"Listing embeddings: {listing_embeddings.stats()}")
     ctx.add_shutdown_callback(log_usage)
+
+    async def flush_write_behind():
+        # Log after the final drain so the counts include it
+        await write_behind.shutdown()
+        logger.info(f"Write-behind: {write_behind.get_write_behind_stats()}")
+    ctx.add_shutdown_callback(flush_write_behind)
+    ctx.add_shutdown_callback(close_geocoder)
     #TODO THE CHAT ROOM SHOULD BE FROM OUR FLYNUMBER, MAKE SURE THAT WORKS AND
     # UNDERSTAND DEEPLY HOW IT DOES
     await session.start(
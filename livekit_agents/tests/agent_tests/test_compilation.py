@@ -19,6 +19,8 @@ FILES_TO_CHECK = [
     "prompts/it_inbound_prompt.py",
     "prompts/it_outbound_prompt.py",
     "utils/database.py",
+    "utils/migrations.py",
+    "utils/ingest_listings.py",
 ]
 
 
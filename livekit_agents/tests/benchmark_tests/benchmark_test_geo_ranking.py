@@ -0,0 +1,140 @@
+"""
+Micro-benchmark: nearest-listing ranking strategies.
+
+Compares, per query, the original geodesic() loop + full sort against the
+vectorized haversine + argpartition pass (HaversineIndex) and the KD-tree with
+geodesic refinement (ListingSpatialIndex) at 100, 10k and 1M listings.
+Index build time is reported separately since it is paid once per snapshot.
+
+The geodesic loop is only timed in full up to GEODESIC_MAX_N listings and
+extrapolated linearly above that (it is O(n) geodesic calls plus a sort).
+
+Run with: pytest tests/benchmark_tests/benchmark_test_geo_ranking.py -s
+      or: python -m tests.benchmark_tests.benchmark_test_geo_ranking
+"""
+import os
+import random
+import sys
+import time
+
+import pytest
+from geopy.distance import geodesic
+from rich.console import Console
+from rich.table import Table
+from rich import box
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from utils.spatial_index import HaversineIndex, ListingSpatialIndex
+
+SIZES = [100, 10_000, 1_000_000]
+QUERIES = 20
+K = 3
+GEODESIC_MAX_N = 20_000
+
+# Milan-ish bounding box
+CENTER = (45.4642, 9.1900)
+
+
+def make_listings(n, seed=42):
+    rng = random.Random(seed)
+    return [
+        {
+            "name": f"Listing {i}",
+            "latitude": CENTER[0] + rng.uniform(-0.15, 0.15),
+            "longitude": CENTER[1] + rng.uniform(-0.2, 0.2),
+        }
+        for i in range(n)
+    ]
+
+
+def make_queries(n=QUERIES, seed=7):
+    rng = random.Random(seed)
+    return [(CENTER[0] + rng.uniform(-0.1, 0.1), CENTER[1] + rng.uniform(-0.15, 0.15)) for _ in range(n)]
+
+
+def geodesic_loop(listings, origin, k=K):
+    """The original ranking: geodesic() per listing, then a full sort"""
+    distances = [(geodesic(origin, (l["latitude"], l["longitude"])).km, l) for l in listings]
+    return sorted(distances, key=lambda x: x[0])[:k]
+
+
+def time_per_query(fn, queries):
+    start = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+
+def run_benchmark(sizes=SIZES):
+    queries = make_queries()
+    rows = []
+    for n in sizes:
+        listings = make_listings(n)
+
+        sample = listings if n <= GEODESIC_MAX_N else listings[:GEODESIC_MAX_N]
+        loop_ms = time_per_query(lambda q: geodesic_loop(sample, q), queries[:3])
+        extrapolated = n > GEODESIC_MAX_N
+        if extrapolated:
+            loop_ms *= n / GEODESIC_MAX_N
+
+        start = time.perf_counter()
+        haversine = HaversineIndex(listings)
+        haversine_build_ms = (time.perf_counter() - start) * 1000
+        haversine_ms = time_per_query(lambda q: haversine.nearest(*q, k=K), queries)
+
+        start = time.perf_counter()
+        kdtree = ListingSpatialIndex(listings)
+        kdtree_build_ms = (time.perf_counter() - start) * 1000
+        kdtree_ms = time_per_query(lambda q: kdtree.nearest(*q, k=K), queries)
+
+        # Same winners (haversine vs ellipsoid can only swap near-ties)
+        q = queries[0]
+        assert haversine.nearest(*q, k=1)[0][1] is kdtree.nearest(*q, k=1)[0][1]
+
+        rows.append({
+            "n": n,
+            "geodesic_loop_ms": loop_ms,
+            "geodesic_extrapolated": extrapolated,
+            "haversine_ms": haversine_ms,
+            "haversine_build_ms": haversine_build_ms,
+            "kdtree_ms": kdtree_ms,
+            "kdtree_build_ms": kdtree_build_ms,
+        })
+    return rows
+
+
+def print_results(rows):
+    table = Table(title=f"Top-{K} nearest listing ranking (ms per query)", box=box.ROUNDED)
+    table.add_column("Listings", justify="right")
+    table.add_column("geodesic loop", justify="right")
+    table.add_column("haversine", justify="right")
+    table.add_column("haversine build", justify="right")
+    table.add_column("kd-tree", justify="right")
+    table.add_column("kd-tree build", justify="right")
+    for r in rows:
+        loop = f"{r['geodesic_loop_ms']:.2f}" + ("*" if r["geodesic_extrapolated"] else "")
+        table.add_row(
+            f"{r['n']:,}",
+            loop,
+            f"{r['haversine_ms']:.3f}",
+            f"{r['haversine_build_ms']:.1f}",
+            f"{r['kdtree_ms']:.3f}",
+            f"{r['kdtree_build_ms']:.1f}",
+        )
+    console = Console()
+    console.print(table)
+    console.print(f"* extrapolated from {GEODESIC_MAX_N:,} listings")
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_geo_ranking_speed(n):
+    rows = run_benchmark([n])
+    print_results(rows)
+    r = rows[0]
+    # The vectorized pass must beat the per-row geodesic loop at every size
+    assert r["haversine_ms"] < r["geodesic_loop_ms"]
+
+
+if __name__ == "__main__":
+    print_results(run_benchmark())
@@ -0,0 +1,47 @@
+"""
+Gazetteer tests - bundled data file only, no network needed.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from utils.gazetteer import gazetteer, normalize_query
+
+MILANO = "Milano, Italia"
+BARTIN = "Bartin, Turkey"
+
+
+@pytest.mark.parametrize("zone, expected", [
+    ("Navigli", "Navigli"),
+    ("città studi", "Città Studi"),
+    ("Citta' Studi", "Città Studi"),
+    ("zona Porta Romana", "Porta Romana"),
+    ("bilocale vicino alla metro Loreto", "Loreto"),
+    ("Navigi", "Navigli"),
+    ("porta venzia", "Porta Venezia"),
+    ("chinatown", "Paolo Sarpi"),
+])
+def test_milano_zones(zone, expected):
+    place = gazetteer.lookup(zone, MILANO)
+    assert place is not None and place.name == expected
+
+
+def test_bartin_dotless_i_and_accents():
+    assert gazetteer.lookup("Kırtepe Mahallesi", BARTIN).name == "Kırtepe"
+    assert gazetteer.lookup("kemerkopru", BARTIN).name == "Kemerköprü"
+
+
+@pytest.mark.parametrize("zone", ["Via Torino 12", "Roma", "qualcosa di bello", ""])
+def test_unknown_zones_and_street_addresses_fall_through(zone):
+    assert gazetteer.lookup(zone, MILANO) is None
+
+
+def test_unknown_city():
+    assert gazetteer.lookup("Navigli", "Torino, Italia") is None
+
+
+def test_normalize_query():
+    assert normalize_query("  Città   Studi! ") == "citta studi"
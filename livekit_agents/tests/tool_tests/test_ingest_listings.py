@@ -0,0 +1,48 @@
+"""
+Listing feed ingestion tests - mapping, validation and streaming readers only, no database needed.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from utils.ingest_listings import LISTING_COLUMNS, read_json_array, to_listing, validate_records
+
+
+def test_immobiliare_headers_map_onto_listing():
+    listing = to_listing({
+        "Titolo": "Bilocale Navigli",
+        "Indirizzo": "Via Vigevano 12, Milano",
+        "Prezzo": "€ 1.200",
+        "Latitudine": "45,4521",
+        "Longitudine": "9.171",
+        "Contratto": "Affitto",
+        "Tipologia": "Ufficio",
+    }, {"agency": "primacasa"})
+    assert listing.name == "Bilocale Navigli"
+    assert listing.price == 1200
+    assert listing.latitude == 45.4521
+    assert listing.longitude == 9.171
+    assert listing.listing_type == "rent"
+    assert listing.property_type == "office"
+    assert listing.agency == "primacasa"
+
+
+def test_invalid_records_are_counted_not_loaded():
+    stats = {"valid": 0, "rejected": 0}
+    records = [
+        {"title": "Ok", "address": "Via Roma 1", "price": "900", "agency": "a"},
+        {"title": "No price", "address": "Via Roma 2", "agency": "a"},
+        {"title": "Bad price", "address": "Via Roma 3", "price": "trattativa riservata", "agency": "a"},
+    ]
+    rows = list(validate_records(records, None, stats))
+    assert stats == {"valid": 1, "rejected": 2}
+    assert rows[0][LISTING_COLUMNS.index("name")] == "Ok"
+
+
+def test_json_array_is_streamed_across_buffer_boundaries(tmp_path):
+    records = [{"title": f"Listing {i}", "address": "x" * 50, "price": i} for i in range(200)]
+    path = tmp_path / "feed.json"
+    path.write_text(json.dumps(records, indent=1))
+    assert list(read_json_array(str(path), buffer_size=64)) == records
@@ -0,0 +1,132 @@
+"""
+Listing embedding index tests - a tiny bag-of-words ONNX model built on the fly
+stands in for the sentence model, so no download is needed.
+"""
+import os
+import sys
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+onnx = pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+tokenizers = pytest.importorskip("tokenizers")
+
+from utils import listing_embeddings as embeddings_module
+from utils.listing_embeddings import ListingEmbeddings
+
+LISTINGS = [
+    {"name": "Attico Navigli", "address": "Alzaia Naviglio Grande 10", "description": "attico con terrazzo"},
+    {"name": "Bilocale Isola", "address": "Via Borsieri 5", "description": "bilocale sopra la farmacia"},
+    {"name": "Loft Tortona", "address": "Via Tortona 20", "description": "loft open space"},
+]
+
+
+@pytest.fixture
+def model_dir(tmp_path, monkeypatch):
+    """One-hot token embeddings: mean pooling gives a bag of words, cosine is word overlap"""
+    words = sorted({w for l in LISTINGS for w in embeddings_module.listing_text(l).lower().replace(".", " ").split()})
+    vocab = {"[UNK]": 0, "[PAD]": 1, **{w: i + 2 for i, w in enumerate(words)}}
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.normalizer = tokenizers.normalizers.Lowercase()
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+    tokenizer.save(str(tmp_path / "tokenizer.json"))
+
+    table = np.eye(len(vocab), dtype=np.float32)
+    table[:2] = 0
+    h = onnx.helper
+    graph = h.make_graph(
+        [h.make_node("Gather", ["table", "input_ids"], ["token_embeddings"])],
+        "bag_of_words",
+        [h.make_tensor_value_info("input_ids", onnx.TensorProto.INT64, ["batch", "tokens"])],
+        [h.make_tensor_value_info("token_embeddings", onnx.TensorProto.FLOAT, ["batch", "tokens", len(vocab)])],
+        [onnx.numpy_helper.from_array(table, "table")],
+    )
+    onnx.save(h.make_model(graph, ir_version=8, opset_imports=[h.make_opsetid("", 13)]), str(tmp_path / "model.onnx"))
+
+    monkeypatch.setattr(embeddings_module, "EMBEDDING_MODEL_REPO", str(tmp_path))
+    monkeypatch.setattr(embeddings_module, "EMBEDDING_MODEL_FILE", "model.onnx")
+    monkeypatch.setattr(embeddings_module, "EMBEDDINGS_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(embeddings_module, "EMBEDDING_MATCH_THRESHOLD", 0.3)
+    return tmp_path
+
+
+async def _match(index: ListingEmbeddings, snapshot, text: str):
+    """First lookup starts the build and returns None; wait for it, then look up again"""
+    await index.match(snapshot, text, [l["name"] for l in snapshot.listings])
+    if index._building is not None:
+        await index._building
+    return await index.match(snapshot, text, [l["name"] for l in snapshot.listings])
+
+
+def test_match_builds_in_background_and_finds_the_listing(model_dir):
+    snapshot = SimpleNamespace(version=1, listings=tuple(LISTINGS))
+    index = ListingEmbeddings()
+
+    async def scenario():
+        assert await index.match(snapshot, "bilocale sopra la farmacia", ["Bilocale Isola"]) is None
+        await index._building
+        return await index.match(snapshot, "il bilocale sopra la farmacia", [l["name"] for l in LISTINGS])
+
+    best, closest = asyncio.run(scenario())
+    assert best == "Bilocale Isola"
+    assert closest[0] == "Bilocale Isola"
+    assert index.stats()["embedded"] == 3
+
+
+def test_restarted_worker_reuses_saved_vectors(model_dir):
+    snapshot = SimpleNamespace(version=1, listings=tuple(LISTINGS))
+    asyncio.run(_match(ListingEmbeddings(), snapshot, "attico con terrazzo"))
+
+    changed = SimpleNamespace(version=2, listings=tuple(LISTINGS[:2]) + ({**LISTINGS[2], "description": "loft"},))
+    restarted = ListingEmbeddings()
+    best, _ = asyncio.run(_match(restarted, changed, "attico con terrazzo"))
+    assert best == "Attico Navigli"
+    assert restarted.stats()["reused"] == 2
+    assert restarted.stats()["embedded"] == 1
+
+
+def test_mismatched_save_is_ignored(model_dir):
+    os.makedirs(embeddings_module.EMBEDDINGS_CACHE_DIR)
+    index = ListingEmbeddings()
+    with open(index._path(), "wb") as f:
+        np.savez(f, names=np.array(["a", "b"]), hashes=np.array(["x"]), matrix=np.zeros((2, 4), dtype=np.float32))
+    assert index._load_saved() is None
+
+
+def test_failed_build_is_retried_after_a_delay(model_dir, monkeypatch):
+    monkeypatch.setattr(embeddings_module, "EMBEDDING_RETRY_DELAY", 0.0)
+    snapshot = SimpleNamespace(version=1, listings=tuple(LISTINGS))
+    index = ListingEmbeddings()
+    load = index.embedder.load
+    calls = []
+
+    def flaky_load():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OSError("hub unreachable")
+        load()
+
+    monkeypatch.setattr(index.embedder, "load", flaky_load)
+    asyncio.run(_match(index, snapshot, "attico con terrazzo"))
+    assert index.stats()["failures"] == 1
+
+    best, _ = asyncio.run(_match(index, snapshot, "attico con terrazzo"))
+    assert best == "Attico Navigli"
+    assert index.stats()["failures"] == 0
+
+
+def test_older_build_finishing_last_does_not_replace_the_index(model_dir):
+    index = ListingEmbeddings()
+
+    async def scenario():
+        await index._refresh(SimpleNamespace(version=2, listings=tuple(LISTINGS)))
+        await index._refresh(SimpleNamespace(version=1, listings=tuple(LISTINGS[:1])))
+
+    asyncio.run(scenario())
+    assert index.stats()["version"] == 2
+    assert index.stats()["listings"] == 3
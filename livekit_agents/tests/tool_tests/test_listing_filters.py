@@ -0,0 +1,127 @@
+"""
+Budget / rooms filtering in the in-memory search path - snapshot and spatial indexes only, no database needed.
+"""
+import asyncio
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from utils.database import ListingFilters
+from utils.listings_cache import ListingsSnapshot
+from utils.spatial_index import HaversineIndex, ListingSpatialIndex, haversine_km
+
+import numpy as np
+
+
+def make_listings(n=500, seed=3):
+    rng = random.Random(seed)
+    return [
+        {
+            "id": i,
+            "name": f"Listing {i}",
+            "agency": "Primacasa",
+            "listing_type": "rent",
+            "property_type": "apartment",
+            "latitude": 45.46 + rng.uniform(-0.1, 0.1),
+            "longitude": 9.19 + rng.uniform(-0.1, 0.1),
+            "price": rng.choice([None, rng.randint(500, 3000)]),
+            "rooms": rng.choice([None, 1, 2, 3, 4]),
+            "size_sqm": None,
+        }
+        for i in range(n)
+    ]
+
+
+def test_filters_ranges_follow_sql_null_semantics():
+    filters = ListingFilters(max_price=1000, min_rooms=2)
+    assert filters.matches({"listing_type": "rent", "property_type": "apartment", "price": 900, "rooms": 2})
+    assert not filters.matches({"listing_type": "rent", "property_type": "apartment", "price": None, "rooms": 2})
+    assert not filters.matches({"listing_type": "rent", "property_type": "apartment", "price": 900, "rooms": 1})
+    assert filters.categorical() == ListingFilters()
+
+
+@pytest.mark.parametrize("index_class", [HaversineIndex, ListingSpatialIndex])
+def test_masked_nearest_matches_filter_then_rank(index_class):
+    listings = make_listings()
+    index = index_class(listings)
+    mask = index.range_mask(max_price=1500, min_rooms=3)
+    expected = [l for l in listings if l["price"] is not None and l["price"] <= 1500 and l["rooms"] is not None and l["rooms"] >= 3]
+    assert mask.sum() == len(expected)
+
+    origin = (45.47, 9.2)
+    result = index.nearest(*origin, k=3, mask=mask)
+    lat = np.radians([l["latitude"] for l in expected])
+    lon = np.radians([l["longitude"] for l in expected])
+    distances = haversine_km(*origin, lat, lon, np.cos(lat))
+    assert [l["id"] for _, l in result] == [expected[i]["id"] for i in np.argsort(distances)[:3]]
+
+
+def test_snapshot_nearest_applies_ranges_before_ranking():
+    snapshot = ListingsSnapshot(1, make_listings())
+    filters = ListingFilters(agency="primacasa", max_price=800)
+    result = snapshot.nearest(45.47, 9.2, filters, k=5)
+    assert len(result) == 5
+    assert all(l["price"] is not None and l["price"] <= 800 for _, l in result)
+    # Ranges share the categorical index instead of building one per budget
+    assert snapshot.spatial_index(filters) is snapshot.spatial_index(filters.categorical())
+
+
+def test_zone_tables_match_live_ranking_and_carry_over():
+    from utils.gazetteer import gazetteer
+
+    listings = make_listings()
+    snapshot = ListingsSnapshot(1, listings)
+    place = gazetteer.lookup("Navigli", "Milano, Italia")
+    filters = ListingFilters(max_price=2000)
+
+    zoned = snapshot.zones.nearest("milano", place, filters, k=3)
+    live = snapshot.nearest(place.latitude, place.longitude, filters, k=3)
+    assert [l["id"] for _, l in zoned] == [l["id"] for _, l in live]
+
+    # Unchanged listings: the table is reused, not re-ranked
+    reloaded = ListingsSnapshot(2, [dict(l) for l in listings], previous=snapshot)
+    assert reloaded.zones.carried_over == 1 and reloaded.zones.rebuilt == 0
+    # A moved listing invalidates it
+    moved = [dict(l) for l in listings]
+    moved[0]["latitude"] += 0.01
+    reloaded = ListingsSnapshot(3, moved, previous=reloaded)
+    assert reloaded.zones.carried_over == 0 and reloaded.zones.rebuilt == 1
+
+
+def test_failed_first_load_is_an_outage_not_an_empty_portfolio(monkeypatch):
+    from utils import database as db
+    from utils.listings_cache import ListingsCache, ListingsUnavailable
+
+    async def down(*args, **kwargs):
+        raise OSError("connection refused")
+
+    monkeypatch.setattr(db, "listen", down)
+    monkeypatch.setattr(db, "get_listings_with_version", down)
+    with pytest.raises(ListingsUnavailable):
+        asyncio.run(ListingsCache().snapshot())
+
+
+def test_snapshot_cards_are_built_off_the_event_loop(monkeypatch):
+    import threading
+    from utils import database as db
+    from utils import listings_cache as cache_module
+
+    async def no_listen(*args, **kwargs):
+        pass
+
+    async def rows(*args, **kwargs):
+        return 1, make_listings(n=20)
+
+    threads = []
+    attach_cards = cache_module.attach_cards
+    monkeypatch.setattr(db, "listen", no_listen)
+    monkeypatch.setattr(db, "get_listings_with_version", rows)
+    monkeypatch.setattr(cache_module, "attach_cards", lambda r: threads.append(threading.get_ident()) or attach_cards(r))
+
+    snapshot = asyncio.run(cache_module.ListingsCache().snapshot())
+    assert snapshot.version == 1 and snapshot.listings[0]["cards"]
+    assert threads and threads[0] != threading.get_ident()
@@ -0,0 +1,54 @@
+"""
+Phone normalization tests - pure functions, no network or database needed.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from utils.phone import normalize_phone, phone_key, phone_from_room_name
+
+
+@pytest.mark.parametrize("raw", [
+    "+393517843713",
+    "393517843713",
+    "00393517843713",
+    "+39 351 784 3713",
+    "3517843713",
+    "351-784-3713",
+])
+def test_italian_mobile_variants_share_one_key(raw):
+    assert normalize_phone(raw) == "+393517843713"
+
+
+def test_italian_landline_keeps_leading_zero():
+    assert normalize_phone("02 1234 5678") == "+390212345678"
+
+
+def test_turkish_default_country_code():
+    assert normalize_phone("5321234567", default_country_code="90") == "+905321234567"
+
+
+@pytest.mark.parametrize("raw", [None, "", "Unknown", "TEST-000000", "12"])
+def test_not_a_phone_number(raw):
+    assert normalize_phone(raw) is None
+
+
+def test_phone_key_keeps_placeholders():
+    assert phone_key("TEST-000000") == "TEST-000000"
+    assert phone_key("39 351 784 3713") == "+393517843713"
+
+
+def test_phone_from_room_name():
+    assert phone_from_room_name("call-_393517843713_abcd") == "+393517843713"
+    assert phone_from_room_name("call-_+393517843713_abcd") == "+393517843713"
+    assert phone_from_room_name("sip_room_1_3713_1700000000") is None
+    assert phone_from_room_name("") is None
+
+
+def test_phone_from_room_name_keeps_unparseable_suffix():
+    assert phone_from_room_name("call-_anonymous_abcd") == "anonymous"
+    assert phone_from_room_name("call-_5321234567_abcd", default_country_code="90") == "+905321234567"
+    assert phone_from_room_name("call-__abcd") is None
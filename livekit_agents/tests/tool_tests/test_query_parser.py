@@ -0,0 +1,97 @@
+"""
+Rule-based query parser tests - gazetteer data file only, no LLM or network needed.
+"""
+import os
+import sys
+
+import pytest
+from pydantic import ValidationError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from utils.query_parser import ExtractionCache, QueryParser, SearchParams, cache_key
+
+MILANO = "Milano, Italia"
+
+
+@pytest.mark.parametrize("query, expected", [
+    (
+        "Cliente vuole comprare appartamento residenziale zona Porta Romana, budget 200mila euro, 2-3 camere",
+        {"zone": "Porta Romana", "listing_type": "sale", "property_type": "living", "budget": 200000, "rooms": 2},
+    ),
+    (
+        "bilocale in affitto a Isola, massimo 1.500 euro al mese",
+        {"zone": "Isola", "listing_type": "rent", "property_type": "living", "budget": 1500, "rooms": 2},
+    ),
+    (
+        "cerca ufficio in affitto in via Tortona 12",
+        {"zone": "Via Tortona 12", "listing_type": "rent", "property_type": "commercial", "budget": None, "rooms": None},
+    ),
+    (
+        "box auto zona navigli",
+        {"zone": "Navigli", "listing_type": None, "property_type": "parking", "budget": None, "rooms": None},
+    ),
+    (
+        "trilocale da 1,5 milioni in centro",
+        {"zone": "Duomo", "listing_type": None, "property_type": "living", "budget": 1500000, "rooms": 3},
+    ),
+    (
+        "appartamento in viale Monza 140 fino a 3 camere",
+        {"zone": "Viale Monza 140", "listing_type": None, "property_type": "living", "budget": None, "rooms": 3},
+    ),
+])
+def test_common_phrasings_parse_confidently(query, expected):
+    parsed = QueryParser().parse(query, MILANO)
+    assert parsed.confident
+    assert parsed.params().model_dump() == expected
+
+
+@pytest.mark.parametrize("query", [
+    "vuole comprare casa con giardino e terrazzo luminosa",
+    "affitto o comprare a Brera",
+    "ufficio o appartamento a Isola",
+])
+def test_unexplained_or_contradictory_queries_go_to_llm(query):
+    assert not QueryParser().parse(query, MILANO).confident
+
+
+def test_place_names_keep_their_particles():
+    assert QueryParser().parse("vicino a Piazza Leonardo da Vinci").zone == "Piazza Leonardo Da Vinci"
+    assert QueryParser().parse("vicino a Piazza Leonardo da Vinci", MILANO).zone == "Città Studi"
+    assert QueryParser().parse("bilocale zona Navigli da 1.500 euro", MILANO).zone == "Navigli"
+
+
+@pytest.mark.parametrize("query", ["bilocale zona Navigli da 80 mq", "trilocale circa 120 metri quadri a Isola"])
+def test_size_is_not_dropped_silently(query):
+    parsed = QueryParser().parse(query, MILANO)
+    assert not parsed.confident
+    assert parsed.budget is None
+
+
+def test_hit_rate():
+    parser = QueryParser()
+    parser.parse("bilocale zona Navigli", MILANO)
+    parser.parse("casa con giardino e terrazzo", MILANO)
+    assert parser.stats()["hit_rate"] == 0.5
+
+
+def test_rephrased_queries_share_a_cache_key():
+    assert cache_key("zona Navigli, due camere") == cache_key("sì, Navigli 2 camere")
+    assert cache_key("budget 200mila euro") == cache_key("budget 200.000 euro") == cache_key("budget 200k euro")
+    assert cache_key("bilocale zona Navigli") != cache_key("trilocale zona Navigli")
+
+
+def test_extraction_cache_hit_rate():
+    cache = ExtractionCache()
+    assert cache.get("bilocale zona Navigli", MILANO) is None
+    cache.put("bilocale zona Navigli", MILANO, SearchParams(zone="Navigli", rooms=2))
+    assert cache.get("Bilocale, zona Navigli!", MILANO) == SearchParams(zone="Navigli", rooms=2)
+    assert cache.stats()["hit_rate"] == 0.5
+
+
+def test_search_params_reject_out_of_schema_output():
+    assert SearchParams.model_validate_json('{"zone": "Isola", "listing_type": "rent"}').zone == "Isola"
+    with pytest.raises(ValidationError):
+        SearchParams.model_validate_json('{"zone": "Isola", "listing_type": "affitto"}')
+    with pytest.raises(ValidationError):
+        SearchParams.model_validate_json('Ecco i parametri: {"zone": "Isola"}')
@@ -0,0 +1,52 @@
+"""
+Write-behind queue tests - the database writer is replaced by an in-memory list.
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from utils import write_behind
+from utils.write_behind import WriteBehindQueue
+
+
+def test_rows_are_batched_in_the_background():
+    batches = []
+
+    async def write(batch):
+        batches.append(list(batch))
+
+    async def scenario():
+        queue = WriteBehindQueue("test", write)
+        for i in range(5):
+            assert queue.put((f"+39{i}", "note"))
+        # Nothing is written on the caller's turn
+        assert batches == [] and queue.stats()["depth"] == 5
+        await asyncio.sleep(write_behind.WRITE_BEHIND_FLUSH_INTERVAL * 2)
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert batches == [[(f"+39{i}", "note") for i in range(5)]]
+    assert queue.stats()["written"] == 5 and queue.stats()["depth"] == 0
+
+
+def test_close_flushes_and_retries_failed_batches():
+    written = []
+    failures = [RuntimeError("db down")]
+
+    async def write(batch):
+        if failures:
+            raise failures.pop()
+        written.extend(batch)
+
+    async def scenario():
+        queue = WriteBehindQueue("test", write)
+        queue.put(("+391", "a"))
+        queue.put(("+392", "b"))
+        await queue.close()
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert written == [("+391", "a"), ("+392", "b")]
+    assert queue.stats()["dropped"] == 0
@@ -7,6 +7,7 @@ from livekit import api
 from livekit.agents import RunContext, function_tool, get_job_context
 
 from utils.agents_utils import get_google_token
+from utils.phone import phone_from_room_name
 
 logger = logging.getLogger("calendar-tools")
 CALENDAR = os.getenv("CALENDAR_ID")
@@ -34,11 +35,7 @@ async def schedule_meeting(
         else:
             job_ctx = get_job_context()
             room_name = job_ctx.room.name if job_ctx.room else ""
-            phone_number = "Unknown"
-            if room_name.startswith("call-"):
-                parts = room_name.split("_")
-                if len(parts) >= 2:
-                    phone_number = parts[1]
+            phone_number = phone_from_room_name(room_name) or "Unknown"
 
         token = get_google_token()
         start = datetime.fromisoformat(date)
@@ -1,17 +1,124 @@
+import os
 import json
-import logging
+import time
 import random
-import requests
+import asyncio
+import logging
+from typing import Optional
 
-from groq import Groq
-from geopy.distance import geodesic
+from groq import APIError
 from livekit.agents import RunContext, function_tool, get_job_context
+from pydantic import ValidationError
 
 from utils import database as db
+from utils.database import ListingFilters
+from utils.gazetteer import normalize_query
+from utils.geocoding import geocode
+from utils.listing_cards import alternative_json, compact_json, json_array, nearby_json
+from utils.listing_search import listing_search
+from utils.listings_cache import ListingsUnavailable
+from utils.llm_clients import llm_clients
+from utils.query_parser import SearchParams, extraction_cache, query_parser
+from utils.write_behind import customer_notes_queue
+from utils.phone import phone_from_room_name
 from prompts.it_inbound_prompt import immobiliare_agenzia
 
 logger = logging.getLogger("real-estate-tools")
 
+# City appended to zone names when geocoding
+GEOCODE_CITY = "Milano, Italia"
+# A filled-in SearchParams object is ~60 tokens; leave headroom for long street names
+EXTRACTION_MAX_TOKENS = int(os.getenv("EXTRACTION_MAX_TOKENS", "150"))
+
+
+def _positive_number(value):
+    """Extracted budget / rooms as a float, None if missing or not a positive number"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if number > 0 else None
+
+
+async def _llm_extract(query: str) -> Optional[SearchParams]:
+    """Search parameters extracted by the LLM, None if its output doesn't validate against SearchParams"""
+    try:
+        extraction = await llm_clients.groq().chat.completions.create(
+            model="moonshotai/kimi-k2-instruct-0905",  # Smart model for extraction
+            messages=[{
+                "role": "user",
+                "content": f"""Extract search parameters from this real estate query. Output ONLY valid JSON, nothing else.
+
+            Query: "{query}"
+
+            Extract these fields (use null if not mentioned):
+            - zone: string (neighborhood, area, or address)
+            - listing_type: "sale" or "rent"
+            - property_type: "living", "commercial" or "parking"
+            - budget: integer (in euros, convert "200mila" to 200000)
+            - rooms: integer (number of rooms/bedrooms)
+
+            JSON output:"""
+            }],
+            # Output constrained to the SearchParams schema by the provider
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": "search_params", "schema": SearchParams.model_json_schema()},
+            },
+            temperature=0,
+            max_completion_tokens=EXTRACTION_MAX_TOKENS
+        )
+        params = SearchParams.model_validate_json(extraction.choices[0].message.content or "")
+    except (APIError, ValidationError) as e:
+        # Schema violations come back as a 400 (json_validate_failed) or fail validation here
+        logger.warning(f"LLM extraction unusable for '{query}': {e!r}")
+        query_parser.record_llm(ok=False)
+        return None
+    query_parser.record_llm(ok=True)
+    return params
+
+
+class _Stages:
+    """Concurrent stages of one tool call: per-stage timings, and cancellation of whatever is still running"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.cancelled = []
+        self._tasks = {}
+
+    async def run(self, name: str, awaitable):
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.timings[name] = round((time.perf_counter() - start) * 1000)
+
+    def spawn(self, name: str, coro) -> asyncio.Task:
+        """Start a stage now, await the task when its result is needed"""
+        task = asyncio.create_task(self.run(name, coro))
+        self._tasks[task] = name
+        task.add_done_callback(self._retrieve)
+        return task
+
+    def _retrieve(self, task: asyncio.Task):
+        """Log a stage's exception, so a branch nobody awaited doesn't fail silently"""
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"get_apartment_info stage {self._tasks[task]} failed: {task.exception()!r}")
+
+    def cancel(self, task: asyncio.Task):
+        """Drop a branch whose result is no longer needed"""
+        if not task.done():
+            task.cancel()
+            self.cancelled.append(self._tasks[task])
+
+    def finish(self):
+        """Cancel the branches that lost (speculative geocode, unneeded lookups) and log the timings"""
+        for task in list(self._tasks):
+            self.cancel(task)
+        total = round((time.perf_counter() - self.started) * 1000)
+        logger.info(f"⏱️ get_apartment_info stages (ms): {self.timings} | total {total} | cancelled {self.cancelled}")
+
 
 @function_tool
 async def get_apartment_info(
@@ -29,71 +136,98 @@ async def get_apartment_info(
 
     logger.info(f"🚀🚀🚀 TOOL CALLED: get_apartment_info with query: {query}")
 
-    # Speak a filler phrase while processing (chosen randomly for variation)
+    # Speak a filler phrase while processing (chosen randomly for variation); not awaited,
+    # it plays while the search below runs
     filler_phrases = [
         "Verifico subito.",
         "Controllo i dati.",
         "Un attimo, cerco le informazioni.",
         "Vediamo cosa abbiamo.",
     ]
-    await context.session.generate_reply(
+    context.session.generate_reply(
         instructions=f"Say exactly this and nothing else: {random.choice(filler_phrases)}",
         allow_interruptions=False
     )
 
-    # Step 1: Use a smart LLM to extract structured parameters from the query
-    client = Groq()
-    extraction = client.chat.completions.create(
-        model="moonshotai/kimi-k2-instruct-0905",  # Smart model for extraction
-        messages=[{
-            "role": "user",
-            "content": f"""Extract search parameters from this real estate query. Output ONLY valid JSON, nothing else.
+    stages = _Stages()
+    try:
+        return await _search_apartments(query, stages)
+    except ListingsUnavailable as e:
+        # Database outage before the first snapshot: a temporary error, not "nothing available"
+        logger.error(f"Listings unavailable: {e}")
+        return json.dumps({
+            "status": "temporary_error",
+            "message": "Non riesco a consultare gli immobili in questo momento. Riprova tra qualche minuto."
+        })
+    finally:
+        stages.finish()
 
-            Query: "{query}"
 
-            Extract these fields (use null if not mentioned):
-            - zone: string (neighborhood, area, or address)
-            - listing_type: "sale" or "rent"
-            - property_type: "living", "commercial" or "parking"
-            - budget: integer (in euros, convert "200mila" to 200000)
-            - rooms: integer (number of rooms/bedrooms)
-
-            JSON output:"""
-        }],
-        temperature=0,
-        max_completion_tokens=600
-    )
+async def _search_apartments(query: str, stages: _Stages) -> str:
+    # Independent of the extraction: rent and sale availability of every property type, in one query
+    availability_task = stages.spawn("availability", listing_search.availability(immobiliare_agenzia))
 
-    try:
-        params = json.loads(extraction.choices[0].message.content.strip())
-    except json.JSONDecodeError:
-        # Fallback: just use the query as zone
-        params = {"zone": query, "listing_type": "rent", "property_type": "living", "budget": None, "rooms": None}
+    # Step 1: Extract structured parameters - repeats and rephrasings come from the extraction cache;
+    # otherwise the rule-based parser (utils.query_parser) handles the usual phrasings and only
+    # queries it can't read confidently go to the LLM
+    speculative_zone, geocode_task = None, None
+    params = extraction_cache.get(query, GEOCODE_CITY)
+    if params is not None:
+        logger.info(f"🧩 Extraction cache hit - hit rate {extraction_cache.stats()['hit_rate']}")
+    else:
+        parsed = query_parser.parse(query, GEOCODE_CITY)
+        logger.info(
+            f"🧩 Parsed query (confidence {parsed.confidence:.2f}): {parsed.params()} - "
+            f"parser hit rate {query_parser.stats()['hit_rate']}"
+        )
+        if parsed.confident:
+            params = parsed.params()
+        else:
+            if parsed.zone:
+                # Speculative: geocode the parser's zone guess while the LLM reads the query
+                speculative_zone = parsed.zone
+                geocode_task = stages.spawn("geocode_speculative", geocode(parsed.zone, GEOCODE_CITY))
+            params = await stages.run("llm_extraction", _llm_extract(query))
+        if params is not None:
+            extraction_cache.put(query, GEOCODE_CITY, params)
+        else:
+            # Unusable LLM output: keep what the rules found (not cached, so it's retried). No zone
+            # found means suggestions, not geocoding the whole sentence
+            params = parsed.params()
 
     logger.info(f"🔍 Extracted params: {params}")
 
-    zone = params.get("zone")
-    budget = params.get("budget")
-    listing_type = params.get("listing_type", "rent")
-    property_type = params.get("property_type", "living")
-
-    # Step 2: Check if we have listings of the requested type (rent vs sale)
-    available_listings = db.getCurrentListings(
-        Real_Estate_Agency=immobiliare_agenzia,
-        property_type=property_type,
-        listing_type=listing_type
+    zone = params.zone
+    budget = _positive_number(params.budget)
+    rooms = _positive_number(params.rooms)
+    listing_type = params.listing_type or "rent"
+    property_type = params.property_type or "living"
+
+    # Listing lookups go through the configured search backend (in-memory snapshot or Postgres);
+    # budget and rooms are applied there, before ranking
+    filters = ListingFilters(
+        immobiliare_agenzia, property_type, listing_type,
+        max_price=budget, min_rooms=int(rooms) if rooms else None
     )
 
-    if available_listings == "No listings found.":
+    if zone and (geocode_task is None or normalize_query(zone) != normalize_query(speculative_zone)):
+        # The speculation lost (LLM found another zone): drop it and geocode the real one, already
+        # running while availability and the zone tables are checked
+        if geocode_task is not None:
+            stages.cancel(geocode_task)
+        geocode_task = stages.spawn("geocode", geocode(zone, GEOCODE_CITY))
+
+    # Step 2: Check if we have listings of the requested type (rent vs sale). Unknown availability
+    # (query failed) skips the check: the search below answers for itself
+    availability = await availability_task
+    if availability is None:
+        logger.warning("Listing availability unknown, skipping the availability check")
+
+    if availability is not None and not availability.get((listing_type, property_type)):
         # Check what we DO have
         opposite_type = "sale" if listing_type == "rent" else "rent"
-        opposite_listings = db.getCurrentListings(
-            Real_Estate_Agency=immobiliare_agenzia,
-            property_type=property_type,
-            listing_type=opposite_type
-        )
 
-        if opposite_listings != "No listings found.":
+        if availability.get((opposite_type, property_type)):
             if listing_type == "rent":
                 return json.dumps({
                     "status": "no_rentals",
@@ -112,51 +246,69 @@ async def get_apartment_info(
 
     # Step 3: If no zone provided, return suggestions based on other filters
     if not zone:
-        listings = db.getAllListingsWithCoords()
+        listings = await stages.run("suggestions", listing_search.suggestions(filters, limit=5))
 
-        if budget:
-            listings = [l for l in listings if l.get('price', 0) <= budget]
+        if not listings and filters.has_ranges():
+            listings = await stages.run("suggestions_relaxed", listing_search.suggestions(filters.categorical(), limit=5))
 
-        if not listings:
-            listings = db.getAllListingsWithCoords()[:5]
-        else:
-            listings = listings[:5]
+        # Cards are pre-serialized at snapshot load (utils.listing_cards); just splice them
+        return (
+            '{"status": "suggestions", "message": "Ecco alcune proposte", "listings": '
+            + json_array(compact_json(l) for l in listings) + '}'
+        )
 
-        return json.dumps({
-            "status": "suggestions",
-            "message": "Ecco alcune proposte",
-            "listings": [
-                {
-                    "name": l['name'],
-                    "address": l['address'],
-                    "price": l['price'],
-                    "rooms": l.get('rooms', 'N/A'),
-                    "description": l.get('description', '')[:150]
-                } for l in listings
-            ]
-        })
+    # Step 3: Zone provided - known quartieri / stations / landmarks come straight from the
+    # snapshot's precomputed zone -> nearest listings tables (utils.zone_listings); otherwise
+    # the geocode started above: memory cache, gazetteer, Postgres cache, then rate-limited
+    # Nominatim, all within a fixed budget (utils.geocoding)
+    user_coords = None
 
-    # Step 3: Zone provided - try geocoding
-    response_openstreetmap = requests.get(
-        url="https://nominatim.openstreetmap.org/search",
-        params={
-            "q": f"{zone}, Milano, Italia",
-            "format": "json",
-            "limit": 1
-        },
-        headers={"User-Agent": "RinovaAI/1.0 (rinova.capmapai.com)"}
-    )
-    geo_data = response_openstreetmap.json()
-
-    # Step 3a: Geocoding failed - use LLM to match listing name
-    if not geo_data:
-        listings = db.getCurrentListings(
-            Real_Estate_Agency=immobiliare_agenzia,
-            property_type=params.get("property_type", "living"),
-            listing_type=params.get("listing_type", "rent")
-        )
-        client = Groq()
-        completion = client.chat.completions.create(
+    async def rank(f: ListingFilters):
+        if user_coords:
+            return await listing_search.nearest(*user_coords, filters=f, k=3)
+        return await listing_search.nearest_to_zone(zone, GEOCODE_CITY, f, k=3)
+
+    top3 = await stages.run("zone_table", rank(filters))
+    if top3 is None:
+        user_coords = await geocode_task
+    else:
+        stages.cancel(geocode_task)
+
+    # Step 3a: Geocoding failed - maybe the user named a listing; try the trigram index, then the LLM
+    if top3 is None and not user_coords:
+        # All three lookups are independent: start them together so their latencies overlap.
+        # Results are still taken in priority order (trigram name, then full text, then the
+        # name list for the LLM); a lower-priority answer never preempts a pending higher one
+        trigram_task = stages.spawn("trigram", listing_search.similar_names(zone, filters.categorical(), limit=1))
+        fulltext_task = stages.spawn("full_text", listing_search.search(zone, filters, k=3))
+        names_task = stages.spawn("listing_names", listing_search.names(filters.categorical()))
+
+        matches = await trigram_task
+        if matches:
+            card = await stages.run("card", listing_search.card(matches[0]))
+            if card:
+                logger.info(f"🔎 Trigram match for '{zone}': {matches[0]}")
+                return card
+
+        # Descriptive zone ("sopra la farmacia"): one full-text query, all terms required
+        hits = await fulltext_task
+        if hits:
+            logger.info(f"🔎 Full-text matches for '{zone}': {[l['name'] for l in hits]}")
+            return '{"status": "text_match", "listings": ' + json_array(compact_json(l) for l in hits) + '}'
+
+        # Semantic match on the local embedding index: a few ms, however many listings we have
+        semantic = await stages.run("embedding_match", listing_search.semantic_match(zone, filters.categorical(), k=3))
+        if semantic is not None:
+            best, closest = semantic
+            card = await listing_search.card(best) if best else None
+            if card:
+                logger.info(f"🔎 Embedding match for '{zone}': {best}")
+                return card
+            return json.dumps({"status": "suggestions", "suggestions": closest})
+
+        # Index not ready (first build running, or no model): let the LLM pick from the names
+        listings = ", ".join(await names_task)
+        completion = await stages.run("llm_listing_match", llm_clients.groq().chat.completions.create(
             model="moonshotai/kimi-k2-instruct-0905",
             messages=[
             {
@@ -173,7 +325,7 @@ Output only the listing name(s), nothing else."""
             }],
             temperature=0.1,
             max_completion_tokens=1000
-        )
+        ))
 
         listing_names = completion.choices[0].message.content
 
@@ -185,34 +337,24 @@ Output only the listing name(s), nothing else."""
             })
 
         # Single match found
-        listing = db.getListing(listing_names.strip())
-        if listing:
-            return listing.json()
+        card = await listing_search.card(listing_names.strip())
+        if card:
+            return card
         else:
-            all_listings = db.getCurrentListings()
             return json.dumps({
                 "status": "suggestions",
-                "suggestions": [name.strip() for name in all_listings.split(",")[:3]]
+                "suggestions": (await listing_search.names(ListingFilters()))[:3]
             })
 
-    # Step 4: Geocoding succeeded - find closest listings by distance
-    user_coords = (float(geo_data[0]["lat"]), float(geo_data[0]["lon"]))
-
-    listings = db.getAllListingsWithCoords(
-        Real_Estate_Agency=immobiliare_agenzia,
-        property_type=property_type,
-        listing_type=listing_type
-    )
-
-    # Calculate distance for each listing
-    for listing in listings:
-        listing['distance_km'] = geodesic(
-            user_coords,
-            (listing['latitude'], listing['longitude'])
-        ).km
-
-    # Sort by distance and get top 3
-    top3 = sorted(listings, key=lambda x: x['distance_km'])[:3]
+    # Step 4: Zone located - find closest listings by distance
+    # Top 3 by distance
+    if top3 is None:
+        top3 = await stages.run("nearest", rank(filters))
+    filters_relaxed = False
+    if not top3 and filters.has_ranges():
+        # Nothing within budget / rooms nearby: show the closest ones anyway
+        top3 = await stages.run("nearest_relaxed", rank(filters.categorical())) or []
+        filters_relaxed = bool(top3)
 
     # No listings with coordinates found for this filter
     if not top3:
@@ -223,20 +365,12 @@ Output only the listing name(s), nothing else."""
         })
 
     # Return raw data - let LLM decide how to present it
-    return json.dumps({
-        "status": "found_nearby" if top3[0]['distance_km'] >= 0.1 else "exact_match",
-        "closest": {
-            "name": top3[0]['name'],
-            "address": top3[0]['address'],
-            "distance_meters": int(top3[0]['distance_km'] * 1000),
-            "price": top3[0]['price'],
-            "description": top3[0]['description'][:300]
-        },
-        "alternatives": [
-            {"name": l['name'], "distance_meters": int(l['distance_km'] * 1000)}
-            for l in top3[1:3]
-        ]
-    })
+    status = "found_nearby" if top3[0]['distance_km'] >= 0.1 else "exact_match"
+    return (
+        f'{{"status": "{status}", "filters_relaxed": {json.dumps(filters_relaxed)}, '
+        f'"closest": {nearby_json(top3[0])}, '
+        f'"alternatives": {json_array(alternative_json(l) for l in top3[1:3])}}}'
+    )
 
 
 @function_tool
@@ -252,7 +386,7 @@ async def immobiliare_offers(context: RunContext, agency: str):
     """
     logger.info(f"🎁 TOOL: immobiliare_offers | agency={agency}")
 
-    offers = db.get_offers_by_agency(agency)
+    offers = await db.get_offers_by_agency(agency)
 
     if not offers:
         return f"Nessuna offerta disponibile per {agency}."
@@ -281,17 +415,9 @@ async def note_info(context: RunContext, note: str):
     else:
         job_ctx = get_job_context()
         room_name = job_ctx.room.name if job_ctx.room else ""
-        phone_number = "Unknown"
-        if room_name.startswith("call-"):
-            parts = room_name.split("_")
-            if len(parts) >= 2:
-                phone_number = parts[1]
-
-    # Save note to database
-    success = db.add_customer_note(phone_number, note)
+        phone_number = phone_from_room_name(room_name) or "Unknown"
 
-    if success:
-        return f"Ho annotato: {note}"
-    else:
-        logger.error(f"Failed to save note for {phone_number}")
-        return f"Ho annotato: {note}"
+    # Written in the background (utils.write_behind), off the spoken turn
+    if not customer_notes_queue.put((phone_number, note)):
+        logger.error(f"Failed to queue note for {phone_number}")
+    return f"Ho annotato: {note}"
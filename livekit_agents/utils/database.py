@@ -1,16 +1,41 @@
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from contextlib import contextmanager
+import time
+import asyncio
+import asyncpg
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, replace
+from datetime import datetime
 from pydantic import BaseModel
 from typing import Optional
 from dotenv import load_dotenv
 
+from utils.phone import phone_key
+
 load_dotenv()
 
 # Get database URL from environment variable
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Connection pool settings (per worker process)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Seconds a caller may wait for a free connection before giving up
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "2.0"))
+# Server-side statement_timeout applied to every pooled connection
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "3000"))
+# Client-side deadline for a single query (a bit above the server timeout)
+DB_QUERY_TIMEOUT = DB_STATEMENT_TIMEOUT_MS / 1000 + 0.5
+# Pool waits longer than this are reported as slow
+DB_POOL_SLOW_WAIT_MS = float(os.getenv("DB_POOL_SLOW_WAIT_MS", "50"))
+# pg_trgm thresholds: similarity() for agency names, word_similarity() for listing names
+TRGM_SIMILARITY_THRESHOLD = float(os.getenv("TRGM_SIMILARITY_THRESHOLD", "0.3"))
+TRGM_WORD_SIMILARITY_THRESHOLD = float(os.getenv("TRGM_WORD_SIMILARITY_THRESHOLD", "0.5"))
+# Minimum ts_rank_cd for a full-text hit. Cover density: two terms a few words apart in a description
+# score ~0.07, the same two terms at opposite ends of a long description ~0.005
+FULLTEXT_MIN_RANK = float(os.getenv("FULLTEXT_MIN_RANK", "0.05"))
+# Notes kept in the compacted customer_notes rollup injected into prompts
+CUSTOMER_NOTES_ROLLUP_SIZE = int(os.getenv("CUSTOMER_NOTES_ROLLUP_SIZE", "20"))
+
 class Listing(BaseModel):
     name: str
     description: str
@@ -20,71 +45,315 @@ class Listing(BaseModel):
     image_url: Optional[str] = None
     latitude: Optional[float] = None
     longitude: Optional[float] = None
+    property_type: Optional[str] = None
+    listing_type: Optional[str] = None
+    rooms: Optional[int] = None
+    size_sqm: Optional[float] = None
+
+    @classmethod
+    def from_row(cls, row) -> "Listing":
+        """Build a Listing from a listings row (asyncpg Record or dict)"""
+        return cls(
+            name=row['name'],
+            description=row['description'],
+            address=row['address'],
+            price=row['price'],
+            agency=row['agency'],
+            image_url=row.get('image_url'),
+            latitude=row.get('latitude'),
+            longitude=row.get('longitude'),
+            property_type=row.get('property_type'),
+            listing_type=row.get('listing_type'),
+            rooms=row.get('rooms'),
+            size_sqm=row.get('size_sqm')
+        )
+
+
+# Property types excluded from "living" and included in "commercial"
+NON_LIVING_TYPES = ('office', 'commercial', 'parking')
+COMMERCIAL_TYPES = ('office', 'commercial')
+
+
+@dataclass(frozen=True)
+class ListingFilters:
+    """Listing search filters, shared by the SQL queries and the in-memory snapshot.
+
+    property_type: "living" (apartments, lofts, etc.), "parking" or "commercial" (offices, shops)
+    listing_type: "rent" or "sale"
+    max_price / min_rooms / min_size_sqm: optional ranges; listings with the value unknown don't match
+    """
+    agency: Optional[str] = None
+    property_type: str = "living"
+    listing_type: str = "rent"
+    max_price: Optional[float] = None
+    min_rooms: Optional[int] = None
+    min_size_sqm: Optional[float] = None
+
+    def has_ranges(self) -> bool:
+        return self.max_price is not None or self.min_rooms is not None or self.min_size_sqm is not None
+
+    def categorical(self) -> "ListingFilters":
+        """The same filters without the price/rooms/size ranges"""
+        return replace(self, max_price=None, min_rooms=None, min_size_sqm=None)
+
+    def sql_conditions(self, params: list) -> list:
+        """WHERE conditions for these filters, appending their values to params ($n placeholders)"""
+        conditions = []
+        if self.agency:
+            # Case-insensitive equality, served by listings_filter_idx
+            params.append(self.agency)
+            conditions.append(f"lower(agency) = lower(${len(params)})")
+
+        params.append(self.listing_type)
+        conditions.append(f"listing_type = ${len(params)}")
+
+        if self.property_type == "living":
+            conditions.append("property_type NOT IN ('office', 'commercial', 'parking')")
+        elif self.property_type == "parking":
+            conditions.append("property_type = 'parking'")
+        else:
+            conditions.append("property_type IN ('office', 'commercial')")
+
+        if self.max_price is not None:
+            params.append(self.max_price)
+            conditions.append(f"price <= ${len(params)}")
+        if self.min_rooms is not None:
+            params.append(self.min_rooms)
+            conditions.append(f"rooms >= ${len(params)}")
+        if self.min_size_sqm is not None:
+            params.append(self.min_size_sqm)
+            conditions.append(f"size_sqm >= ${len(params)}")
+        return conditions
+
+    def matches(self, listing: dict) -> bool:
+        """Same semantics as sql_conditions, evaluated on a listing dict"""
+        if self.agency and (listing.get('agency') or '').lower() != self.agency.lower():
+            return False
+        if listing.get('listing_type') != self.listing_type:
+            return False
+        property_type = listing.get('property_type')
+        # NULL property_type never matches, as in SQL
+        if property_type is None:
+            return False
+        if self.property_type == "living":
+            if property_type in NON_LIVING_TYPES:
+                return False
+        elif self.property_type == "parking":
+            if property_type != 'parking':
+                return False
+        elif property_type not in COMMERCIAL_TYPES:
+            return False
+        return self.matches_ranges(listing)
+
+    def matches_ranges(self, listing: dict) -> bool:
+        """Only the price/rooms/size part of matches()"""
+        if self.max_price is not None and (listing.get('price') is None or listing['price'] > self.max_price):
+            return False
+        if self.min_rooms is not None and (listing.get('rooms') is None or listing['rooms'] < self.min_rooms):
+            return False
+        if self.min_size_sqm is not None and (listing.get('size_sqm') is None or listing['size_sqm'] < self.min_size_sqm):
+            return False
+        return True
 
-@contextmanager
-def get_connection():
-    """Context manager for database connections"""
+
+class PoolStats:
+    """Pool-wait metrics for the current worker process"""
+
+    def __init__(self):
+        self.acquires = 0
+        self.timeouts = 0
+        self.slow_waits = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def record(self, wait_ms: float):
+        self.acquires += 1
+        self.total_wait_ms += wait_ms
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        if wait_ms >= DB_POOL_SLOW_WAIT_MS:
+            self.slow_waits += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "acquires": self.acquires,
+            "timeouts": self.timeouts,
+            "slow_waits": self.slow_waits,
+            "avg_wait_ms": round(self.total_wait_ms / self.acquires, 2) if self.acquires else 0.0,
+            "max_wait_ms": round(self.max_wait_ms, 2),
+        }
+
+
+_pool: Optional[asyncpg.Pool] = None
+_pool_loop: Optional[asyncio.AbstractEventLoop] = None
+_pool_lock: Optional[asyncio.Lock] = None
+pool_stats = PoolStats()
+
+
+async def get_pool() -> asyncpg.Pool:
+    """Return the worker's connection pool, creating it on first use.
+
+    asyncpg pools are bound to the event loop that created them, so a new pool
+    is built if we are called from a different loop (e.g. a fresh test loop).
+    """
+    global _pool, _pool_loop, _pool_lock
     if not DATABASE_URL:
         raise ValueError("DATABASE_URL environment variable is not set")
-    conn = psycopg2.connect(DATABASE_URL)
+
+    loop = asyncio.get_running_loop()
+    if _pool is not None and _pool_loop is loop:
+        return _pool
+
+    if _pool_lock is None or _pool_loop is not loop:
+        _pool_lock = asyncio.Lock()
+        if _pool is not None:
+            # Pool belongs to a dead/other loop - drop its sockets without awaiting
+            _pool.terminate()
+            _pool = None
+        _pool_loop = loop
+
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                DATABASE_URL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                command_timeout=DB_QUERY_TIMEOUT,
+                max_inactive_connection_lifetime=300,
+                server_settings={"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)},
+            )
+    return _pool
+
+
+async def close_pool():
+    """Close the worker's connection pool and listener (process exit / scripts, not per job)"""
+    global _pool, _pool_loop, _pool_lock
+    await close_listener()
+    if _pool is not None:
+        await _pool.close()
+    _pool = None
+    _pool_loop = None
+    _pool_lock = None
+
+
+def get_pool_stats() -> dict:
+    """Pool-wait metrics plus current pool occupancy"""
+    stats = pool_stats.as_dict()
+    if _pool is not None:
+        stats["size"] = _pool.get_size()
+        stats["idle"] = _pool.get_idle_size()
+        stats["max_size"] = _pool.get_max_size()
+    return stats
+
+
+async def connect_direct(statement_timeout_ms: int = 0) -> asyncpg.Connection:
+    """Dedicated, unpooled connection for long-running maintenance (migrations, bulk loads)"""
+    if not DATABASE_URL:
+        raise ValueError("DATABASE_URL environment variable is not set")
+    return await asyncpg.connect(DATABASE_URL, server_settings={"statement_timeout": str(statement_timeout_ms)})
+
+
+@asynccontextmanager
+async def get_connection():
+    """Async context manager that borrows a pooled connection"""
+    pool = await get_pool()
+    start = time.perf_counter()
+    try:
+        conn = await pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        pool_stats.timeouts += 1
+        raise
+    wait_ms = (time.perf_counter() - start) * 1000
+    pool_stats.record(wait_ms)
+    if wait_ms >= DB_POOL_SLOW_WAIT_MS:
+        print(f"Slow database pool acquire: {wait_ms:.1f}ms ({get_pool_stats()})")
     try:
         yield conn
     finally:
-        conn.close()
-
-def init_db():
-    """Initialize the database schema"""
-    with get_connection() as conn:
-        with conn.cursor() as c:
-            c.execute('''CREATE TABLE IF NOT EXISTS listings (
-                id SERIAL PRIMARY KEY,
-                name TEXT UNIQUE,
-                description TEXT,
-                address TEXT,
-                price REAL,
-                agency TEXT,
-                image_url TEXT,
-                latitude REAL,
-                longitude REAL
-            )''')
-            
-            # Whitelist table for phone numbers
-            c.execute('''CREATE TABLE IF NOT EXISTS whitelist (
-                phone_number TEXT PRIMARY KEY,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )''')
-
-            # Offers table for immobiliare offers (outbound)
-            c.execute('''CREATE TABLE IF NOT EXISTS offers (
-                id SERIAL PRIMARY KEY,
-                agency TEXT NOT NULL,
-                offer TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )''')
-
-            # Customer notes table for outbound calls
-            c.execute('''CREATE TABLE IF NOT EXISTS customer_notes (
-                phone_number TEXT PRIMARY KEY,
-                notes TEXT NOT NULL,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )''')
-            conn.commit()
-            
-            # Check if empty and add dummy data for testing
-            c.execute("SELECT count(*) FROM listings")
-            if c.fetchone()[0] == 0:
-                dummy_listings = [
-                    ("Luxury Python Villa", "A beautiful villa for snakes", "123 Python Way", 1500000, "RinovaAI", "http://example.com/1.jpg", None, None),
-                    ("Cozy Coder Studio", "Small studio for devs", "404 Not Found St", 500, "RinovaAI", "http://example.com/2.jpg", None, None)
-                ]
-                c.executemany(
-                    "INSERT INTO listings (name, description, address, price, agency, image_url, latitude, longitude) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-                    dummy_listings
-                )
-                conn.commit()
-                print("Initialized database with dummy data")
+        await pool.release(conn)
+
+
+# ===== CHANGE NOTIFICATIONS =====
+
+# One dedicated LISTEN connection per worker, shared by every in-process cache.
+# Handlers get the NOTIFY payload, or None when notifications may have been
+# missed (connection lost) and the cache should resync from the table.
+_listen_conn: Optional[asyncpg.Connection] = None
+_listen_loop: Optional[asyncio.AbstractEventLoop] = None
+_listen_lock: Optional[asyncio.Lock] = None
+_listen_handlers: dict = {}
+_listen_channels: set = set()
+
+
+def _dispatch_notification(conn, pid, channel, payload):
+    for handler in list(_listen_handlers.get(channel, [])):
+        try:
+            handler(payload)
+        except Exception as e:
+            print(f"Error handling notification on {channel}: {e}")
+
+
+def _on_listener_terminated(conn):
+    global _listen_conn
+    if conn is not _listen_conn:
+        return
+    _listen_conn = None
+    _listen_channels.clear()
+    for handlers in list(_listen_handlers.values()):
+        for handler in list(handlers):
+            handler(None)
+
+
+async def listen(channel: str, handler) -> None:
+    """Register handler(payload) for NOTIFYs on channel, connecting the listener if needed"""
+    global _listen_conn, _listen_loop, _listen_lock
+    if not DATABASE_URL:
+        raise ValueError("DATABASE_URL environment variable is not set")
 
-def getCurrentListings(Real_Estate_Agency=None, property_type="living", listing_type="rent"):
+    loop = asyncio.get_running_loop()
+    if _listen_lock is None or _listen_loop is not loop:
+        _listen_lock = asyncio.Lock()
+        if _listen_conn is not None:
+            _listen_conn.terminate()
+            _listen_conn = None
+            _listen_channels.clear()
+        _listen_loop = loop
+
+    handlers = _listen_handlers.setdefault(channel, [])
+    if handler not in handlers:
+        handlers.append(handler)
+
+    async with _listen_lock:
+        if _listen_conn is None or _listen_conn.is_closed():
+            _listen_channels.clear()
+            _listen_conn = await asyncpg.connect(DATABASE_URL)
+            _listen_conn.add_termination_listener(_on_listener_terminated)
+        for name in list(_listen_handlers):
+            if name not in _listen_channels:
+                await _listen_conn.add_listener(name, _dispatch_notification)
+                _listen_channels.add(name)
+
+
+def is_listening(channel: str) -> bool:
+    """Whether NOTIFYs on channel are currently being delivered"""
+    return _listen_conn is not None and not _listen_conn.is_closed() and channel in _listen_channels
+
+
+async def close_listener():
+    """Close the worker's LISTEN connection"""
+    global _listen_conn, _listen_loop, _listen_lock
+    conn = _listen_conn
+    _listen_conn = None
+    _listen_channels.clear()
+    if conn is not None and not conn.is_closed():
+        if _listen_loop is asyncio.get_running_loop():
+            await conn.close()
+        else:
+            conn.terminate()
+    _listen_loop = None
+    _listen_lock = None
+
+
+async def getCurrentListings(Real_Estate_Agency=None, property_type="living", listing_type="rent"):
     """Get all listing names, optionally filtered by agency, property type, and listing type.
     
     Args:
@@ -92,237 +361,527 @@ def getCurrentListings(Real_Estate_Agency=None, property_type="living", listing_
         property_type: "living" (apartments, lofts, etc.) or "commercial" (offices, shops)
         listing_type: "rent" or "sale"
     """
-    with get_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as c:
-            try:
-                if property_type == "living":
-                    # Exclude offices, commercial properties, and parking
-                    if Real_Estate_Agency:
-                        c.execute("""
-                            SELECT name FROM listings
-                            WHERE agency ILIKE %s
-                            AND property_type NOT IN ('office', 'commercial', 'parking')
-                            AND listing_type = %s
-                        """, (Real_Estate_Agency, listing_type))
-                    else:
-                        c.execute("""
-                            SELECT name FROM listings
-                            WHERE property_type NOT IN ('office', 'commercial', 'parking')
-                            AND listing_type = %s
-                        """, (listing_type,))
-                elif property_type == "parking":
-                    # Parking properties
-                    if Real_Estate_Agency:
-                        c.execute("""
-                            SELECT name FROM listings
-                            WHERE agency ILIKE %s
-                            AND property_type = 'parking'
-                            AND listing_type = %s
-                        """, (Real_Estate_Agency, listing_type))
-                    else:
-                        c.execute("""
-                            SELECT name FROM listings
-                            WHERE property_type = 'parking'
-                            AND listing_type = %s
-                        """, (listing_type,))
+    try:
+        async with get_connection() as conn:
+            if property_type == "living":
+                # Exclude offices, commercial properties, and parking
+                if Real_Estate_Agency:
+                    rows = await conn.fetch("""
+                        SELECT name FROM listings
+                        WHERE agency ILIKE $1
+                        AND property_type NOT IN ('office', 'commercial', 'parking')
+                        AND listing_type = $2
+                    """, Real_Estate_Agency, listing_type, timeout=DB_QUERY_TIMEOUT)
+                else:
+                    rows = await conn.fetch("""
+                        SELECT name FROM listings
+                        WHERE property_type NOT IN ('office', 'commercial', 'parking')
+                        AND listing_type = $1
+                    """, listing_type, timeout=DB_QUERY_TIMEOUT)
+            elif property_type == "parking":
+                # Parking properties
+                if Real_Estate_Agency:
+                    rows = await conn.fetch("""
+                        SELECT name FROM listings
+                        WHERE agency ILIKE $1
+                        AND property_type = 'parking'
+                        AND listing_type = $2
+                    """, Real_Estate_Agency, listing_type, timeout=DB_QUERY_TIMEOUT)
+                else:
+                    rows = await conn.fetch("""
+                        SELECT name FROM listings
+                        WHERE property_type = 'parking'
+                        AND listing_type = $1
+                    """, listing_type, timeout=DB_QUERY_TIMEOUT)
+            else:
+                # Commercial properties (offices, shops, etc.)
+                if Real_Estate_Agency:
+                    rows = await conn.fetch("""
+                        SELECT name FROM listings
+                        WHERE agency ILIKE $1
+                        AND property_type IN ('office', 'commercial')
+                        AND listing_type = $2
+                    """, Real_Estate_Agency, listing_type, timeout=DB_QUERY_TIMEOUT)
                 else:
-                    # Commercial properties (offices, shops, etc.)
-                    if Real_Estate_Agency:
-                        c.execute("""
-                            SELECT name FROM listings
-                            WHERE agency ILIKE %s
-                            AND property_type IN ('office', 'commercial')
-                            AND listing_type = %s
-                        """, (Real_Estate_Agency, listing_type))
-                    else:
-                        c.execute("""
-                            SELECT name FROM listings
-                            WHERE property_type IN ('office', 'commercial')
-                            AND listing_type = %s
-                        """, (listing_type,))
-                rows = c.fetchall()
-                
-                if not rows:
-                    return "No listings found."
-                    
-                return ", ".join([row['name'] for row in rows])
-            except Exception as e:
-                print(f"Error fetching listings: {e}")
-                return "Error fetching listings"
-
-
-def getListing(listing_name):
+                    rows = await conn.fetch("""
+                        SELECT name FROM listings
+                        WHERE property_type IN ('office', 'commercial')
+                        AND listing_type = $1
+                    """, listing_type, timeout=DB_QUERY_TIMEOUT)
+
+        if not rows:
+            return "No listings found."
+
+        return ", ".join([row['name'] for row in rows])
+    except Exception as e:
+        print(f"Error fetching listings: {e}")
+        return "Error fetching listings"
+
+
+async def getListing(listing_name):
     """Get a single listing by name"""
-    with get_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as c:
-            try:
-                c.execute("SELECT * FROM listings WHERE name = %s", (listing_name,))
-                row = c.fetchone()
-                
-                if row:
-                    return Listing(
-                        name=row['name'],
-                        description=row['description'],
-                        address=row['address'],
-                        price=row['price'],
-                        agency=row['agency'],
-                        image_url=row['image_url'],
-                        latitude=row.get('latitude'),
-                        longitude=row.get('longitude')
-                    )
-                return None
-            except Exception as e:
-                print(f"Error fetching listing details: {e}")
-                return None
-
-def getAllListingsWithCoords(Real_Estate_Agency=None, property_type="living", listing_type="rent"):
+    try:
+        async with get_connection() as conn:
+            row = await conn.fetchrow(
+                "SELECT * FROM listings WHERE name = $1", listing_name, timeout=DB_QUERY_TIMEOUT
+            )
+
+        if row:
+            return Listing.from_row(row)
+        return None
+    except Exception as e:
+        print(f"Error fetching listing details: {e}")
+        return None
+
+async def getAllListingsWithCoords(Real_Estate_Agency=None, property_type="living", listing_type="rent"):
     """Get all listings with coordinates, filtered by agency, property type, and listing type."""
-    with get_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as c:
-            try:
-                conditions = ["latitude IS NOT NULL", "longitude IS NOT NULL"]
-                params = []
+    try:
+        filters = ListingFilters(Real_Estate_Agency, property_type, listing_type)
+        params = []
+        conditions = ["latitude IS NOT NULL", "longitude IS NOT NULL"] + filters.sql_conditions(params)
 
-                if Real_Estate_Agency:
-                    conditions.append("agency ILIKE %s")
-                    params.append(Real_Estate_Agency)
+        query = f"SELECT * FROM listings WHERE {' AND '.join(conditions)}"
+        async with get_connection() as conn:
+            rows = await conn.fetch(query, *params, timeout=DB_QUERY_TIMEOUT)
+        return [dict(row) for row in rows]
+    except Exception as e:
+        print(f"Error fetching listings with coords: {e}")
+        return []
 
-                conditions.append("listing_type = %s")
-                params.append(listing_type)
+# Columns shipped for search results: everything the tools show, descriptions pre-truncated
+LISTING_RESULT_COLUMNS = """id, name, address, price, rooms, size_sqm, agency, listing_type, property_type,
+    latitude, longitude, left(description, 300) AS description"""
 
-                if property_type == "living":
-                    conditions.append("property_type NOT IN ('office', 'commercial', 'parking')")
-                elif property_type == "parking":
-                    conditions.append("property_type = 'parking'")
-                else:
-                    conditions.append("property_type IN ('office', 'commercial')")
+# Columns held in the in-process snapshot (not search_vector, that one only lives in Postgres)
+LISTING_SNAPSHOT_COLUMNS = """id, name, description, address, price, rooms, size_sqm, agency, image_url,
+    latitude, longitude, property_type, listing_type"""
+
+async def nearest_listings(latitude: float, longitude: float, k: int = 3, filters: Optional[ListingFilters] = None) -> list:
+    """Top-k geocoded listings nearest to a point, ranked inside Postgres.
+
+    Uses the GiST index on ll_to_earth(latitude, longitude) for KNN ordering and
+    returns only the result columns, each row with a distance_km field.
+    """
+    try:
+        filters = filters or ListingFilters()
+        params = [latitude, longitude]
+        conditions = ["latitude IS NOT NULL", "longitude IS NOT NULL"] + filters.sql_conditions(params)
+        params.append(k)
+        query = f"""
+            SELECT {LISTING_RESULT_COLUMNS},
+                earth_distance(ll_to_earth(latitude, longitude), ll_to_earth($1, $2)) / 1000.0 AS distance_km
+            FROM listings
+            WHERE {' AND '.join(conditions)}
+            ORDER BY ll_to_earth(latitude, longitude) <-> ll_to_earth($1, $2)
+            LIMIT ${len(params)}
+        """
+        async with get_connection() as conn:
+            rows = await conn.fetch(query, *params, timeout=DB_QUERY_TIMEOUT)
+        return [dict(row) for row in rows]
+    except Exception as e:
+        print(f"Error fetching nearest listings: {e}")
+        return []
+
+async def get_listing_names(filters: Optional[ListingFilters] = None) -> list:
+    """Names of the listings matching the filters"""
+    try:
+        params = []
+        conditions = (filters or ListingFilters()).sql_conditions(params)
+        async with get_connection() as conn:
+            rows = await conn.fetch(
+                f"SELECT name FROM listings WHERE {' AND '.join(conditions)} ORDER BY id",
+                *params, timeout=DB_QUERY_TIMEOUT
+            )
+        return [row['name'] for row in rows]
+    except Exception as e:
+        print(f"Error fetching listing names: {e}")
+        return []
+
+async def get_listing_availability(agency: Optional[str] = None) -> Optional[dict]:
+    """{(listing_type, property_type): count} for every rent/sale x living/commercial/parking pair, in one query.
+
+    None on error: unknown availability, not an empty inventory.
+    """
+    try:
+        async with get_connection() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT listing_type,
+                       CASE WHEN property_type = 'parking' THEN 'parking'
+                            WHEN property_type IN ('office', 'commercial') THEN 'commercial'
+                            ELSE 'living' END AS category,
+                       count(*) AS n
+                FROM listings
+                WHERE ($1::text IS NULL OR lower(agency) = lower($1)) AND property_type IS NOT NULL
+                GROUP BY 1, 2
+                """,
+                agency, timeout=DB_QUERY_TIMEOUT
+            )
+        return {(row['listing_type'], row['category']): row['n'] for row in rows}
+    except Exception as e:
+        print(f"Error fetching listing availability: {e}")
+        return None
+
+async def get_listing_suggestions(filters: Optional[ListingFilters] = None, limit: int = 5) -> list:
+    """A few geocoded listings matching the filters (budget / rooms included)"""
+    try:
+        params = []
+        conditions = ["latitude IS NOT NULL", "longitude IS NOT NULL"] + (filters or ListingFilters()).sql_conditions(params)
+        params.append(limit)
+        async with get_connection() as conn:
+            rows = await conn.fetch(
+                f"SELECT {LISTING_RESULT_COLUMNS} FROM listings WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ${len(params)}",
+                *params, timeout=DB_QUERY_TIMEOUT
+            )
+        return [dict(row) for row in rows]
+    except Exception as e:
+        print(f"Error fetching listing suggestions: {e}")
+        return []
+
+async def similar_listing_names(text: str, filters: Optional[ListingFilters] = None, limit: int = 3,
+                                threshold: float = TRGM_WORD_SIMILARITY_THRESHOLD) -> list:
+    """Listing names fuzzily matching text (typos, partial names), best first.
+
+    Uses pg_trgm word_similarity so "navigli" finds "Bilocale Navigli luminoso";
+    the <% operator is served by the GIN trigram index on listings.name.
+    """
+    try:
+        params = [text]
+        conditions = ["$1 <% name"] + (filters or ListingFilters()).sql_conditions(params)
+        params.append(limit)
+        async with get_connection() as conn:
+            async with conn.transaction(readonly=True):
+                await _set_trgm_threshold(conn, "pg_trgm.word_similarity_threshold", threshold)
+                rows = await conn.fetch(
+                    f"""SELECT name FROM listings WHERE {' AND '.join(conditions)}
+                        ORDER BY word_similarity($1, name) DESC, id LIMIT ${len(params)}""",
+                    *params, timeout=DB_QUERY_TIMEOUT
+                )
+        return [row['name'] for row in rows]
+    except Exception as e:
+        print(f"Error fetching similar listing names: {e}")
+        return []
+
+async def search_listings(text: str, filters: Optional[ListingFilters] = None, k: int = 3) -> list:
+    """Full-text search (Italian stemming) over name, address and description, best first.
+
+    Every stemmed term must match ("terrazzo farmacia" needs both), and hits
+    ranking below FULLTEXT_MIN_RANK (ts_rank_cd, GIN index on search_vector) are
+    dropped, so an empty list means nothing relevant. Pass the extracted zone /
+    keywords, not a whole utterance. Rows carry a rank field.
+    """
+    try:
+        params = [text, FULLTEXT_MIN_RANK]
+        conditions = [
+            "search_vector @@ q.query",
+            "ts_rank_cd(search_vector, q.query) >= $2",
+        ] + (filters or ListingFilters()).sql_conditions(params)
+        params.append(k)
+        query = f"""
+            SELECT {LISTING_RESULT_COLUMNS}, ts_rank_cd(search_vector, q.query) AS rank
+            FROM listings, plainto_tsquery('italian', $1) AS q(query)
+            WHERE {' AND '.join(conditions)}
+            ORDER BY rank DESC, id
+            LIMIT ${len(params)}
+        """
+        async with get_connection() as conn:
+            rows = await conn.fetch(query, *params, timeout=DB_QUERY_TIMEOUT)
+        return [dict(row) for row in rows]
+    except Exception as e:
+        print(f"Error searching listings: {e}")
+        return []
+
+async def get_listings_version() -> Optional[int]:
+    """Current listings version (bumped by a trigger on every change), None on error"""
+    try:
+        async with get_connection() as conn:
+            return await conn.fetchval(
+                "SELECT version FROM table_versions WHERE name = 'listings'", timeout=DB_QUERY_TIMEOUT
+            ) or 0
+    except Exception as e:
+        print(f"Error fetching listings version: {e}")
+        return None
+
+async def get_listings_with_version() -> tuple:
+    """Consistent (version, rows) read of the whole listings table for in-process snapshots.
+
+    Raises on error so callers can keep serving their previous snapshot.
+    """
+    async with get_connection() as conn:
+        async with conn.transaction(isolation='repeatable_read', readonly=True):
+            version = await conn.fetchval(
+                "SELECT version FROM table_versions WHERE name = 'listings'", timeout=DB_QUERY_TIMEOUT
+            )
+            rows = await conn.fetch(f"SELECT {LISTING_SNAPSHOT_COLUMNS} FROM listings ORDER BY id", timeout=DB_QUERY_TIMEOUT)
+    return version or 0, [dict(row) for row in rows]
+
+# ===== GEOCODE CACHE FUNCTIONS =====
+
+async def get_cached_geocode(query_key: str, city: str):
+    """Unexpired geocode_cache row (latitude/longitude NULL for a cached miss), None if absent or on error"""
+    try:
+        async with get_connection() as conn:
+            return await conn.fetchrow("""
+                SELECT latitude, longitude FROM geocode_cache
+                WHERE query_key = $1 AND city = $2 AND expires_at > CURRENT_TIMESTAMP
+            """, query_key, city, timeout=DB_QUERY_TIMEOUT)
+    except Exception as e:
+        print(f"Error reading geocode cache: {e}")
+        return None
+
+async def cache_geocode(query_key: str, city: str, coords: Optional[tuple], ttl_seconds: float) -> bool:
+    """Store a geocode result (coords None caches a miss) for ttl_seconds"""
+    latitude, longitude = coords if coords else (None, None)
+    try:
+        async with get_connection() as conn:
+            await conn.execute("""
+                INSERT INTO geocode_cache (query_key, city, latitude, longitude, expires_at)
+                VALUES ($1, $2, $3, $4, CURRENT_TIMESTAMP + make_interval(secs => $5))
+                ON CONFLICT (query_key, city) DO UPDATE
+                SET latitude = EXCLUDED.latitude, longitude = EXCLUDED.longitude,
+                    created_at = CURRENT_TIMESTAMP, expires_at = EXCLUDED.expires_at
+            """, query_key, city, latitude, longitude, float(ttl_seconds), timeout=DB_QUERY_TIMEOUT)
+        return True
+    except Exception as e:
+        print(f"Error writing geocode cache: {e}")
+        return False
 
-                query = f"SELECT * FROM listings WHERE {' AND '.join(conditions)}"
-                c.execute(query, params)
-                rows = c.fetchall()
-                return [dict(row) for row in rows]
-            except Exception as e:
-                print(f"Error fetching listings with coords: {e}")
-                return []
+async def reserve_rate_limit(name: str, interval: float, max_wait: float, burst: float = 1) -> Optional[float]:
+    """Take the next request slot of a rate limit shared by every worker process.
+
+    One request per interval seconds, up to burst at once. Returns the seconds
+    to wait before sending, or None when that would exceed max_wait (nothing is
+    reserved then) or the database can't be reached.
+    """
+    tolerance = interval * (max(burst, 1) - 1)
+    try:
+        async with get_connection() as conn:
+            wait = await conn.fetchval("""
+                INSERT INTO rate_limits AS r (name, next_at)
+                VALUES ($1, clock_timestamp() + make_interval(secs => $2::float8))
+                ON CONFLICT (name) DO UPDATE
+                SET next_at = greatest(r.next_at, clock_timestamp()) + make_interval(secs => $2::float8)
+                WHERE greatest(r.next_at, clock_timestamp()) - clock_timestamp()
+                    <= make_interval(secs => $3::float8 + $4::float8)
+                RETURNING extract(epoch FROM r.next_at - clock_timestamp())::float8 - $2::float8 - $4::float8
+            """, name, float(interval), float(max_wait), float(tolerance), timeout=DB_QUERY_TIMEOUT)
+        return None if wait is None else max(0.0, wait)
+    except Exception as e:
+        print(f"Error reserving rate limit {name}: {e}")
+        return None
+
+async def block_rate_limit(name: str, seconds: float) -> bool:
+    """Hand out no slots of a shared rate limit for the next seconds (server asked to back off)"""
+    try:
+        async with get_connection() as conn:
+            await conn.execute("""
+                INSERT INTO rate_limits AS r (name, next_at)
+                VALUES ($1, clock_timestamp() + make_interval(secs => $2::float8))
+                ON CONFLICT (name) DO UPDATE SET next_at = greatest(r.next_at, EXCLUDED.next_at)
+            """, name, float(seconds), timeout=DB_QUERY_TIMEOUT)
+        return True
+    except Exception as e:
+        print(f"Error blocking rate limit {name}: {e}")
+        return False
 
 # ===== WHITELIST FUNCTIONS =====
 
-def is_whitelisted(phone_number: str) -> bool:
-    """Check if a phone number is in the whitelist"""
-    # Normalize: just compare digits (strip +)
-    normalized = phone_number.lstrip("+")
-    with get_connection() as conn:
-        with conn.cursor() as c:
-            try:
-                c.execute("SELECT phone_number FROM whitelist")
-                for row in c.fetchall():
-                    if row[0].lstrip("+") == normalized:
-                        return True
-                return False
-            except Exception as e:
-                print(f"Error checking whitelist: {e}")
-                return False
+async def is_whitelisted(phone_number: str) -> bool:
+    """Check if a phone number is in the whitelist (hits the database; see utils.whitelist for the cached check)"""
+    try:
+        async with get_connection() as conn:
+            return await conn.fetchval(
+                "SELECT EXISTS(SELECT 1 FROM whitelist WHERE phone_number = $1)",
+                phone_key(phone_number), timeout=DB_QUERY_TIMEOUT
+            )
+    except Exception as e:
+        print(f"Error checking whitelist: {e}")
+        return False
 
-def add_to_whitelist(phone_number: str) -> bool:
+async def add_to_whitelist(phone_number: str) -> bool:
     """Add a phone number to the whitelist"""
-    with get_connection() as conn:
-        with conn.cursor() as c:
-            try:
-                c.execute(
-                    "INSERT INTO whitelist (phone_number) VALUES (%s) ON CONFLICT DO NOTHING",
-                    (phone_number,)
-                )
-                conn.commit()
-                return True
-            except Exception as e:
-                print(f"Error adding to whitelist: {e}")
-                return False
+    try:
+        async with get_connection() as conn:
+            await conn.execute(
+                "INSERT INTO whitelist (phone_number) VALUES ($1) ON CONFLICT DO NOTHING",
+                phone_key(phone_number), timeout=DB_QUERY_TIMEOUT
+            )
+        return True
+    except Exception as e:
+        print(f"Error adding to whitelist: {e}")
+        return False
 
-def remove_from_whitelist(phone_number: str) -> bool:
+async def remove_from_whitelist(phone_number: str) -> bool:
     """Remove a phone number from the whitelist"""
-    with get_connection() as conn:
-        with conn.cursor() as c:
-            try:
-                c.execute("DELETE FROM whitelist WHERE phone_number = %s", (phone_number,))
-                conn.commit()
-                return True
-            except Exception as e:
-                print(f"Error removing from whitelist: {e}")
-                return False
+    try:
+        async with get_connection() as conn:
+            await conn.execute(
+                "DELETE FROM whitelist WHERE phone_number = $1", phone_key(phone_number), timeout=DB_QUERY_TIMEOUT
+            )
+        return True
+    except Exception as e:
+        print(f"Error removing from whitelist: {e}")
+        return False
 
-def get_all_whitelisted() -> list:
+async def get_all_whitelisted() -> list:
     """Get all whitelisted phone numbers"""
-    with get_connection() as conn:
-        with conn.cursor() as c:
-            try:
-                c.execute("SELECT phone_number FROM whitelist")
-                return [row[0] for row in c.fetchall()]
-            except Exception as e:
-                print(f"Error fetching whitelist: {e}")
-                return []
+    try:
+        async with get_connection() as conn:
+            rows = await conn.fetch("SELECT phone_number FROM whitelist", timeout=DB_QUERY_TIMEOUT)
+        return [row[0] for row in rows]
+    except Exception as e:
+        print(f"Error fetching whitelist: {e}")
+        return []
+
+# ===== FUZZY MATCHING (pg_trgm) =====
+
+async def _set_trgm_threshold(conn, setting: str, threshold: float):
+    """Set a pg_trgm threshold for the current transaction only (pooled connections are shared)"""
+    await conn.execute("SELECT set_config($1, $2, true)", setting, str(threshold), timeout=DB_QUERY_TIMEOUT)
+
+def _like_pattern(text: str) -> str:
+    """Case-insensitive 'contains' pattern with LIKE wildcards in text escaped"""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+async def similar_agencies(agency: str, limit: int = 5, threshold: float = TRGM_SIMILARITY_THRESHOLD) -> list:
+    """Agency names (from offers) trigram-similar to agency, best first"""
+    try:
+        async with get_connection() as conn:
+            async with conn.transaction(readonly=True):
+                await _set_trgm_threshold(conn, "pg_trgm.similarity_threshold", threshold)
+                rows = await conn.fetch("""
+                    SELECT agency FROM offers WHERE agency % $1
+                    GROUP BY agency ORDER BY max(similarity(agency, $1)) DESC LIMIT $2
+                """, agency, limit, timeout=DB_QUERY_TIMEOUT)
+        return [row['agency'] for row in rows]
+    except Exception as e:
+        print(f"Error fetching similar agencies: {e}")
+        return []
 
 # ===== OFFERS FUNCTIONS =====
 
-def get_offers_by_agency(agency: str) -> list:
-    """Get all offers for a specific agency using fuzzy matching"""
-    with get_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as c:
-            try:
-                # Fuzzy match: contains, case-insensitive
-                c.execute("SELECT offer FROM offers WHERE agency ILIKE %s", (f"%{agency}%",))
-                rows = c.fetchall()
-                return [row['offer'] for row in rows]
-            except Exception as e:
-                print(f"Error fetching offers: {e}")
-                return []
-
-def get_all_offers() -> list:
+async def get_offers_by_agency(agency: str) -> list:
+    """Get all offers for a specific agency using fuzzy matching.
+
+    Case-insensitive containment first, then the most trigram-similar agency
+    (typos, "prima casa" vs "primacasa"); both are served by the GIN trigram index.
+    """
+    try:
+        async with get_connection() as conn:
+            rows = await conn.fetch(
+                "SELECT offer FROM offers WHERE agency ILIKE $1 ORDER BY id", _like_pattern(agency), timeout=DB_QUERY_TIMEOUT
+            )
+        if rows:
+            return [row['offer'] for row in rows]
+
+        matches = await similar_agencies(agency, limit=1)
+        if not matches:
+            return []
+        async with get_connection() as conn:
+            rows = await conn.fetch(
+                "SELECT offer FROM offers WHERE agency = $1 ORDER BY id", matches[0], timeout=DB_QUERY_TIMEOUT
+            )
+        return [row['offer'] for row in rows]
+    except Exception as e:
+        print(f"Error fetching offers: {e}")
+        return []
+
+async def get_all_offers() -> list:
     """Get all offers from all agencies"""
-    with get_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as c:
-            try:
-                c.execute("SELECT agency, offer FROM offers")
-                rows = c.fetchall()
-                return [dict(row) for row in rows]
-            except Exception as e:
-                print(f"Error fetching all offers: {e}")
-                return []
+    try:
+        async with get_connection() as conn:
+            rows = await conn.fetch("SELECT agency, offer FROM offers", timeout=DB_QUERY_TIMEOUT)
+        return [dict(row) for row in rows]
+    except Exception as e:
+        print(f"Error fetching all offers: {e}")
+        return []
 
 # ===== CUSTOMER NOTES FUNCTIONS =====
 
-def add_customer_note(phone_number: str, note: str) -> bool:
-    """Add a note for a customer. Appends to existing notes with newline."""
-    with get_connection() as conn:
-        with conn.cursor() as c:
-            try:
-                # Use upsert: insert or append to existing notes
-                c.execute("""
-                    INSERT INTO customer_notes (phone_number, notes, updated_at)
-                    VALUES (%s, %s, CURRENT_TIMESTAMP)
-                    ON CONFLICT (phone_number) DO UPDATE
-                    SET notes = customer_notes.notes || E'\n' || EXCLUDED.notes,
-                        updated_at = CURRENT_TIMESTAMP
-                """, (phone_number, note))
-                conn.commit()
-                return True
-            except Exception as e:
-                print(f"Error adding customer note: {e}")
-                return False
+async def add_customer_note(phone_number: str, note: str) -> bool:
+    """Add a note for a customer (a single append to customer_note_events)"""
+    try:
+        async with get_connection() as conn:
+            await conn.execute(
+                "INSERT INTO customer_note_events (phone_number, note) VALUES ($1, $2)",
+                phone_key(phone_number), note, timeout=DB_QUERY_TIMEOUT
+            )
+        return True
+    except Exception as e:
+        print(f"Error adding customer note: {e}")
+        return False
+
+async def add_customer_notes(notes: list) -> None:
+    """Append a batch of (phone_number, note) pairs in one round-trip (raises on error; see utils.write_behind)"""
+    async with get_connection() as conn:
+        await conn.executemany(
+            "INSERT INTO customer_note_events (phone_number, note) VALUES ($1, $2)",
+            [(phone_key(phone_number), note) for phone_number, note in notes], timeout=DB_QUERY_TIMEOUT
+        )
+
+async def get_recent_customer_notes(phone_number: str, limit: int = 10) -> list:
+    """Latest notes for a customer as [{"note", "created_at"}], newest first"""
+    try:
+        async with get_connection() as conn:
+            rows = await conn.fetch("""
+                SELECT note, created_at FROM customer_note_events
+                WHERE phone_number = $1
+                ORDER BY created_at DESC, id DESC LIMIT $2
+            """, phone_key(phone_number), limit, timeout=DB_QUERY_TIMEOUT)
+        return [dict(row) for row in rows]
+    except Exception as e:
+        print(f"Error fetching recent customer notes: {e}")
+        return []
+
+async def get_customer_notes_between(phone_number: str, since: datetime, until: Optional[datetime] = None) -> list:
+    """Notes for a customer written in [since, until) as [{"note", "created_at"}], newest first"""
+    try:
+        async with get_connection() as conn:
+            rows = await conn.fetch("""
+                SELECT note, created_at FROM customer_note_events
+                WHERE phone_number = $1 AND created_at >= $2 AND ($3::timestamp IS NULL OR created_at < $3)
+                ORDER BY created_at DESC, id DESC
+            """, phone_key(phone_number), since, until, timeout=DB_QUERY_TIMEOUT)
+        return [dict(row) for row in rows]
+    except Exception as e:
+        print(f"Error fetching customer notes: {e}")
+        return []
+
+async def get_customer_notes(phone_number: str) -> str:
+    """Compacted notes for a customer (the latest CUSTOMER_NOTES_ROLLUP_SIZE, oldest first) for prompts.
+
+    Served from the customer_notes rollup; the rollup is rebuilt here, lazily,
+    only when a newer event exists than the one it was built from.
+    """
+    key = phone_key(phone_number)
+    try:
+        async with get_connection() as conn:
+            row = await conn.fetchrow("""
+                SELECT
+                    (SELECT id FROM customer_note_events WHERE phone_number = $1
+                     ORDER BY created_at DESC, id DESC LIMIT 1) AS latest_id,
+                    c.notes, c.last_event_id
+                FROM (SELECT 1) AS one
+                LEFT JOIN customer_notes c ON c.phone_number = $1
+            """, key, timeout=DB_QUERY_TIMEOUT)
+            if row['latest_id'] is None or row['latest_id'] == row['last_event_id']:
+                return row['notes'] or ""
 
-def get_customer_notes(phone_number: str) -> str:
-    """Get all notes for a customer"""
-    with get_connection() as conn:
-        with conn.cursor() as c:
-            try:
-                c.execute("SELECT notes FROM customer_notes WHERE phone_number = %s", (phone_number,))
-                row = c.fetchone()
-                return row[0] if row else ""
-            except Exception as e:
-                print(f"Error fetching customer notes: {e}")
-                return ""
-
-# Initialize database on module import
-try:
-    init_db()
-except Exception as e:
-    print(f"Warning: Could not initialize database: {e}")
\ No newline at end of file
+            events = await conn.fetch("""
+                SELECT id, note FROM customer_note_events
+                WHERE phone_number = $1
+                ORDER BY created_at DESC, id DESC LIMIT $2
+            """, key, CUSTOMER_NOTES_ROLLUP_SIZE, timeout=DB_QUERY_TIMEOUT)
+            notes = "\n".join(event['note'] for event in reversed(events))
+            await conn.execute("""
+                INSERT INTO customer_notes (phone_number, notes, updated_at, last_event_id)
+                VALUES ($1, $2, CURRENT_TIMESTAMP, $3)
+                ON CONFLICT (phone_number) DO UPDATE
+                SET notes = EXCLUDED.notes, updated_at = EXCLUDED.updated_at, last_event_id = EXCLUDED.last_event_id
+                WHERE customer_notes.last_event_id IS NULL OR customer_notes.last_event_id < EXCLUDED.last_event_id
+            """, key, notes, events[0]['id'], timeout=DB_QUERY_TIMEOUT)
+        return notes
+    except Exception as e:
+        print(f"Error fetching customer notes: {e}")
+        return ""
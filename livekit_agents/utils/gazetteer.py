@@ -0,0 +1,132 @@
+"""
+Offline gazetteer of the zones callers name: quartieri / NIL zones, metro
+stations and landmarks for the cities we serve, with approximate centroids.
+
+Most zone mentions are neighbourhood names, not street addresses, so they are
+answered from the bundled data file (utils/data/gazetteer.json, override with
+GAZETTEER_PATH) before any network geocoder is tried. Lookups are accent-,
+case- and typo-tolerant ("citta studi", "Navigi", "zona porta romana").
+Anything that looks like a street address (has a house number) is left to
+Nominatim, which places it far more precisely than a zone centroid.
+"""
+import os
+import re
+import json
+import difflib
+import unicodedata
+from dataclasses import dataclass
+from typing import Optional
+
+GAZETTEER_PATH = os.getenv(
+    "GAZETTEER_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "gazetteer.json")
+)
+# difflib ratio needed for a typo match
+GAZETTEER_FUZZY_CUTOFF = float(os.getenv("GAZETTEER_FUZZY_CUTOFF", "0.85"))
+# Shorter words are too ambiguous to fuzzy-match
+GAZETTEER_FUZZY_MIN_LENGTH = 5
+
+# Words callers wrap zone names in ("zona navigli", "vicino alla metro lima")
+FILLER_WORDS = {
+    "zona", "quartiere", "vicino", "vicinanze", "pressi", "nei", "nel", "nella", "in", "a", "al", "alla",
+    "allo", "ai", "di", "del", "della", "dei", "la", "il", "lo", "le", "metro", "metropolitana", "fermata",
+    "mm", "area", "dalle", "parti", "verso", "mahallesi", "mah", "civari", "yakini",
+}
+
+
+def normalize_query(text: str) -> str:
+    """Lowercase, accents stripped, punctuation and extra spaces removed"""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    # Turkish dotless i has no decomposition
+    text = text.replace("ı", "i").lower()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+@dataclass(frozen=True)
+class Place:
+    name: str
+    type: str
+    latitude: float
+    longitude: float
+
+
+class Gazetteer:
+    """Alias index over the bundled places, per city"""
+
+    def __init__(self, path: str = GAZETTEER_PATH):
+        self.path = path
+        self._cities: Optional[dict] = None
+
+    def _load(self) -> dict:
+        if self._cities is None:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            cities = {}
+            for city_id, city in data["cities"].items():
+                aliases = {}
+                for entry in city["places"]:
+                    place = Place(entry["name"], entry["type"], entry["lat"], entry["lon"])
+                    for alias in [entry["name"], *entry.get("aliases", [])]:
+                        aliases.setdefault(normalize_query(alias), place)
+                cities[city_id] = {
+                    "names": {normalize_query(a) for a in [city_id, *city.get("aliases", [])]},
+                    "aliases": aliases,
+                    "alias_list": list(aliases),
+                    "places": list(dict.fromkeys(aliases.values())),
+                }
+            self._cities = cities
+        return self._cities
+
+    def city_id(self, city: str) -> Optional[str]:
+        """Gazetteer city for a geocoder city string like "Milano, Italia" or "Bartin, Turkey" """
+        words = set(normalize_query(city).split())
+        for city_id, entry in self._load().items():
+            if entry["names"] & words:
+                return city_id
+        return None
+
+    def places(self, city: str) -> list:
+        """Every place known in a city"""
+        city_id = self.city_id(city)
+        return self._load()[city_id]["places"] if city_id else []
+
+    def lookup(self, zone: str, city: str) -> Optional[Place]:
+        """Place named by zone in city, None if the gazetteer doesn't know it"""
+        city_id = self.city_id(city)
+        entry = self._load()[city_id] if city_id else None
+        query = normalize_query(zone)
+        if entry is None or not query:
+            return None
+        aliases = entry["aliases"]
+
+        if query in aliases:
+            return aliases[query]
+        # House numbers mean a street address: let the real geocoder place it
+        if any(c.isdigit() for c in query):
+            return None
+
+        words = [w for w in query.split() if w not in FILLER_WORDS]
+        if not words:
+            return None
+
+        # Longest run of words that is a known alias ("bilocale zona porta romana")
+        for n in range(min(4, len(words)), 0, -1):
+            for i in range(len(words) - n + 1):
+                candidate = " ".join(words[i:i + n])
+                if candidate in aliases:
+                    return aliases[candidate]
+
+        # Typos: closest alias to the whole phrase, then to each run of words
+        for n in range(min(4, len(words)), 0, -1):
+            for i in range(len(words) - n + 1):
+                candidate = " ".join(words[i:i + n])
+                if len(candidate) < GAZETTEER_FUZZY_MIN_LENGTH:
+                    continue
+                close = difflib.get_close_matches(candidate, entry["alias_list"], n=1, cutoff=GAZETTEER_FUZZY_CUTOFF)
+                if close:
+                    return aliases[close[0]]
+        return None
+
+
+gazetteer = Gazetteer()
@@ -0,0 +1,240 @@
+"""
+Cached zone geocoding.
+
+The same few hundred neighbourhood names come back call after call, and the
+public Nominatim instance allows about 1 request/s. Lookups go through these
+tiers before the network:
+
+1. an in-process LRU (cachetools TLRUCache) - repeated zones resolve in
+   microseconds;
+2. the offline gazetteer (utils.gazetteer) - known quartieri, metro stations
+   and landmarks, fully local;
+3. the geocode_cache table in Postgres, shared by every worker and surviving
+   restarts.
+
+The cache tiers are keyed on (normalized query, city). Misses are cached too (negative
+caching) with a shorter TTL, so a zone Nominatim doesn't know isn't retried
+on every mention.
+
+Nominatim itself is called through one pooled async httpx client per worker.
+LiveKit runs every job in its own process, so the rate limit (NOMINATIM_RATE
+requests/s in total) is a slot counter in Postgres (db.reserve_rate_limit)
+shared by all of them; a 429's Retry-After blocks it for every process. When
+the database can't hand out a slot, Nominatim isn't called at all. The whole lookup runs under GEOCODE_DEADLINE:
+when the budget runs out - slow OSM, rate limit, slow cache read - geocode()
+returns None and the tools fall through to listing-name matching (trigram,
+full-text, then the LLM), so a geocoding stall never holds up a voice turn.
+"""
+import os
+import time
+import asyncio
+import logging
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+from cachetools import TLRUCache
+
+from utils import database as db
+from utils.gazetteer import gazetteer, normalize_query
+
+logger = logging.getLogger("geocoding")
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+NOMINATIM_USER_AGENT = "RinovaAI/1.0 (rinova.capmapai.com)"
+# Requests per second (and burst) allowed towards Nominatim, all worker processes together
+NOMINATIM_RATE = float(os.getenv("NOMINATIM_RATE", "1"))
+NOMINATIM_BURST = float(os.getenv("NOMINATIM_BURST", "1"))
+# Name of the shared limit in the rate_limits table
+NOMINATIM_RATE_LIMIT = "nominatim"
+# Back-off after a 429 without a usable Retry-After
+NOMINATIM_DEFAULT_RETRY_AFTER = 60.0
+# Seconds a whole geocode() may take, cache reads and rate-limit waits included
+GEOCODE_DEADLINE = float(os.getenv("GEOCODE_DEADLINE", "1.5"))
+
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", "4096"))
+# Seconds a found / not-found result stays valid
+GEOCODE_CACHE_TTL = float(os.getenv("GEOCODE_CACHE_TTL", str(30 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = float(os.getenv("GEOCODE_NEGATIVE_TTL", str(24 * 3600)))
+
+# Sentinel for cached misses (None means "not cached")
+NOT_FOUND = ()
+
+
+class GeocoderUnavailable(Exception):
+    """Nominatim can't answer within the budget (rate limited / backing off); not a "not found" """
+
+
+def _retry_after(response: httpx.Response) -> float:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return NOMINATIM_DEFAULT_RETRY_AFTER
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return NOMINATIM_DEFAULT_RETRY_AFTER
+
+
+class NominatimClient:
+    """Pooled, rate-limited async Nominatim search"""
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.requests = 0
+        self.rate_limited = 0
+        self.throttled = 0
+
+    def _get_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            # A client is bound to the loop it was first used on
+            self._client = httpx.AsyncClient(
+                http2=True,
+                headers={"User-Agent": NOMINATIM_USER_AGENT},
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+            )
+            self._client_loop = loop
+        return self._client
+
+    async def search(self, zone: str, city: str, deadline: float) -> Optional[tuple]:
+        """(latitude, longitude) or None; raises GeocoderUnavailable / httpx errors"""
+        wait = await db.reserve_rate_limit(
+            NOMINATIM_RATE_LIMIT, 1 / NOMINATIM_RATE, max_wait=deadline - time.monotonic(), burst=NOMINATIM_BURST
+        )
+        if wait is None:
+            self.throttled += 1
+            raise GeocoderUnavailable("no shared rate limit slot within the budget")
+        if wait:
+            await asyncio.sleep(wait)
+
+        self.requests += 1
+        response = await self._get_client().get(
+            NOMINATIM_URL,
+            params={"q": f"{zone}, {city}", "format": "json", "limit": 1},
+            timeout=max(0.1, deadline - time.monotonic()),
+        )
+        if response.status_code == 429:
+            self.rate_limited += 1
+            await db.block_rate_limit(NOMINATIM_RATE_LIMIT, _retry_after(response))
+            raise GeocoderUnavailable("Nominatim returned 429")
+        response.raise_for_status()
+        data = response.json()
+        if not data:
+            return None
+        return float(data[0]["lat"]), float(data[0]["lon"])
+
+    async def close(self):
+        if self._client is not None and self._client_loop is asyncio.get_running_loop():
+            await self._client.aclose()
+        self._client = None
+
+
+nominatim = NominatimClient()
+
+
+def _ttl(key, value, now):
+    return now + (GEOCODE_NEGATIVE_TTL if value == NOT_FOUND else GEOCODE_CACHE_TTL)
+
+
+class GeocodeCache:
+    """Memory, gazetteer and Postgres tiers in front of Nominatim"""
+
+    def __init__(self):
+        self._memory = TLRUCache(maxsize=GEOCODE_CACHE_SIZE, ttu=_ttl)
+        self.hits = 0
+        self.gazetteer_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self._pending_writes = set()
+
+    async def geocode(self, zone: str, city: str, deadline: float) -> Optional[tuple]:
+        """(latitude, longitude) for a zone in a city, None if it can't be found.
+
+        deadline is a time.monotonic() value the network lookup must finish by.
+        """
+        key = (normalize_query(zone), city)
+        if not key[0]:
+            return None
+
+        cached = self._memory.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached or None
+
+        try:
+            place = gazetteer.lookup(zone, city)
+        except Exception as e:
+            print(f"Error reading gazetteer: {e}")
+            place = None
+        if place is not None:
+            self.gazetteer_hits += 1
+            coords = (place.latitude, place.longitude)
+            self._memory[key] = coords
+            return coords
+
+        row = await db.get_cached_geocode(key[0], city)
+        if row is not None:
+            self.db_hits += 1
+            coords = (row['latitude'], row['longitude']) if row['latitude'] is not None else NOT_FOUND
+            self._memory[key] = coords
+            return coords or None
+
+        self.misses += 1
+        try:
+            coords = await nominatim.search(zone, city, deadline)
+        except Exception as e:
+            # Network trouble or back-off is not a "not found": don't cache it
+            logger.warning(f"Nominatim lookup failed for '{zone}, {city}': {e!r}")
+            return None
+
+        self._memory[key] = coords or NOT_FOUND
+        ttl = GEOCODE_CACHE_TTL if coords else GEOCODE_NEGATIVE_TTL
+        # Persist in the background, off the caller's budget
+        task = asyncio.create_task(db.cache_geocode(key[0], city, coords, ttl))
+        self._pending_writes.add(task)
+        task.add_done_callback(self._pending_writes.discard)
+        return coords
+
+    def stats(self) -> dict:
+        local = self.hits + self.gazetteer_hits + self.db_hits
+        total = local + self.misses
+        return {
+            "memory_hits": self.hits,
+            "gazetteer_hits": self.gazetteer_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "timeouts": self.timeouts,
+            "hit_rate": round(local / total, 3) if total else None,
+            "size": len(self._memory),
+            "nominatim_requests": nominatim.requests,
+            "nominatim_429": nominatim.rate_limited,
+            "nominatim_throttled": nominatim.throttled,
+        }
+
+
+geocode_cache = GeocodeCache()
+
+
+async def geocode(zone: str, city: str, budget: float = GEOCODE_DEADLINE) -> Optional[tuple]:
+    """(latitude, longitude) for a zone in a city (e.g. "Milano, Italia").
+
+    None if unknown or if it can't be resolved within budget seconds.
+    """
+    deadline = time.monotonic() + budget
+    try:
+        return await asyncio.wait_for(geocode_cache.geocode(zone, city, deadline), budget)
+    except asyncio.TimeoutError:
+        geocode_cache.timeouts += 1
+        logger.warning(f"Geocoding '{zone}, {city}' exceeded {budget}s budget")
+        return None
+
+
+async def close_geocoder():
+    """Close the worker's Nominatim HTTP client (job shutdown)"""
+    await nominatim.close()
@@ -0,0 +1,247 @@
+"""
+Bulk listing ingestion.
+
+Streams a portal export (CSV, JSON array or JSON Lines from immobiliare /
+idealista) in chunks, validates every record against the Listing model, COPYs
+the valid rows into a temporary staging table and merges them into listings
+with a single INSERT ... ON CONFLICT (name). The merge is one statement: the
+listings version trigger fires for its INSERT and its UPDATE part (the version
+moves by two), and both notifications are delivered together at commit, so
+every worker's snapshot still reloads once per ingest rather than per chunk.
+
+Usage:
+    python -m utils.ingest_listings feed.csv --agency primacasa --listing-type rent
+    python -m utils.ingest_listings feed.jsonl --chunk-size 10000
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+from itertools import islice
+from typing import Iterable, Iterator, Optional
+
+from pydantic import ValidationError
+
+from utils import database as db
+from utils.database import Listing
+
+CHUNK_SIZE = 5000
+
+# Columns loaded from the feed (Listing fields, in COPY order)
+LISTING_COLUMNS = (
+    "name", "description", "address", "price", "agency", "image_url",
+    "latitude", "longitude", "property_type", "listing_type", "rooms", "size_sqm",
+)
+
+# Portal export headers -> Listing fields
+FIELD_ALIASES = {
+    "name": "name", "title": "name", "titolo": "name",
+    "description": "description", "descrizione": "description",
+    "address": "address", "indirizzo": "address",
+    "price": "price", "prezzo": "price",
+    "agency": "agency", "agenzia": "agency",
+    "image_url": "image_url", "image": "image_url", "immagine": "image_url", "thumbnail": "image_url",
+    "latitude": "latitude", "lat": "latitude", "latitudine": "latitude",
+    "longitude": "longitude", "lon": "longitude", "lng": "longitude", "longitudine": "longitude",
+    "property_type": "property_type", "propertytype": "property_type", "tipologia": "property_type",
+    "listing_type": "listing_type", "operation": "listing_type", "contratto": "listing_type",
+    "rooms": "rooms", "locali": "rooms", "vani": "rooms", "habitaciones": "rooms",
+    "size_sqm": "size_sqm", "size": "size_sqm", "superficie": "size_sqm", "mq": "size_sqm", "metri_quadri": "size_sqm",
+}
+
+LISTING_TYPE_VALUES = {
+    "rent": "rent", "affitto": "rent", "locazione": "rent",
+    "sale": "sale", "vendita": "sale", "sell": "sale",
+}
+
+PROPERTY_TYPE_VALUES = {
+    "ufficio": "office", "office": "office",
+    "negozio": "commercial", "commerciale": "commercial", "commercial": "commercial", "premises": "commercial",
+    "box": "parking", "garage": "parking", "posto auto": "parking", "parking": "parking", "garaje": "parking",
+}
+
+
+# ===== READERS =====
+
+def read_csv(path: str) -> Iterator[dict]:
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        yield from csv.DictReader(f)
+
+
+def read_json_lines(path: str) -> Iterator[dict]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def read_json_array(path: str, buffer_size: int = 1 << 16) -> Iterator[dict]:
+    """Stream the objects of a top-level JSON array without loading the whole file"""
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buffer = f.read(buffer_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path}: expected a JSON array")
+        buffer = buffer[1:]
+        while True:
+            buffer = buffer.lstrip().lstrip(",").lstrip()
+            if buffer.startswith("]"):
+                return
+            try:
+                obj, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                more = f.read(buffer_size)
+                if not more:
+                    raise
+                buffer += more
+                continue
+            yield obj
+            buffer = buffer[end:]
+
+
+def read_feed(path: str, fmt: Optional[str] = None) -> Iterator[dict]:
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt == "csv":
+        return read_csv(path)
+    if fmt in ("jsonl", "ndjson"):
+        return read_json_lines(path)
+    if fmt == "json":
+        return read_json_array(path)
+    raise ValueError(f"Unsupported feed format: {fmt}")
+
+
+# ===== VALIDATION =====
+
+def _number(value, thousands: bool = False) -> Optional[float]:
+    """Parse portal numbers ("1500,50", "€ 200.000") into floats.
+
+    With thousands=True a lone dot followed by three digits is a thousands
+    separator ("1.200" -> 1200); only prices use it, coordinates never do.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).replace("€", "").replace(" ", "").strip()
+    if "," in text:
+        text = text.replace(".", "").replace(",", ".")
+    elif thousands and (text.count(".") > 1 or (text.count(".") == 1 and len(text.rsplit(".", 1)[1]) == 3)):
+        text = text.replace(".", "")
+    return float(text)
+
+
+def to_listing(record: dict, defaults: Optional[dict] = None) -> Listing:
+    """Map a raw feed record onto the Listing model (raises ValidationError/ValueError)"""
+    fields = dict(defaults or {})
+    for key, value in record.items():
+        field = FIELD_ALIASES.get(str(key).strip().lower().replace(" ", "_"))
+        if field and value not in (None, ""):
+            fields[field] = value.strip() if isinstance(value, str) else value
+
+    if "price" in fields:
+        fields["price"] = _number(fields["price"], thousands=True)
+    for key in ("latitude", "longitude"):
+        if key in fields:
+            fields[key] = _number(fields[key])
+    if "size_sqm" in fields:
+        fields["size_sqm"] = _number(str(fields["size_sqm"]).lower().replace("m²", "").replace("mq", ""), thousands=True)
+    if "rooms" in fields:
+        # "5+" locali -> 5
+        rooms = _number(str(fields["rooms"]).rstrip("+"))
+        fields["rooms"] = int(rooms) if rooms is not None else None
+    if "listing_type" in fields:
+        fields["listing_type"] = LISTING_TYPE_VALUES.get(str(fields["listing_type"]).lower(), fields["listing_type"])
+    if "property_type" in fields:
+        raw = str(fields["property_type"]).lower()
+        fields["property_type"] = PROPERTY_TYPE_VALUES.get(raw, raw)
+    fields.setdefault("description", "")
+    return Listing(**fields)
+
+
+def validate_records(records: Iterable[dict], defaults: Optional[dict], stats: dict) -> Iterator[tuple]:
+    """Yield COPY-ready tuples for valid records, counting the rejects in stats"""
+    for n, record in enumerate(records, start=1):
+        try:
+            listing = to_listing(record, defaults)
+        except (ValidationError, ValueError, TypeError) as e:
+            stats["rejected"] += 1
+            if stats["rejected"] <= 10:
+                print(f"Skipping record {n}: {e}")
+            continue
+        stats["valid"] += 1
+        yield tuple(getattr(listing, column) for column in LISTING_COLUMNS)
+
+
+def chunks(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+# ===== LOAD =====
+
+async def ingest(records: Iterable[dict], defaults: Optional[dict] = None, chunk_size: int = CHUNK_SIZE) -> dict:
+    """Validate, stage and merge listings; returns ingestion stats"""
+    stats = {"valid": 0, "rejected": 0, "merged": 0}
+    start = time.perf_counter()
+    conn = await db.connect_direct()
+    try:
+        async with conn.transaction():
+            await conn.execute('''CREATE TEMP TABLE listings_staging (
+                seq BIGSERIAL,
+                name TEXT NOT NULL,
+                description TEXT,
+                address TEXT,
+                price REAL,
+                agency TEXT,
+                image_url TEXT,
+                latitude REAL,
+                longitude REAL,
+                property_type TEXT,
+                listing_type TEXT,
+                rooms SMALLINT,
+                size_sqm REAL
+            ) ON COMMIT DROP''')
+
+            for chunk in chunks(validate_records(records, defaults, stats), chunk_size):
+                await conn.copy_records_to_table("listings_staging", records=chunk, columns=LISTING_COLUMNS)
+
+            columns = ", ".join(LISTING_COLUMNS)
+            updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in LISTING_COLUMNS if c != "name")
+            # Last occurrence of a name in the feed wins
+            result = await conn.execute(f'''
+                INSERT INTO listings ({columns})
+                SELECT DISTINCT ON (name) {columns}
+                FROM listings_staging
+                ORDER BY name, seq DESC
+                ON CONFLICT (name) DO UPDATE SET {updates}
+            ''')
+            stats["merged"] = int(result.rsplit(" ", 1)[-1])
+    finally:
+        await conn.close()
+    stats["seconds"] = round(time.perf_counter() - start, 2)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk-load a listings feed (CSV / JSON / JSON Lines)")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["csv", "json", "jsonl"], help="defaults to the file extension")
+    parser.add_argument("--agency", help="agency for records that don't carry one")
+    parser.add_argument("--listing-type", choices=["rent", "sale"], help="listing type for records that don't carry one")
+    parser.add_argument("--property-type", help="property type for records that don't carry one")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    defaults = {
+        key: value for key, value in {
+            "agency": args.agency,
+            "listing_type": args.listing_type,
+            "property_type": args.property_type,
+        }.items() if value
+    }
+    stats = asyncio.run(ingest(read_feed(args.path, args.format), defaults, args.chunk_size))
+    print(f"Ingested {stats['merged']} listings ({stats['valid']} valid, {stats['rejected']} rejected) in {stats['seconds']}s")
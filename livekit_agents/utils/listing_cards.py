@@ -0,0 +1,91 @@
+"""
+Pre-serialized listing "cards": the JSON fragments the apartment tools return.
+
+Cards are built once per listing when a snapshot loads, in the snapshot's
+build thread rather than on the event loop (utils.listings_cache), and stored
+on the row under "cards", so the tool path only splices strings
+together instead of building dicts and calling json.dumps per request.
+Fragments that carry a per-query distance are left open ('{"name": ...') and
+closed by nearby_json / alternative_json.
+
+Rows that don't come from a snapshot (Postgres backend) get their cards built
+on the fly by cards_of(); it's the same code, just not amortized.
+"""
+import json
+from typing import Iterable, NamedTuple, Optional
+
+from utils.database import Listing
+
+
+class ListingCards(NamedTuple):
+    compact: str      # suggestions / text matches
+    nearby: str       # closest listing, open object awaiting distance_meters
+    alternative: str  # alternatives, open object awaiting distance_meters
+    detail: Optional[str]  # the full listing, as Listing.json() serializes it (None if it doesn't validate)
+
+
+def _open_object(fields: dict) -> str:
+    """'{"a": 1, "b": 2' - an object still accepting more keys"""
+    return json.dumps(fields)[:-1]
+
+
+def _detail(row: dict) -> Optional[str]:
+    try:
+        return Listing.from_row(row).model_dump_json()
+    except (KeyError, ValueError):
+        # Incomplete row (e.g. no description): same outcome as getListing failing
+        return None
+
+
+def build_cards(row: dict) -> ListingCards:
+    description = row.get('description') or ''
+    return ListingCards(
+        compact=json.dumps({
+            "name": row['name'],
+            "address": row.get('address'),
+            "price": row.get('price'),
+            "rooms": row.get('rooms') or 'N/A',
+            "description": description[:150],
+        }),
+        nearby=_open_object({
+            "name": row['name'],
+            "address": row.get('address'),
+            "price": row.get('price'),
+            "rooms": row.get('rooms'),
+            "description": description[:300],
+        }),
+        alternative=_open_object({"name": row['name']}),
+        detail=_detail(row),
+    )
+
+
+def attach_cards(rows: Iterable[dict]) -> None:
+    """Store each row's cards on it (rows are snapshot-owned, so this happens once per load)"""
+    for row in rows:
+        row['cards'] = build_cards(row)
+
+
+def cards_of(listing: dict) -> ListingCards:
+    return listing.get('cards') or build_cards(listing)
+
+
+def _distance_suffix(listing: dict) -> str:
+    return f', "distance_meters": {int(listing["distance_km"] * 1000)}}}'
+
+
+def nearby_json(listing: dict) -> str:
+    """Closest-listing card with its distance spliced in"""
+    return cards_of(listing).nearby + _distance_suffix(listing)
+
+
+def alternative_json(listing: dict) -> str:
+    """Alternative-listing card (name + distance)"""
+    return cards_of(listing).alternative + _distance_suffix(listing)
+
+
+def compact_json(listing: dict) -> str:
+    return cards_of(listing).compact
+
+
+def json_array(fragments: Iterable[str]) -> str:
+    return "[" + ", ".join(fragments) + "]"
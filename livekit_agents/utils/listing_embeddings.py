@@ -0,0 +1,262 @@
+"""
+Local semantic index over the listings, for matching what a caller said
+("il bilocale con terrazzo sopra la farmacia") to a listing name when it's
+neither a geocodable zone nor a trigram / full-text hit.
+
+Each listing's name, address and the start of its description are embedded
+with a multilingual sentence model (paraphrase-multilingual-MiniLM, ONNX on
+CPU) into a normalized float32 matrix; a lookup embeds the query and takes the
+cosine top-k with one matrix-vector product - a few milliseconds, whatever the
+portfolio size, instead of pasting every listing name into an LLM prompt.
+
+The model is ~118M parameters, most of them the 250k-token multilingual
+vocabulary, so the int8-quantized export is used by default (~120MB instead of
+~470MB fp32). It isn't loaded in the agents' prewarm: the first lookup of a
+worker process starts the index build in a thread (download on first use, load,
+embed) and falls back to the LLM until it's ready. EMBEDDING_MODEL_REPO may be
+a local directory holding the model file and tokenizer.json (offline images).
+
+The index follows the listings snapshot (utils.listings_cache). When the
+snapshot version moves it is rebuilt in a thread, re-embedding only listings
+whose text changed; until then lookups use the previous index. Names, text
+hashes and vectors are saved together in one .npz in EMBEDDINGS_CACHE_DIR
+(written to a temp file and renamed: several workers share it), so a restarted
+worker doesn't re-embed the portfolio.
+
+onnxruntime, tokenizers and huggingface_hub are imported when the model loads.
+"""
+import os
+import time
+import asyncio
+import hashlib
+import tempfile
+import threading
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+EMBEDDING_MODEL_REPO = os.getenv("EMBEDDING_MODEL_REPO", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+# int8 export; onnx/model.onnx is the fp32 one
+EMBEDDING_MODEL_FILE = os.getenv("EMBEDDING_MODEL_FILE", "onnx/model_quint8_avx2.onnx")
+EMBEDDINGS_CACHE_DIR = os.getenv("EMBEDDINGS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "listing_embeddings"))
+# Cosine similarity above which the top hit is returned as the match (below: suggestions)
+EMBEDDING_MATCH_THRESHOLD = float(os.getenv("EMBEDDING_MATCH_THRESHOLD", "0.6"))
+EMBEDDING_MAX_TOKENS = 128
+EMBEDDING_BATCH_SIZE = 32
+# Seconds before retrying a failed build (model download / load), doubling per consecutive failure
+EMBEDDING_RETRY_DELAY = float(os.getenv("EMBEDDING_RETRY_DELAY", "30"))
+EMBEDDING_RETRY_MAX_DELAY = float(os.getenv("EMBEDDING_RETRY_MAX_DELAY", "900"))
+
+
+def listing_text(listing: dict) -> str:
+    """What gets embedded for a listing"""
+    parts = [listing.get('name'), listing.get('address'), (listing.get('description') or '')[:300]]
+    return ". ".join(p for p in parts if p)
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha1(f"{EMBEDDING_MODEL_REPO}\n{EMBEDDING_MODEL_FILE}\n{text}".encode("utf-8")).hexdigest()
+
+
+def _model_file(filename: str) -> str:
+    if os.path.isdir(EMBEDDING_MODEL_REPO):
+        return os.path.join(EMBEDDING_MODEL_REPO, filename)
+    from huggingface_hub import hf_hub_download
+    return hf_hub_download(EMBEDDING_MODEL_REPO, filename)
+
+
+class Embedder:
+    """Sentence embeddings with an ONNX model: mean pooling, L2-normalized"""
+
+    def __init__(self):
+        self._session = None
+        self._tokenizer = None
+        self._input_names: set = set()
+        # The index build and query encodes run in different threads
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._session is not None:
+                return
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+
+            options = ort.SessionOptions()
+            # Keep embedding threads from competing with audio for every core
+            options.intra_op_num_threads = 1
+            session = ort.InferenceSession(_model_file(EMBEDDING_MODEL_FILE), options, providers=["CPUExecutionProvider"])
+            tokenizer = Tokenizer.from_file(_model_file("tokenizer.json"))
+            tokenizer.enable_truncation(max_length=EMBEDDING_MAX_TOKENS)
+            tokenizer.enable_padding()
+            self._input_names = {i.name for i in session.get_inputs()}
+            self._tokenizer = tokenizer
+            self._session = session
+
+    def encode(self, texts: list) -> np.ndarray:
+        self.load()
+        vectors = []
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            encodings = self._tokenizer.encode_batch(texts[start:start + EMBEDDING_BATCH_SIZE])
+            ids = np.array([e.ids for e in encodings], dtype=np.int64)
+            mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            inputs = {"input_ids": ids, "attention_mask": mask, "token_type_ids": np.zeros_like(ids)}
+            tokens = self._session.run(None, {k: v for k, v in inputs.items() if k in self._input_names})[0]
+            pooled = (tokens * mask[..., None]).sum(axis=1) / np.maximum(mask.sum(axis=1, keepdims=True), 1)
+            vectors.append(pooled)
+        if not vectors:
+            return np.zeros((0, 0), dtype=np.float32)
+        matrix = np.concatenate(vectors).astype(np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        return matrix
+
+
+class EmbeddingIndex(NamedTuple):
+    version: int
+    names: list          # listing name per row
+    hashes: list         # text hash per row
+    matrix: np.ndarray   # (len(names), dim) normalized float32
+
+
+class ListingEmbeddings:
+    """Worker's embedding index over the current listings snapshot"""
+
+    def __init__(self):
+        self.embedder = Embedder()
+        self._index: Optional[EmbeddingIndex] = None
+        self._building: Optional[asyncio.Task] = None
+        self._building_version: Optional[int] = None
+        self._failures = 0
+        self._retry_at = 0.0
+        self.embedded = 0
+        self.reused = 0
+        self.lookups = 0
+        self.lookup_ms = 0.0
+
+    def _path(self) -> str:
+        slug = f"{EMBEDDING_MODEL_REPO}/{EMBEDDING_MODEL_FILE}".strip("/").replace("/", "__").replace(".onnx", "")
+        return os.path.join(EMBEDDINGS_CACHE_DIR, f"{slug}.npz")
+
+    def _load_saved(self) -> Optional[EmbeddingIndex]:
+        try:
+            with np.load(self._path(), allow_pickle=False) as saved:
+                names, hashes, matrix = saved["names"].tolist(), saved["hashes"].tolist(), saved["matrix"]
+        except (OSError, ValueError, KeyError):
+            return None
+        if not (len(names) == len(hashes) == len(matrix)):
+            return None
+        return EmbeddingIndex(-1, names, hashes, matrix)
+
+    def _save(self, index: EmbeddingIndex):
+        """Names, hashes and vectors in one file, replaced atomically: several workers share it"""
+        path = self._path()
+        os.makedirs(EMBEDDINGS_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(
+                    f,
+                    names=np.array(index.names, dtype=str),
+                    hashes=np.array(index.hashes, dtype=str),
+                    matrix=index.matrix,
+                )
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _build(self, version: int, listings: tuple, previous: Optional[EmbeddingIndex]) -> EmbeddingIndex:
+        """Runs in a thread: embed only the listings whose text isn't in the previous index"""
+        # Even when every vector is reused, queries need the model: load (and download) it here, off the event loop
+        self.embedder.load()
+        if previous is None:
+            previous = self._load_saved()
+        known = {h: i for i, h in enumerate(previous.hashes)} if previous is not None else {}
+
+        names = [l['name'] for l in listings]
+        texts = [listing_text(l) for l in listings]
+        hashes = [_text_hash(t) for t in texts]
+        missing = [i for i, h in enumerate(hashes) if h not in known]
+        fresh = self.embedder.encode([texts[i] for i in missing]) if missing else None
+
+        dim = fresh.shape[1] if fresh is not None else (previous.matrix.shape[1] if previous is not None else 0)
+        matrix = np.empty((len(listings), dim), dtype=np.float32)
+        for row, h in enumerate(hashes):
+            if h in known:
+                matrix[row] = previous.matrix[known[h]]
+        if missing:
+            matrix[missing] = fresh
+        self.embedded += len(missing)
+        self.reused += len(listings) - len(missing)
+
+        index = EmbeddingIndex(version, names, hashes, matrix)
+        try:
+            self._save(index)
+        except OSError as e:
+            print(f"Error saving listing embeddings: {e}")
+        return index
+
+    async def _refresh(self, snapshot):
+        try:
+            index = await asyncio.to_thread(self._build, snapshot.version, snapshot.listings, self._index)
+        except Exception as e:
+            # Model can't be downloaded / loaded: callers fall back to the LLM until a retry succeeds
+            self._failures += 1
+            delay = min(EMBEDDING_RETRY_DELAY * 2 ** (self._failures - 1), EMBEDDING_RETRY_MAX_DELAY)
+            self._retry_at = time.monotonic() + delay
+            print(f"Error building listing embeddings (retrying in {delay:.0f}s): {e}")
+            return
+        self._failures = 0
+        # Builds for different versions may overlap: an older one finishing last mustn't win
+        if self._index is None or index.version >= self._index.version:
+            self._index = index
+
+    def _ensure_current(self, snapshot):
+        index = self._index
+        if index is not None and index.version == snapshot.version:
+            return
+        if time.monotonic() < self._retry_at:
+            return
+        if self._building is not None and not self._building.done() and self._building_version == snapshot.version:
+            return
+        self._building_version = snapshot.version
+        self._building = asyncio.create_task(self._refresh(snapshot))
+
+    async def match(self, snapshot, text: str, allowed_names: list, k: int = 3) -> Optional[tuple]:
+        """(best matching name or None, top-k names) among allowed_names.
+
+        None when no index is ready yet (first build still running) or the model is unavailable.
+        """
+        self._ensure_current(snapshot)
+        index = self._index
+        if index is None or not text or not index.names:
+            return None
+
+        start = time.perf_counter()
+        # A few ms of CPU, but the session's threads would otherwise hold the event loop
+        query = await asyncio.to_thread(self.embedder.encode, [text])
+        scores = np.asarray(index.matrix @ query[0])
+        allowed = set(allowed_names)
+        scores[[i for i, name in enumerate(index.names) if name not in allowed]] = -np.inf
+        top = np.argsort(-scores)[:k]
+        top = [i for i in top if np.isfinite(scores[i])]
+        self.lookups += 1
+        self.lookup_ms += (time.perf_counter() - start) * 1000
+        if not top:
+            return None
+        best = index.names[top[0]] if scores[top[0]] >= EMBEDDING_MATCH_THRESHOLD else None
+        return best, [index.names[i] for i in top]
+
+    def stats(self) -> dict:
+        return {
+            "listings": len(self._index.names) if self._index else 0,
+            "version": self._index.version if self._index else None,
+            "embedded": self.embedded,
+            "reused": self.reused,
+            "lookups": self.lookups,
+            "avg_lookup_ms": round(self.lookup_ms / self.lookups, 2) if self.lookups else None,
+            "failures": self._failures,
+        }
+
+
+listing_embeddings = ListingEmbeddings()
@@ -0,0 +1,153 @@
+"""
+Listing search backends used by the apartment tools.
+
+- "memory" (default): every worker holds the listings snapshot
+  (utils.listings_cache) and ranks with its in-process spatial index.
+- "postgres": for portfolios too big to hold in every worker; filtering and
+  nearest-neighbour ranking run inside Postgres (utils.database.nearest_listings)
+  and only the few result rows cross the wire.
+
+Select with LISTINGS_SEARCH_BACKEND.
+"""
+import os
+from typing import Optional
+
+from utils import database as db
+from utils.database import Listing, ListingFilters
+from utils.gazetteer import gazetteer
+from utils.listing_cards import cards_of
+from utils.listings_cache import get_listings_snapshot
+
+LISTINGS_SEARCH_BACKEND = os.getenv("LISTINGS_SEARCH_BACKEND", "memory")
+
+LISTING_TYPES = ("rent", "sale")
+PROPERTY_TYPES = ("living", "commercial", "parking")
+
+
+class SnapshotListingSearch:
+    """Answers every query from the worker's in-memory listings snapshot"""
+
+    async def names(self, filters: ListingFilters) -> list:
+        """Names of the listings matching the filters"""
+        return (await get_listings_snapshot()).names(filters)
+
+    async def availability(self, agency: Optional[str] = None) -> dict:
+        """{(listing_type, property_type): count} for every rent/sale x property type pair"""
+        snapshot = await get_listings_snapshot()
+        return {
+            (listing_type, property_type): len(snapshot.filter(ListingFilters(agency, property_type, listing_type)))
+            for listing_type in LISTING_TYPES
+            for property_type in PROPERTY_TYPES
+        }
+
+    async def get(self, name: str) -> Optional[Listing]:
+        """Listing by exact name"""
+        row = (await get_listings_snapshot()).get(name)
+        return Listing.from_row(row) if row else None
+
+    async def card(self, name: str) -> Optional[str]:
+        """Listing by exact name as pre-serialized JSON (built at snapshot load)"""
+        row = (await get_listings_snapshot()).get(name)
+        return cards_of(row).detail if row else None
+
+    async def nearest(self, latitude: float, longitude: float, filters: ListingFilters, k: int = 3) -> list:
+        """Top-k listings nearest to a point, as dicts with a distance_km field, nearest first"""
+        snapshot = await get_listings_snapshot()
+        # Snapshot rows are shared, so return copies
+        return [
+            dict(listing, distance_km=distance_km)
+            for distance_km, listing in snapshot.nearest(latitude, longitude, filters, k=k)
+        ]
+
+    async def nearest_to_zone(self, zone: str, city: str, filters: ListingFilters, k: int = 3) -> Optional[list]:
+        """Like nearest(), around a gazetteer zone, from the snapshot's precomputed zone tables.
+
+        None when the zone isn't in the gazetteer (or the tables can't answer): geocode it instead.
+        """
+        place = gazetteer.lookup(zone, city)
+        if place is None:
+            return None
+        snapshot = await get_listings_snapshot()
+        ranked = snapshot.zones.nearest(gazetteer.city_id(city), place, filters, k=k)
+        if ranked is None:
+            return None
+        return [dict(listing, distance_km=distance_km) for distance_km, listing in ranked]
+
+    async def similar_names(self, text: str, filters: ListingFilters, limit: int = 3) -> list:
+        """Listing names fuzzily matching text, best first (trigram index in Postgres)"""
+        return await db.similar_listing_names(text, filters, limit=limit)
+
+    async def search(self, text: str, filters: ListingFilters, k: int = 3) -> list:
+        """Full-text search over name/address/description (Italian stemming, GIN index in Postgres)"""
+        return await db.search_listings(text, filters, k=k)
+
+    async def suggestions(self, filters: ListingFilters, limit: int = 5) -> list:
+        """A few geocoded listings matching the filters (budget / rooms included)"""
+        return (await get_listings_snapshot()).with_coords(filters)[:limit]
+
+    async def semantic_match(self, text: str, filters: ListingFilters, k: int = 3) -> Optional[tuple]:
+        """(best matching listing name or None, k closest names) by embedding similarity (utils.listing_embeddings).
+
+        None while the worker's embedding index isn't ready.
+        """
+        # Only the fallback path needs the embedding module (and numpy)
+        from utils.listing_embeddings import listing_embeddings
+
+        snapshot = await get_listings_snapshot()
+        return await listing_embeddings.match(snapshot, text, snapshot.names(filters), k=k)
+
+
+class PostgresListingSearch:
+    """Pushes filtering and ranking into Postgres"""
+
+    async def names(self, filters: ListingFilters) -> list:
+        """Names of the listings matching the filters"""
+        return await db.get_listing_names(filters)
+
+    async def availability(self, agency: Optional[str] = None) -> Optional[dict]:
+        """{(listing_type, property_type): count} for every rent/sale x property type pair (one grouped query).
+
+        None when the query fails: availability unknown.
+        """
+        return await db.get_listing_availability(agency)
+
+    async def get(self, name: str) -> Optional[Listing]:
+        """Listing by exact name"""
+        return await db.getListing(name)
+
+    async def card(self, name: str) -> Optional[str]:
+        """Listing by exact name as JSON"""
+        listing = await db.getListing(name)
+        return listing.model_dump_json() if listing else None
+
+    async def nearest(self, latitude: float, longitude: float, filters: ListingFilters, k: int = 3) -> list:
+        """Top-k listings nearest to a point, as dicts with a distance_km field, nearest first"""
+        return await db.nearest_listings(latitude, longitude, k=k, filters=filters)
+
+    async def nearest_to_zone(self, zone: str, city: str, filters: ListingFilters, k: int = 3) -> Optional[list]:
+        """No precomputed zone tables here: always geocode and use nearest()"""
+        return None
+
+    async def similar_names(self, text: str, filters: ListingFilters, limit: int = 3) -> list:
+        """Listing names fuzzily matching text, best first (trigram index in Postgres)"""
+        return await db.similar_listing_names(text, filters, limit=limit)
+
+    async def search(self, text: str, filters: ListingFilters, k: int = 3) -> list:
+        """Full-text search over name/address/description (Italian stemming, GIN index in Postgres)"""
+        return await db.search_listings(text, filters, k=k)
+
+    async def suggestions(self, filters: ListingFilters, limit: int = 5) -> list:
+        """A few geocoded listings matching the filters (budget / rooms included)"""
+        return await db.get_listing_suggestions(filters, limit=limit)
+
+    async def semantic_match(self, text: str, filters: ListingFilters, k: int = 3) -> Optional[tuple]:
+        """No local embedding index without a snapshot: callers fall back to the LLM"""
+        return None
+
+
+_BACKENDS = {
+    "memory": SnapshotListingSearch,
+    "postgres": PostgresListingSearch,
+}
+
+listing_search = _BACKENDS.get(LISTINGS_SEARCH_BACKEND, SnapshotListingSearch)()
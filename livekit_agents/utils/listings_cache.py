@@ -0,0 +1,181 @@
+"""
+Per-worker snapshot of the listings table.
+
+Listings change a few times a day, so each worker keeps the whole table in
+memory and answers every agency / property_type / listing_type filter from it.
+A statement trigger bumps table_versions.listings and NOTIFYs
+`listings_changed` on every change; the snapshot reloads when it sees a newer
+version. Without a LISTEN connection it falls back to polling the version
+counter (one cheap indexed read) every few seconds.
+
+A snapshot is built in a thread (asyncio.to_thread): its zone tables and cards
+take a while on a big portfolio, and live calls keep using the previous
+snapshot meanwhile instead of waiting on a blocked event loop.
+
+Listing dicts returned from a snapshot are shared - treat them as read-only.
+"""
+import os
+import time
+import asyncio
+from typing import Optional
+
+from utils import database as db
+from utils.database import ListingFilters
+from utils.listing_cards import attach_cards
+from utils.spatial_index import build_spatial_index
+from utils.zone_listings import ZoneListings
+
+LISTINGS_CHANNEL = "listings_changed"
+# How often to poll the version counter when notifications are unavailable
+LISTINGS_VERSION_CHECK_INTERVAL = float(os.getenv("LISTINGS_VERSION_CHECK_INTERVAL", "5"))
+# Full reload even while notifications flow, as a safety net
+LISTINGS_MAX_AGE = float(os.getenv("LISTINGS_MAX_AGE", "900"))
+
+
+class ListingsUnavailable(Exception):
+    """No snapshot could be loaded yet (database down): not the same as "no listings" """
+
+
+class ListingsSnapshot:
+    """Immutable view of the listings table at one version"""
+
+    def __init__(self, version: int, rows: list, previous: Optional["ListingsSnapshot"] = None):
+        self.version = version
+        self.listings = tuple(rows)
+        # Pre-serialized response fragments, built once per load (utils.listing_cards)
+        attach_cards(self.listings)
+        self.loaded_at = time.monotonic()
+        self._by_name = {row['name']: row for row in self.listings}
+        self._filtered: dict = {}
+        # Zone -> nearest listings tables; unchanged ones are carried over from the previous snapshot
+        self.zones = ZoneListings(self, previous.zones if previous is not None else None)
+
+    def filter(self, filters: ListingFilters) -> list:
+        """Listings matching the filters (memoized per filter combination, ranges applied on top)"""
+        if filters.has_ranges():
+            # Budgets vary per caller: filter the memoized categorical subset instead of memoizing
+            return [l for l in self.filter(filters.categorical()) if filters.matches_ranges(l)]
+        result = self._filtered.get(filters)
+        if result is None:
+            result = [l for l in self.listings if filters.matches(l)]
+            self._filtered[filters] = result
+        return result
+
+    def names(self, filters: ListingFilters) -> list:
+        """Listing names matching the filters (in-memory getCurrentListings)"""
+        return [l['name'] for l in self.filter(filters)]
+
+    def with_coords(self, filters: ListingFilters) -> list:
+        """Geocoded listings matching the filters (in-memory getAllListingsWithCoords)"""
+        if filters.has_ranges():
+            return [l for l in self.with_coords(filters.categorical()) if filters.matches_ranges(l)]
+        key = ("coords", filters)
+        result = self._filtered.get(key)
+        if result is None:
+            result = [
+                l for l in self.filter(filters)
+                if l.get('latitude') is not None and l.get('longitude') is not None
+            ]
+            self._filtered[key] = result
+        return result
+
+    def spatial_index(self, filters: ListingFilters):
+        """Nearest-neighbour index over the geocoded listings matching the filters (built on first use).
+
+        Indexes are per categorical filter combination; ranges go to nearest() as a mask.
+        """
+        filters = filters.categorical()
+        key = ("spatial", filters)
+        index = self._filtered.get(key)
+        if index is None:
+            index = build_spatial_index(self.with_coords(filters))
+            self._filtered[key] = index
+        return index
+
+    def nearest(self, latitude: float, longitude: float, filters: ListingFilters, k: int = 3) -> list:
+        """Top-k listings matching the filters (ranges included), as [(distance_km, listing), ...]"""
+        index = self.spatial_index(filters)
+        mask = index.range_mask(filters.max_price, filters.min_rooms, filters.min_size_sqm)
+        return index.nearest(latitude, longitude, k=k, mask=mask)
+
+    def get(self, name: str) -> Optional[dict]:
+        """Listing by exact name"""
+        return self._by_name.get(name)
+
+
+class ListingsCache:
+    """Keeps the worker's ListingsSnapshot current"""
+
+    def __init__(self):
+        self._snapshot: Optional[ListingsSnapshot] = None
+        self._stale = False
+        self._checked_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+        self._lock_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _on_notify(self, payload: Optional[str]):
+        if self._snapshot is None:
+            return
+        if payload is None or not payload.isdigit() or int(payload) != self._snapshot.version:
+            self._stale = True
+
+    async def _needs_refresh(self) -> bool:
+        snapshot = self._snapshot
+        if snapshot is None or self._stale:
+            return True
+        now = time.monotonic()
+        if now - snapshot.loaded_at >= LISTINGS_MAX_AGE:
+            return True
+        if db.is_listening(LISTINGS_CHANNEL):
+            return False
+        if now - self._checked_at < LISTINGS_VERSION_CHECK_INTERVAL:
+            return False
+        self._checked_at = now
+        version = await db.get_listings_version()
+        return version is not None and version != snapshot.version
+
+    async def _refresh(self):
+        try:
+            await db.listen(LISTINGS_CHANNEL, self._on_notify)
+        except Exception as e:
+            print(f"Warning: listings change notifications unavailable: {e}")
+        try:
+            # Clear the flag first: a NOTIFY arriving mid-load marks it stale again
+            self._stale = False
+            version, rows = await db.get_listings_with_version()
+        except Exception as e:
+            self._stale = True
+            print(f"Error loading listings snapshot: {e}")
+            return
+        self._snapshot = await asyncio.to_thread(ListingsSnapshot, version, rows, self._snapshot)
+        self._checked_at = time.monotonic()
+
+    async def snapshot(self) -> ListingsSnapshot:
+        """Current snapshot, refreshing it first if the listings version moved.
+
+        While a refresh is running other callers keep using the previous
+        snapshot, and a failed refresh keeps serving it. Raises
+        ListingsUnavailable if no snapshot has ever loaded.
+        """
+        if await self._needs_refresh():
+            loop = asyncio.get_running_loop()
+            if self._lock is None or self._lock_loop is not loop:
+                self._lock = asyncio.Lock()
+                self._lock_loop = loop
+            if not (self._lock.locked() and self._snapshot is not None):
+                seen = self._snapshot
+                async with self._lock:
+                    # Skip if another caller refreshed while we waited
+                    if self._snapshot is seen:
+                        await self._refresh()
+        if self._snapshot is None:
+            raise ListingsUnavailable("listings snapshot could not be loaded")
+        return self._snapshot
+
+
+listings_cache = ListingsCache()
+
+
+async def get_listings_snapshot() -> ListingsSnapshot:
+    """The worker's current listings snapshot"""
+    return await listings_cache.snapshot()
@@ -0,0 +1,106 @@
+"""
+Worker-scoped async LLM clients for the calls tools make themselves
+(query extraction, listing-name matching).
+
+A synchronous client inside a tool blocks the worker's event loop for the
+whole completion: every other session on the worker stops processing audio
+and VAD until it returns. These clients are async and share one pooled
+HTTP/2 httpx client, so connections to Groq / OpenRouter / OpenAI stay warm
+across calls and sessions. They're created in the agents' prewarm and reused
+for the life of the worker process.
+
+    completion = await llm_clients.groq().chat.completions.create(...)
+"""
+import os
+import asyncio
+from typing import Optional
+
+import httpx
+from groq import AsyncGroq
+from openai import AsyncOpenAI
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+OPENROUTER_HEADERS = {
+    "HTTP-Referer": "https://rinova.capmapai.com",
+    "X-Title": "Rinova AI",
+}
+# Per-request timeout and SDK retries: an in-call LLM request must fail fast
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "10"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "1"))
+
+# Provider -> environment variable holding its API key
+PROVIDER_KEYS = {
+    "groq": "GROQ_API_KEY",
+    "openrouter": "OPENROUTER_API_KEY",
+    "openai": "OPENAI_API_KEY",
+}
+
+
+class LLMClients:
+    """Registry of async LLM clients sharing one HTTP/2 connection pool"""
+
+    def __init__(self):
+        self._http: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._clients: dict = {}
+
+    def _build(self, provider: str):
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                http2=True,
+                timeout=httpx.Timeout(LLM_TIMEOUT, connect=5.0),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=120),
+            )
+        options = {"http_client": self._http, "timeout": LLM_TIMEOUT, "max_retries": LLM_MAX_RETRIES}
+        if provider == "groq":
+            client = AsyncGroq(**options)
+        elif provider == "openrouter":
+            client = AsyncOpenAI(
+                base_url=OPENROUTER_BASE_URL,
+                api_key=os.getenv("OPENROUTER_API_KEY"),
+                default_headers=OPENROUTER_HEADERS,
+                **options,
+            )
+        elif provider == "openai":
+            client = AsyncOpenAI(**options)
+        else:
+            raise ValueError(f"Unknown LLM provider: {provider}")
+        self._clients[provider] = client
+        return client
+
+    def _get(self, provider: str):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Pooled connections belong to the loop they were opened on: start over on a new one
+            if self._loop is not None:
+                self._http = None
+                self._clients = {}
+            self._loop = loop
+        return self._clients.get(provider) or self._build(provider)
+
+    def prewarm(self):
+        """Create the clients of every configured provider (call from the agent's prewarm)"""
+        for provider, key in PROVIDER_KEYS.items():
+            if provider not in self._clients and os.getenv(key):
+                try:
+                    self._build(provider)
+                except Exception as e:
+                    print(f"Error creating {provider} client: {e}")
+
+    def groq(self) -> AsyncGroq:
+        return self._get("groq")
+
+    def openrouter(self) -> AsyncOpenAI:
+        return self._get("openrouter")
+
+    def openai(self) -> AsyncOpenAI:
+        return self._get("openai")
+
+    async def close(self):
+        if self._http is not None and self._loop is asyncio.get_running_loop():
+            await self._http.aclose()
+        self._http = None
+        self._clients = {}
+
+
+llm_clients = LLMClients()
@@ -0,0 +1,332 @@
+"""
+Versioned schema migrations.
+
+Importing utils.database does no I/O; the schema is created and upgraded by
+this explicit command instead. Applied versions are recorded in
+schema_migrations and every migration runs in its own transaction under an
+advisory lock, so concurrent deploys can't apply the same step twice.
+
+Usage:
+    python -m utils.migrations            # apply pending migrations
+    python -m utils.migrations status     # show applied / pending versions
+    python -m utils.migrations --seed     # also add dummy listings to an empty table
+"""
+import argparse
+import asyncio
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+import asyncpg
+
+from utils import database as db
+from utils.phone import phone_key
+
+# Arbitrary constant identifying our pg_advisory_lock
+MIGRATIONS_LOCK_ID = 7_204_311
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    statements: tuple = ()
+    # Optional data step, run after the statements inside the same transaction
+    run: Optional[Callable[[asyncpg.Connection], Awaitable[None]]] = field(default=None, compare=False)
+
+
+# ===== DATA MIGRATIONS =====
+
+async def normalize_whitelist_numbers(conn):
+    """Rewrite whitelist keys to E.164 (utils.phone)"""
+    rows = await conn.fetch("SELECT phone_number FROM whitelist")
+    for row in rows:
+        key = phone_key(row["phone_number"])
+        if key == row["phone_number"]:
+            continue
+        await conn.execute(
+            "INSERT INTO whitelist (phone_number, added_at) SELECT $1, added_at FROM whitelist WHERE phone_number = $2 ON CONFLICT DO NOTHING",
+            key, row["phone_number"]
+        )
+        await conn.execute("DELETE FROM whitelist WHERE phone_number = $1", row["phone_number"])
+
+
+async def normalize_customer_note_numbers(conn):
+    """Rewrite customer_notes keys to E.164, merging duplicate customers oldest-first"""
+    rows = await conn.fetch("SELECT phone_number, notes, updated_at FROM customer_notes ORDER BY updated_at")
+    merged = {}
+    for row in rows:
+        key = phone_key(row["phone_number"])
+        if key in merged:
+            merged[key]["notes"] += "\n" + row["notes"]
+            merged[key]["updated_at"] = row["updated_at"]
+            merged[key]["sources"].append(row["phone_number"])
+        else:
+            merged[key] = {"notes": row["notes"], "updated_at": row["updated_at"], "sources": [row["phone_number"]]}
+
+    for key, entry in merged.items():
+        if entry["sources"] == [key]:
+            continue
+        await conn.execute("DELETE FROM customer_notes WHERE phone_number = ANY($1::text[])", entry["sources"])
+        await conn.execute(
+            "INSERT INTO customer_notes (phone_number, notes, updated_at) VALUES ($1, $2, $3)",
+            key, entry["notes"], entry["updated_at"]
+        )
+
+
+async def normalize_phone_numbers(conn):
+    await normalize_whitelist_numbers(conn)
+    await normalize_customer_note_numbers(conn)
+
+
+# ===== MIGRATIONS =====
+
+MIGRATIONS = [
+    Migration(1, "baseline schema", (
+        '''CREATE TABLE IF NOT EXISTS listings (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE,
+            description TEXT,
+            address TEXT,
+            price REAL,
+            agency TEXT,
+            image_url TEXT,
+            latitude REAL,
+            longitude REAL
+        )''',
+        # Columns the search code relies on; older databases got them by hand
+        "ALTER TABLE listings ADD COLUMN IF NOT EXISTS property_type TEXT",
+        "ALTER TABLE listings ADD COLUMN IF NOT EXISTS listing_type TEXT",
+        # Whitelist table for phone numbers
+        '''CREATE TABLE IF NOT EXISTS whitelist (
+            phone_number TEXT PRIMARY KEY,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        # Offers table for immobiliare offers (outbound)
+        '''CREATE TABLE IF NOT EXISTS offers (
+            id SERIAL PRIMARY KEY,
+            agency TEXT NOT NULL,
+            offer TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        # Customer notes table for outbound calls
+        '''CREATE TABLE IF NOT EXISTS customer_notes (
+            phone_number TEXT PRIMARY KEY,
+            notes TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+    )),
+    Migration(2, "listings version counter", (
+        # Per-table change counters, bumped by triggers and broadcast via NOTIFY
+        '''CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+        DECLARE
+            new_version BIGINT;
+        BEGIN
+            INSERT INTO table_versions (name, version) VALUES (TG_TABLE_NAME, 1)
+            ON CONFLICT (name) DO UPDATE
+            SET version = table_versions.version + 1, updated_at = CURRENT_TIMESTAMP
+            RETURNING version INTO new_version;
+            PERFORM pg_notify(TG_TABLE_NAME || '_changed', new_version::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql''',
+        "DROP TRIGGER IF EXISTS listings_version ON listings",
+        '''CREATE TRIGGER listings_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON listings
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()''',
+    )),
+    Migration(3, "whitelist change notifications", (
+        '''CREATE OR REPLACE FUNCTION notify_whitelist_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                PERFORM pg_notify('whitelist_changed', 'RESET');
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                PERFORM pg_notify('whitelist_changed', 'DELETE:' || OLD.phone_number);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM pg_notify('whitelist_changed', 'INSERT:' || NEW.phone_number);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql''',
+        "DROP TRIGGER IF EXISTS whitelist_notify ON whitelist",
+        '''CREATE TRIGGER whitelist_notify
+            AFTER INSERT OR UPDATE OR DELETE ON whitelist
+            FOR EACH ROW EXECUTE FUNCTION notify_whitelist_change()''',
+        "DROP TRIGGER IF EXISTS whitelist_notify_truncate ON whitelist",
+        '''CREATE TRIGGER whitelist_notify_truncate
+            AFTER TRUNCATE ON whitelist
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_whitelist_change()''',
+    )),
+    Migration(4, "normalize phone numbers to E.164", run=normalize_phone_numbers),
+    Migration(5, "earthdistance KNN index on listings", (
+        "CREATE EXTENSION IF NOT EXISTS cube",
+        "CREATE EXTENSION IF NOT EXISTS earthdistance",
+        '''CREATE INDEX IF NOT EXISTS listings_earth_idx ON listings
+            USING gist (ll_to_earth(latitude, longitude))
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL''',
+    )),
+    Migration(6, "trigram indexes for fuzzy agency and listing name search", (
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        # gin_trgm_ops serves ILIKE '%...%', % / similarity() and <% / word_similarity()
+        "CREATE INDEX IF NOT EXISTS offers_agency_trgm_idx ON offers USING gin (agency gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS listings_name_trgm_idx ON listings USING gin (name gin_trgm_ops)",
+    )),
+    Migration(7, "append-only customer note events", (
+        '''CREATE TABLE IF NOT EXISTS customer_note_events (
+            id BIGSERIAL PRIMARY KEY,
+            phone_number TEXT NOT NULL,
+            note TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )''',
+        # id breaks ties between notes written in the same transaction
+        '''CREATE INDEX IF NOT EXISTS customer_note_events_phone_idx
+            ON customer_note_events (phone_number, created_at DESC, id DESC)''',
+        # Backfill: one event per line of the old concatenated blob, in order
+        '''INSERT INTO customer_note_events (phone_number, note, created_at)
+            SELECT c.phone_number, t.line, c.updated_at
+            FROM customer_notes c,
+                unnest(string_to_array(c.notes, E'\\n')) WITH ORDINALITY AS t(line, n)
+            WHERE btrim(t.line) <> ''
+            ORDER BY c.phone_number, t.n''',
+        # customer_notes becomes the compacted rollup of the latest events
+        "ALTER TABLE customer_notes ADD COLUMN IF NOT EXISTS last_event_id BIGINT",
+        '''UPDATE customer_notes c SET last_event_id = e.last_id
+            FROM (SELECT phone_number, max(id) AS last_id FROM customer_note_events GROUP BY phone_number) e
+            WHERE e.phone_number = c.phone_number''',
+    )),
+    Migration(8, "italian full-text search over listings", (
+        # Weighted: name (A) > address (B) > description (C)
+        '''ALTER TABLE listings ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('italian', coalesce(name, '')), 'A') ||
+                setweight(to_tsvector('italian', coalesce(address, '')), 'B') ||
+                setweight(to_tsvector('italian', coalesce(description, '')), 'C')
+            ) STORED''',
+        "CREATE INDEX IF NOT EXISTS listings_search_idx ON listings USING gin (search_vector)",
+    )),
+    Migration(9, "structured rooms / size columns and filter index", (
+        "ALTER TABLE listings ADD COLUMN IF NOT EXISTS rooms SMALLINT",
+        "ALTER TABLE listings ADD COLUMN IF NOT EXISTS size_sqm REAL",
+        # ListingFilters matches agency case-insensitively, hence lower(agency)
+        '''CREATE INDEX IF NOT EXISTS listings_filter_idx
+            ON listings (lower(agency), listing_type, property_type, price)''',
+    )),
+    Migration(10, "persistent geocode cache", (
+        # latitude/longitude NULL = cached "not found"
+        '''CREATE TABLE IF NOT EXISTS geocode_cache (
+            query_key TEXT NOT NULL,
+            city TEXT NOT NULL,
+            latitude DOUBLE PRECISION,
+            longitude DOUBLE PRECISION,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (query_key, city)
+        )''',
+    )),
+    Migration(11, "rate limits shared by every worker process", (
+        # next_at: when the next request may go out (GCRA theoretical arrival time)
+        '''CREATE TABLE IF NOT EXISTS rate_limits (
+            name TEXT PRIMARY KEY,
+            next_at TIMESTAMPTZ NOT NULL
+        )''',
+    )),
+]
+
+
+# ===== RUNNER =====
+
+async def _connect() -> asyncpg.Connection:
+    # Dedicated connection without the pool's statement_timeout: index builds can be slow
+    return await db.connect_direct()
+
+
+async def _ensure_migrations_table(conn):
+    await conn.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+
+async def applied_versions(conn) -> set:
+    await _ensure_migrations_table(conn)
+    rows = await conn.fetch("SELECT version FROM schema_migrations")
+    return {row["version"] for row in rows}
+
+
+async def migrate(seed: bool = False) -> list:
+    """Apply pending migrations in order, returns the versions applied"""
+    conn = await _connect()
+    applied_now = []
+    try:
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_ID)
+        try:
+            applied = await applied_versions(conn)
+            for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+                if migration.version in applied:
+                    continue
+                async with conn.transaction():
+                    for statement in migration.statements:
+                        await conn.execute(statement)
+                    if migration.run:
+                        await migration.run(conn)
+                    await conn.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                        migration.version, migration.name
+                    )
+                print(f"Applied migration {migration.version}: {migration.name}")
+                applied_now.append(migration.version)
+            if seed:
+                await seed_dummy_listings(conn)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
+    finally:
+        await conn.close()
+    return applied_now
+
+
+async def seed_dummy_listings(conn):
+    """Add dummy listings for testing if the table is empty"""
+    if await conn.fetchval("SELECT count(*) FROM listings"):
+        return
+    dummy_listings = [
+        ("Luxury Python Villa", "A beautiful villa for snakes", "123 Python Way", 1500000, "RinovaAI", "http://example.com/1.jpg", None, None),
+        ("Cozy Coder Studio", "Small studio for devs", "404 Not Found St", 500, "RinovaAI", "http://example.com/2.jpg", None, None)
+    ]
+    await conn.executemany(
+        "INSERT INTO listings (name, description, address, price, agency, image_url, latitude, longitude) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)",
+        dummy_listings
+    )
+    print("Initialized database with dummy data")
+
+
+async def status():
+    conn = await _connect()
+    try:
+        applied = await applied_versions(conn)
+    finally:
+        await conn.close()
+    for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+        state = "applied" if migration.version in applied else "pending"
+        print(f"{migration.version:>4}  {state:<8} {migration.name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply database schema migrations")
+    parser.add_argument("command", nargs="?", choices=["migrate", "status"], default="migrate")
+    parser.add_argument("--seed", action="store_true", help="add dummy listings if the table is empty")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        asyncio.run(status())
+    else:
+        applied = asyncio.run(migrate(seed=args.seed))
+        if not applied:
+            print("Database schema is up to date")
@@ -0,0 +1,65 @@
+"""
+Phone number normalization.
+
+Every phone number we store or look up (whitelist, customer_notes, calendar
+descriptions) goes through phone_key(), so "+39351...", "39351...",
+"0039 351..." and "351..." all map to the same E.164 key and lookups are a
+single equality probe on the primary key.
+"""
+import os
+import re
+from typing import Optional
+
+# Country code assumed for numbers written without one
+DEFAULT_COUNTRY_CODE = os.getenv("DEFAULT_PHONE_COUNTRY_CODE", "39")
+
+# National significant numbers are at most 10 digits in the countries we serve
+_MAX_NATIONAL_DIGITS = 10
+_SEPARATORS = re.compile(r"[\s\-./()]")
+
+
+def normalize_phone(raw: Optional[str], default_country_code: str = DEFAULT_COUNTRY_CODE) -> Optional[str]:
+    """Normalize a phone number to E.164 ("+393517843713").
+
+    Returns None if the value doesn't look like a phone number.
+    """
+    if not raw:
+        return None
+    value = _SEPARATORS.sub("", str(raw).strip())
+    if value.startswith("+"):
+        digits = value[1:]
+    elif value.startswith("00"):
+        digits = value[2:]
+    else:
+        digits = value
+        if not digits.isdigit():
+            return None
+        if len(digits) <= _MAX_NATIONAL_DIGITS:
+            # No country code (e.g. "3517843713" or "0212345678")
+            digits = default_country_code + digits
+
+    if not digits.isdigit() or digits.startswith("0") or not 8 <= len(digits) <= 15:
+        return None
+    return "+" + digits
+
+
+def phone_key(raw: Optional[str], default_country_code: str = DEFAULT_COUNTRY_CODE) -> str:
+    """Storage/lookup key for a phone number: E.164 when parseable, else the trimmed raw value.
+
+    Placeholders such as "TEST-000000" or "Unknown" are kept as-is.
+    """
+    return normalize_phone(raw, default_country_code) or (raw or "").strip()
+
+
+def phone_from_room_name(room_name: str, default_country_code: str = DEFAULT_COUNTRY_CODE) -> Optional[str]:
+    """Extract the caller's number from a SIP room name (format: call-_393517843713_...).
+
+    The number is keyed with phone_key() under the agent's default country code, so a suffix that
+    doesn't parse as a phone number comes back as-is rather than being lost.
+    """
+    if not room_name or not room_name.startswith("call-"):
+        return None
+    parts = room_name.split("_")
+    if len(parts) < 2:
+        return None
+    return phone_key(parts[1], default_country_code) or None
@@ -0,0 +1,335 @@
+"""
+Rule-based parser for Italian real-estate search requests.
+
+get_apartment_info needs zone / listing_type / property_type / budget / rooms
+out of a free-text query, and sending every query to the LLM costs a full
+round-trip per search. Most queries use a handful of fixed phrasings
+("bilocale in affitto zona Navigli, massimo 1.200 euro al mese", "comprare
+trilocale a Città Studi, budget 300mila"), so they're parsed here first:
+
+- money: "200mila", "200k", "1,5 milioni", "1.500 euro", "€ 900"
+- rooms: monolocale ... pentalocale, "2 camere", "2-3 locali", "tre stanze"
+- listing_type: affitto / al mese -> rent, comprare / acquisto / vendita -> sale
+- property_type: ufficio / negozio -> commercial, box / garage / posto auto -> parking
+- zone: street addresses ("via Tortona 12"), "zona ..." / "vicino a ...",
+  or any known gazetteer place (utils.gazetteer)
+- size: "80 mq", "100 metri quadri" are recognised but not a search parameter,
+  so a query with one is left to the LLM
+
+Every result carries a confidence. The tool only calls the LLM when it's below
+QUERY_PARSER_MIN_CONFIDENCE: words the rules can't explain and no zone found,
+or contradictory cues (affitto and comprare in the same request), or a
+constraint the parameters can't carry (a surface in square metres).
+
+Whatever produced them, extracted parameters are memoized per worker
+(ExtractionCache) on a canonical form of the query - accent-folded, numbers
+normalized ("1.500" / "1500", "200 mila" / "200k", "due" / "2"), filler and
+conversational words dropped - so "zona Navigli, due camere" followed by "sì,
+Navigli 2 camere" is answered without parsing or calling the LLM again.
+"""
+import os
+import re
+from dataclasses import dataclass
+from typing import Literal, Optional
+
+from cachetools import TTLCache
+from pydantic import BaseModel
+
+from utils.gazetteer import FILLER_WORDS, gazetteer, normalize_query
+
+# Below this the caller should fall back to LLM extraction
+QUERY_PARSER_MIN_CONFIDENCE = float(os.getenv("QUERY_PARSER_MIN_CONFIDENCE", "0.75"))
+
+EXTRACTION_CACHE_SIZE = int(os.getenv("EXTRACTION_CACHE_SIZE", "2048"))
+# Seconds an extraction stays valid
+EXTRACTION_CACHE_TTL = float(os.getenv("EXTRACTION_CACHE_TTL", str(6 * 3600)))
+
+NUMBER_WORDS = {"un": 1, "uno": 1, "una": 1, "due": 2, "tre": 3, "quattro": 4, "cinque": 5, "sei": 6}
+ROOM_TYPES = {"monolocale": 1, "bilocale": 2, "trilocale": 3, "quadrilocale": 4, "pentalocale": 5}
+MULTIPLIERS = {"mila": 1_000, "k": 1_000, "mln": 1_000_000, "milione": 1_000_000, "milioni": 1_000_000}
+
+_NUMBER = r"\d+(?:[.,]\d+)*|" + "|".join(NUMBER_WORDS)
+ROOMS_RE = re.compile(
+    rf"\b(?P<n>{_NUMBER})(?:\s*(?:-|/|o|a)\s*(?:{_NUMBER}))?\s+(?:camere|camera|stanze|stanza|locali|vani)\b"
+)
+SIZE_RE = re.compile(rf"\b(?:{_NUMBER})\s*(?:mq|m2|m²|metri quadri|metri quadrati)(?!\w)")
+ROOM_TYPES_RE = re.compile(r"\b(" + "|".join(ROOM_TYPES) + r")\b")
+MONEY_RE = re.compile(
+    r"(?P<cue>\b(?:budget|massimo|max|fino a|entro|sotto i|prezzo|spesa|intorno ai|circa)\b\s*(?:di|a|i|ai)?\s*)?"
+    r"(?P<euro_before>€\s*)?"
+    r"(?P<num>\d+(?:[.,]\d+)*)\s*"
+    r"(?P<mult>mila|k|mln|milioni|milione)?\b\s*"
+    r"(?P<euro>€|euro\b|eur\b)?"
+)
+
+RENT_RE = re.compile(r"\b(affitt\w*|locazione|al mese|mensil\w*)\b")
+SALE_RE = re.compile(r"\b(compr(?:are|o|a|iamo|erei|erebbe)|acquist\w*|vendit\w*|vendere)\b")
+COMMERCIAL_RE = re.compile(
+    r"\b(uffici|ufficio|negozio|negozi|locale commerciale|commerciale|capannone|magazzino|laboratorio|showroom)\b"
+)
+PARKING_RE = re.compile(r"\b(box|garage|posto auto|posti auto|posto macchina|autorimessa|parcheggio)\b")
+LIVING_RE = re.compile(
+    r"\b(appartamento|appartamenti|casa|abitazione|residenziale|villa|villetta|attico|loft|mansarda)\b"
+)
+
+STREET_WORDS = {"via", "viale", "corso", "piazza", "piazzale", "largo", "vicolo", "strada", "alzaia", "ripa", "bastioni"}
+ZONE_MARKERS = {"zona", "quartiere", "vicino", "vicinanze", "pressi", "dalle"}
+# Allowed inside a place name ("via dei Mille", "Porta di San Lorenzo", "Piazza Leonardo da Vinci")
+NAME_PARTICLES = {"di", "del", "della", "delle", "dei", "degli", "d", "da", "de", "san", "santa", "sant"}
+# Words that carry no search parameter
+STOP_WORDS = FILLER_WORDS | {
+    "cliente", "vuole", "vorrebbe", "cerca", "cerco", "cerchiamo", "cercando", "sto", "stiamo", "interessato",
+    "interessata", "interessati", "mi", "ci", "piacerebbe", "serve", "servirebbe", "un", "una", "uno", "gli",
+    "i", "e", "o", "con", "per", "su", "da", "che", "tra", "fra", "anche", "possibilmente", "preferibilmente",
+    "magari", "buongiorno", "salve", "grazie", "immobile", "immobili", "soluzione", "proprieta", "budget",
+    "euro", "eur", "massimo", "max", "fino", "circa", "intorno", "sotto", "entro", "prezzo", "spesa", "mese",
+    "camere", "camera", "stanze", "stanza", "locali", "vani", "letto", "disponibile", "disponibili",
+    "qualcosa", "tipo", "milano", "comune", "citta",
+}
+# Words that don't change what a query asks for, dropped from cache keys
+CACHE_IGNORED_WORDS = FILLER_WORDS | {
+    "si", "ok", "okay", "allora", "ecco", "beh", "ehm", "dunque", "quindi", "pure", "per", "favore", "grazie",
+    "cliente", "vuole", "vorrebbe", "cerca", "cerco", "cerchiamo", "cercando", "sto", "mi", "ci", "piacerebbe",
+    "un", "una", "uno", "e",
+}
+MONEY_NUMBER_RE = re.compile(r"\b(\d+(?:[.,]\d+)*)\s*(mila|k|mln|milioni|milione)?\b")
+
+
+def _amount(number: str, multiplier: Optional[str]) -> float:
+    """'1.500' -> 1500, '1,5' + milioni -> 1500000 (a separator before exactly 3 digits is a thousands one)"""
+    if number in NUMBER_WORDS:
+        value = float(NUMBER_WORDS[number])
+    else:
+        parts = re.split(r"[.,]", number)
+        if len(parts) > 1 and len(parts[-1]) != 3:
+            value = float("".join(parts[:-1]) + "." + parts[-1])
+        else:
+            value = float("".join(parts))
+    return value * MULTIPLIERS.get(multiplier, 1)
+
+
+def _blank(text: str, match: re.Match) -> str:
+    """Replace a consumed span with spaces, keeping the other offsets valid"""
+    return text[:match.start()] + " " * (match.end() - match.start()) + text[match.end():]
+
+
+def _name_after(tokens: list, start: int, allow_number: bool) -> tuple:
+    """Place name starting at tokens[start] ("porta romana", "dei mille 12"), and the index after it"""
+    while start < len(tokens) and tokens[start] in FILLER_WORDS:
+        start += 1
+    end = start
+    while end < len(tokens) and end - start < 5:
+        token = tokens[end]
+        if token.isdigit():
+            if allow_number and end > start:
+                end += 1
+            break
+        if token in STOP_WORDS and token not in NAME_PARTICLES:
+            break
+        end += 1
+    # A particle only belongs to the name if a word follows it ("zona Navigli da 80 mq")
+    while end > start and tokens[end - 1] in NAME_PARTICLES:
+        end -= 1
+    return " ".join(tokens[start:end]), end
+
+
+# Parsed or LLM-extracted alike; its JSON schema is also the LLM's response_format
+# (the docstring goes to the model as the schema description)
+class SearchParams(BaseModel):
+    """Search parameters of a real estate query"""
+    zone: Optional[str] = None
+    listing_type: Optional[Literal["sale", "rent"]] = None
+    property_type: Optional[Literal["living", "commercial", "parking"]] = None
+    budget: Optional[int] = None
+    rooms: Optional[int] = None
+
+
+@dataclass
+class ParsedQuery:
+    zone: Optional[str] = None
+    listing_type: Optional[str] = None
+    property_type: Optional[str] = None
+    budget: Optional[int] = None
+    rooms: Optional[int] = None
+    confidence: float = 0.0
+
+    @property
+    def confident(self) -> bool:
+        return self.confidence >= QUERY_PARSER_MIN_CONFIDENCE
+
+    def params(self) -> SearchParams:
+        return SearchParams(
+            zone=self.zone,
+            listing_type=self.listing_type,
+            property_type=self.property_type,
+            budget=self.budget,
+            rooms=self.rooms,
+        )
+
+
+class QueryParser:
+    """Parses queries and counts how often the rules were enough (and how the LLM did when they weren't)"""
+
+    def __init__(self):
+        self.parsed = 0
+        self.confident = 0
+        self.llm_extractions = 0
+        self.llm_fallbacks = 0
+
+    def parse(self, query: str, city: Optional[str] = None) -> ParsedQuery:
+        """Search parameters out of a query; zones are checked against the gazetteer of city if given"""
+        result = ParsedQuery(confidence=1.0)
+        text = (query or "").lower()
+
+        # Size and rooms before money, so "circa 120 mq" / "fino a 3 camere" aren't read as a budget
+        for match in list(SIZE_RE.finditer(text)):
+            # Not a search parameter: dropping it silently would answer a different question
+            result.confidence = min(result.confidence, 0.7)
+            text = _blank(text, match)
+        for match in list(ROOMS_RE.finditer(text)):
+            rooms = _amount(match.group("n"), None)
+            if result.rooms is None and 0 < rooms < 20:
+                result.rooms = int(rooms)
+            text = _blank(text, match)
+        match = ROOM_TYPES_RE.search(text)
+        if match:
+            result.rooms = result.rooms or ROOM_TYPES[match.group(1)]
+            result.property_type = "living"
+
+        amounts = []
+        for match in list(MONEY_RE.finditer(text)):
+            if not (match.group("cue") or match.group("euro_before") or match.group("mult") or match.group("euro")):
+                continue  # bare number: house number, floor...
+            value = _amount(match.group("num"), match.group("mult"))
+            if value >= 100:
+                amounts.append(value)
+                text = _blank(text, match)
+        if amounts:
+            # "tra 800 e 1.000 euro": the upper bound is the budget
+            result.budget = round(max(amounts))
+
+        text = normalize_query(text)
+        rent, sale = RENT_RE.search(text), SALE_RE.search(text)
+        if rent and sale:
+            result.confidence = min(result.confidence, 0.4)
+        elif rent or sale:
+            result.listing_type = "rent" if rent else "sale"
+
+        commercial, parking, living = COMMERCIAL_RE.search(text), PARKING_RE.search(text), LIVING_RE.search(text)
+        if commercial and (living or result.property_type == "living"):
+            result.confidence = min(result.confidence, 0.5)
+        elif commercial:
+            result.property_type = "commercial"
+        elif living or result.property_type == "living":
+            # "appartamento con box": the box is an extra, not the request
+            result.property_type = "living"
+        elif parking:
+            result.property_type = "parking"
+        for regex in (RENT_RE, SALE_RE, COMMERCIAL_RE, PARKING_RE, LIVING_RE, ROOM_TYPES_RE):
+            text = regex.sub(" ", text)
+
+        tokens = text.split()
+        consumed = set()
+        for i, token in enumerate(tokens):
+            if token in STREET_WORDS:
+                name, end = _name_after(tokens, i + 1, allow_number=True)
+                if name:
+                    address = f"{token} {name}"
+                    place = gazetteer.lookup(address, city) if city else None
+                    result.zone = place.name if place else address.title()
+                    result.confidence = min(result.confidence, 1.0 if place else 0.9)
+                    consumed.update(range(i, end))
+                    break
+            if token in ZONE_MARKERS:
+                name, end = _name_after(tokens, i + 1, allow_number=False)
+                if name:
+                    place = gazetteer.lookup(name, city) if city else None
+                    result.zone = place.name if place else name.title()
+                    result.confidence = min(result.confidence, 1.0 if place else 0.8)
+                    consumed.update(range(i, end))
+                    break
+
+        leftover = [t for i, t in enumerate(tokens) if i not in consumed and t not in STOP_WORDS]
+        if result.zone is None and leftover:
+            # No explicit zone marker: maybe a bare place name ("trilocale a Isola")
+            remaining = " ".join(t for i, t in enumerate(tokens) if i not in consumed)
+            place = gazetteer.lookup(remaining, city) if city else None
+            if place:
+                result.zone = place.name
+                result.confidence = min(result.confidence, 0.9)
+            else:
+                # Words we can't explain - let the LLM read it
+                result.confidence = min(result.confidence, 0.3)
+
+        self.parsed += 1
+        if result.confident:
+            self.confident += 1
+        return result
+
+    def record_llm(self, ok: bool):
+        """Count an LLM extraction; not ok means its output was unusable and the parsed fields were used"""
+        self.llm_extractions += 1
+        if not ok:
+            self.llm_fallbacks += 1
+
+    def stats(self) -> dict:
+        return {
+            "parsed": self.parsed,
+            "confident": self.confident,
+            "hit_rate": round(self.confident / self.parsed, 3) if self.parsed else None,
+            "llm_extractions": self.llm_extractions,
+            "llm_fallbacks": self.llm_fallbacks,
+        }
+
+
+query_parser = QueryParser()
+
+
+def cache_key(query: str) -> str:
+    """Canonical form of a query: same key for rephrasings that ask for the same thing"""
+    def canonical(match: re.Match) -> str:
+        value = _amount(match.group(1), match.group(2))
+        return f" {int(value) if value.is_integer() else value} "
+
+    text = MONEY_NUMBER_RE.sub(canonical, (query or "").lower())
+    words = []
+    for word in normalize_query(text).split():
+        if word in CACHE_IGNORED_WORDS:
+            continue
+        words.append(str(NUMBER_WORDS[word]) if word in NUMBER_WORDS else word)
+    return " ".join(words)
+
+
+class ExtractionCache:
+    """Per-worker TTL LRU of extracted search parameters, keyed on cache_key(query)"""
+
+    def __init__(self):
+        self._memory = TTLCache(maxsize=EXTRACTION_CACHE_SIZE, ttl=EXTRACTION_CACHE_TTL)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query: str, city: str) -> Optional[SearchParams]:
+        params = self._memory.get((cache_key(query), city))
+        if params is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Callers may modify it
+        return params.model_copy()
+
+    def put(self, query: str, city: str, params: SearchParams):
+        key = cache_key(query)
+        if key:
+            self._memory[(key, city)] = params.model_copy()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+            "size": len(self._memory),
+        }
+
+
+extraction_cache = ExtractionCache()
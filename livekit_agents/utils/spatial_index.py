@@ -0,0 +1,194 @@
+"""
+Spatial indexes for nearest-listing search.
+
+ListingSpatialIndex projects listings onto the unit sphere (3D cartesian) and
+stores them in a scipy cKDTree. Euclidean chord distance on the sphere is
+monotonic in great-circle distance, so the tree returns candidates in true
+spherical order in O(log n). Only those candidates are refined with the exact
+(ellipsoidal) geodesic distance.
+
+HaversineIndex keeps latitude/longitude as column arrays and ranks with one
+vectorized haversine pass plus argpartition. It has no build cost and wins on
+small portfolios; see tests/benchmark_tests/benchmark_test_geo_ranking.py for
+the crossover. build_spatial_index() picks between them (SPATIAL_INDEX).
+
+Both accept a boolean mask aligned with index.listings, so price / rooms / size
+ranges (range_mask) are applied before ranking without building an index per
+budget.
+"""
+import math
+import os
+from typing import Optional
+
+import numpy as np
+from geopy.distance import geodesic
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS_KM = 6371.0088
+# Spherical vs ellipsoidal distances differ by well under this fraction
+SPHERE_ERROR = 0.005
+# Extra candidates fetched beyond k before geodesic refinement
+CANDIDATE_MARGIN = 5
+# "kdtree", "haversine" or "auto" (haversine below SPATIAL_INDEX_KDTREE_MIN listings)
+SPATIAL_INDEX = os.getenv("SPATIAL_INDEX", "auto")
+SPATIAL_INDEX_KDTREE_MIN = int(os.getenv("SPATIAL_INDEX_KDTREE_MIN", "50000"))
+
+
+def to_unit_vectors(latitudes, longitudes) -> np.ndarray:
+    """Project degrees lat/lon onto the unit sphere, shape (n, 3)"""
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def chord_to_km(chord: float) -> float:
+    """Great-circle distance (km) for a chord length on the unit sphere"""
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def haversine_km(latitude: float, longitude: float, lat_rad: np.ndarray, lon_rad: np.ndarray, cos_lat: np.ndarray) -> np.ndarray:
+    """Great-circle distances (km) from one point to every listing, in one vectorized pass.
+
+    lat_rad / lon_rad are the listings' coordinates in radians, cos_lat their cosines.
+    """
+    lat0 = math.radians(latitude)
+    lon0 = math.radians(longitude)
+    a = np.sin((lat_rad - lat0) / 2) ** 2 + math.cos(lat0) * cos_lat * np.sin((lon_rad - lon0) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def top_k_indices(distances: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k smallest distances, nearest first (argpartition + sort of k)"""
+    k = min(k, len(distances))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(distances):
+        candidates = np.argpartition(distances, k - 1)[:k]
+    else:
+        candidates = np.arange(len(distances))
+    return candidates[np.argsort(distances[candidates], kind="stable")]
+
+
+def _geocoded(listings: list) -> list:
+    return [
+        l for l in listings
+        if l.get('latitude') is not None and l.get('longitude') is not None
+    ]
+
+
+def _column(listings: list, key: str) -> np.ndarray:
+    """Numeric column with NaN for missing values (NaN fails every comparison, like SQL NULL)"""
+    return np.array([np.nan if l.get(key) is None else l[key] for l in listings], dtype=np.float64)
+
+
+class _RangeColumns:
+    """Price / rooms / size columns for range masks, built on first use"""
+
+    listings: list
+
+    def range_mask(self, max_price=None, min_rooms=None, min_size_sqm=None) -> Optional[np.ndarray]:
+        """Boolean mask of the listings within the ranges, None when there are no ranges"""
+        if max_price is None and min_rooms is None and min_size_sqm is None:
+            return None
+        columns = getattr(self, "_range_columns", None)
+        if columns is None:
+            columns = {key: _column(self.listings, key) for key in ("price", "rooms", "size_sqm")}
+            self._range_columns = columns
+        mask = np.ones(len(self.listings), dtype=bool)
+        with np.errstate(invalid="ignore"):
+            if max_price is not None:
+                mask &= columns["price"] <= max_price
+            if min_rooms is not None:
+                mask &= columns["rooms"] >= min_rooms
+            if min_size_sqm is not None:
+                mask &= columns["size_sqm"] >= min_size_sqm
+        return mask
+
+
+class HaversineIndex(_RangeColumns):
+    """Column arrays of coordinates ranked by a vectorized haversine pass"""
+
+    def __init__(self, listings: list):
+        self.listings = _geocoded(listings)
+        self._lat = np.radians(np.fromiter((l['latitude'] for l in self.listings), dtype=np.float64, count=len(self.listings)))
+        self._lon = np.radians(np.fromiter((l['longitude'] for l in self.listings), dtype=np.float64, count=len(self.listings)))
+        self._cos_lat = np.cos(self._lat)
+
+    def __len__(self):
+        return len(self.listings)
+
+    def nearest(self, latitude: float, longitude: float, k: int = 3, mask: Optional[np.ndarray] = None) -> list:
+        """Top-k listings by haversine distance, as [(distance_km, listing), ...] nearest first.
+
+        Only listings where mask is True are ranked (all of them without a mask).
+        """
+        if not self.listings or k <= 0:
+            return []
+        distances = haversine_km(latitude, longitude, self._lat, self._lon, self._cos_lat)
+        if mask is not None:
+            k = min(k, int(mask.sum()))
+            distances[~mask] = np.inf
+        return [(float(distances[i]), self.listings[i]) for i in top_k_indices(distances, k)]
+
+
+class ListingSpatialIndex(_RangeColumns):
+    """KD-tree over geocoded listings answering top-k nearest queries"""
+
+    def __init__(self, listings: list):
+        self.listings = _geocoded(listings)
+        self._tree: Optional[cKDTree] = None
+        if self.listings:
+            points = to_unit_vectors(
+                [l['latitude'] for l in self.listings],
+                [l['longitude'] for l in self.listings],
+            )
+            self._tree = cKDTree(points)
+
+    def __len__(self):
+        return len(self.listings)
+
+    def nearest(self, latitude: float, longitude: float, k: int = 3, mask: Optional[np.ndarray] = None) -> list:
+        """Top-k listings by geodesic distance, as [(distance_km, listing), ...] nearest first.
+
+        Only listings where mask is True are ranked (all of them without a mask).
+        """
+        n = len(self.listings)
+        if not n or k <= 0:
+            return []
+        k = min(k, n if mask is None else int(mask.sum()))
+        if k == 0:
+            return []
+        point = to_unit_vectors([latitude], [longitude])[0]
+        origin = (latitude, longitude)
+
+        m = min(n, k + CANDIDATE_MARGIN)
+        while True:
+            chords, idx = self._tree.query(point, k=m)
+            chords = np.atleast_1d(chords)
+            idx = np.atleast_1d(idx)
+            if mask is not None:
+                idx = idx[mask[idx]]
+            refined = sorted(
+                (
+                    geodesic(origin, (self.listings[i]['latitude'], self.listings[i]['longitude'])).km,
+                    int(i),
+                )
+                for i in idx
+            )[:k]
+            # Any listing outside the candidate set is at least this far away
+            # (spherically); stop once that bound can't beat our k-th result.
+            if m == n or (len(refined) == k and chord_to_km(chords[-1]) * (1 - SPHERE_ERROR) >= refined[-1][0]):
+                return [(distance_km, self.listings[i]) for distance_km, i in refined]
+            m = min(n, m * 2)
+
+
+def build_spatial_index(listings: list):
+    """Nearest-neighbour index for the listings, chosen by SPATIAL_INDEX"""
+    if SPATIAL_INDEX == "kdtree":
+        return ListingSpatialIndex(listings)
+    if SPATIAL_INDEX == "haversine":
+        return HaversineIndex(listings)
+    if len(listings) >= SPATIAL_INDEX_KDTREE_MIN:
+        return ListingSpatialIndex(listings)
+    return HaversineIndex(listings)
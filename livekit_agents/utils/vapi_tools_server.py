@@ -12,14 +12,20 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Import database functions
-from utils.database import get_offers_by_agency, add_customer_note
+from utils.database import get_offers_by_agency, add_customer_note, close_pool
 from utils.agents_utils import get_google_token
+from utils.phone import phone_key
 
 CALENDAR = os.getenv("CALENDAR_ID")
 
 app = FastAPI()
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await close_pool()
+
+
 @app.post("/immobiliare_offers")
 async def immobiliare_offers(request: Request):
     """Get available offers for an agency"""
@@ -29,7 +35,7 @@ async def immobiliare_offers(request: Request):
     args = body.get("message", {}).get("toolCalls", [{}])[0].get("function", {}).get("arguments", {})
     agency = args.get("agency", "primacasa")
 
-    offers = get_offers_by_agency(agency)
+    offers = await get_offers_by_agency(agency)
 
     if not offers:
         result = f"Nessuna offerta disponibile per {agency}."
@@ -50,9 +56,9 @@ async def note_info(request: Request):
     note = args.get("note", "")
 
     call = body.get("message", {}).get("call", {})
-    phone_number = call.get("customer", {}).get("number", "VAPI-UNKNOWN")
+    phone_number = phone_key(call.get("customer", {}).get("number")) or "VAPI-UNKNOWN"
 
-    success = add_customer_note(phone_number, note)
+    success = await add_customer_note(phone_number, note)
 
     if success:
         result = "Nota registrata."
@@ -169,7 +175,7 @@ async def schedule_meeting(request: Request):
 
     # Get phone number
     call = body.get("message", {}).get("call", {})
-    phone_number = call.get("customer", {}).get("number", "Unknown")
+    phone_number = phone_key(call.get("customer", {}).get("number")) or "Unknown"
 
     if not date:
         return JSONResponse({"results": [{"result": "Errore: Data mancante"}]})
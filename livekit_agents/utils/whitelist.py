@@ -0,0 +1,95 @@
+"""
+Process-wide whitelist cache.
+
+The whole whitelist is loaded once per worker into a set of E.164 keys (utils.phone)
+and kept current through the `whitelist_changed` NOTIFY channel (see the
+trigger in utils.migrations), so membership checks are O(1) and never
+touch the network. If the listener is unavailable the set is reloaded on a
+short poll interval instead.
+"""
+import os
+import time
+import asyncio
+from typing import Optional
+
+from utils import database as db
+from utils.phone import phone_key
+
+WHITELIST_CHANNEL = "whitelist_changed"
+# Full reload even while notifications flow, as a safety net
+WHITELIST_MAX_AGE = float(os.getenv("WHITELIST_MAX_AGE", "600"))
+# Reload interval when the LISTEN connection is down
+WHITELIST_POLL_INTERVAL = float(os.getenv("WHITELIST_POLL_INTERVAL", "30"))
+
+
+class WhitelistCache:
+    """In-memory whitelist set invalidated by Postgres LISTEN/NOTIFY"""
+
+    def __init__(self):
+        self._numbers: Optional[set] = None
+        self._loaded_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+        self._lock_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _is_fresh(self) -> bool:
+        if self._numbers is None:
+            return False
+        age = time.monotonic() - self._loaded_at
+        if db.is_listening(WHITELIST_CHANNEL):
+            return age < WHITELIST_MAX_AGE
+        return age < WHITELIST_POLL_INTERVAL
+
+    def _on_notify(self, payload: Optional[str]):
+        if self._numbers is None:
+            return
+        if payload is None or payload == "RESET":
+            # Notifications lost or table truncated - resync on next access
+            self._numbers = None
+            return
+        op, _, number = payload.partition(":")
+        if op == "INSERT":
+            self._numbers.add(phone_key(number))
+        elif op == "DELETE":
+            self._numbers.discard(phone_key(number))
+
+    async def _load(self):
+        try:
+            # Subscribe before loading so no change can slip in between
+            await db.listen(WHITELIST_CHANNEL, self._on_notify)
+        except Exception as e:
+            print(f"Warning: whitelist change notifications unavailable: {e}")
+        try:
+            async with db.get_connection() as conn:
+                rows = await conn.fetch("SELECT phone_number FROM whitelist", timeout=db.DB_QUERY_TIMEOUT)
+        except Exception as e:
+            print(f"Error loading whitelist: {e}")
+            return
+        self._numbers = {phone_key(row[0]) for row in rows}
+        self._loaded_at = time.monotonic()
+
+    async def numbers(self) -> frozenset:
+        """Current normalized whitelist, loading it on first use"""
+        if not self._is_fresh():
+            loop = asyncio.get_running_loop()
+            if self._lock is None or self._lock_loop is not loop:
+                self._lock = asyncio.Lock()
+                self._lock_loop = loop
+            async with self._lock:
+                if not self._is_fresh():
+                    await self._load()
+        return frozenset(self._numbers or ())
+
+    async def contains(self, phone_number: str) -> bool:
+        """Check if a phone number is whitelisted"""
+        if not self._is_fresh():
+            await self.numbers()
+        return self._numbers is not None and phone_key(phone_number) in self._numbers
+
+    async def is_empty(self) -> bool:
+        """True when no whitelist is configured (or it could not be loaded)"""
+        if not self._is_fresh():
+            await self.numbers()
+        return not self._numbers
+
+
+whitelist = WhitelistCache()
@@ -0,0 +1,160 @@
+"""
+Write-behind queues for non-critical writes.
+
+Tools like note_info don't need the database round-trip on the spoken turn:
+they enqueue the row and return immediately. A per-worker background task
+drains each queue in batches (every WRITE_BEHIND_FLUSH_INTERVAL seconds or
+WRITE_BEHIND_BATCH_SIZE rows, whichever comes first) with one executemany.
+
+Queues are flushed on job shutdown: register shutdown() with
+ctx.add_shutdown_callback. It only drains the queues; the pool and the LISTEN
+connection belong to the worker process and are shared with the next job.
+"""
+import os
+import time
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+from utils import database as db
+
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.25"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "100"))
+# Rows beyond this are dropped (and counted) rather than growing without bound
+WRITE_BEHIND_MAX_DEPTH = int(os.getenv("WRITE_BEHIND_MAX_DEPTH", "10000"))
+# Attempts per batch before it is dropped
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "3"))
+
+
+class WriteBehindQueue:
+    """Buffers rows in memory and writes them in batches from a background task"""
+
+    def __init__(self, name: str, write: Callable[[list], Awaitable[None]]):
+        self.name = name
+        self._write = write
+        self._rows = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        # Held while writing, so flush/close never race the background task on a batch
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._attempts = 0
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed_batches = 0
+        self.max_depth = 0
+        self.last_batch_ms = 0.0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def put(self, row: tuple) -> bool:
+        """Queue a row for writing; never blocks. Returns False if the queue is full."""
+        if len(self._rows) >= WRITE_BEHIND_MAX_DEPTH:
+            self.dropped += 1
+            print(f"Warning: write-behind queue {self.name} full, dropping row")
+            return False
+        self._rows.append(row)
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, len(self._rows))
+        self._ensure_task()
+        if len(self._rows) >= WRITE_BEHIND_BATCH_SIZE:
+            self._wakeup.set()
+        return True
+
+    def _ensure_task(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and self._loop is loop and not self._task.done():
+            return
+        # First use, or a new event loop: the old task (if any) can't run here
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), WRITE_BEHIND_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            async with self._lock:
+                while self._rows:
+                    if not await self._write_batch():
+                        break
+
+    async def _write_batch(self) -> bool:
+        """Write up to one batch from the head of the queue, False on failure"""
+        batch = [self._rows[i] for i in range(min(WRITE_BEHIND_BATCH_SIZE, len(self._rows)))]
+        start = time.perf_counter()
+        try:
+            await self._write(batch)
+        except Exception as e:
+            self._attempts += 1
+            print(f"Error writing {len(batch)} rows from write-behind queue {self.name} (attempt {self._attempts}): {e}")
+            if self._attempts < WRITE_BEHIND_MAX_ATTEMPTS:
+                return False
+            self.failed_batches += 1
+            self.dropped += len(batch)
+        else:
+            self.written += len(batch)
+        self.last_batch_ms = (time.perf_counter() - start) * 1000
+        self._attempts = 0
+        for _ in batch:
+            self._rows.popleft()
+        return True
+
+    async def flush(self):
+        """Write everything queued so far (retrying failed batches up to the attempt limit)"""
+        if self._lock is not None and self._loop is asyncio.get_running_loop():
+            async with self._lock:
+                while self._rows:
+                    await self._write_batch()
+        else:
+            while self._rows:
+                await self._write_batch()
+
+    async def close(self):
+        """Stop the background task and flush what is left"""
+        task = self._task
+        if task is not None and self._loop is asyncio.get_running_loop():
+            # Under the lock the task is idle (waiting for work), never mid-batch
+            async with self._lock:
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._rows),
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed_batches": self.failed_batches,
+            "last_batch_ms": round(self.last_batch_ms, 1),
+        }
+
+
+customer_notes_queue = WriteBehindQueue("customer_notes", db.add_customer_notes)
+
+QUEUES = [customer_notes_queue]
+
+
+def get_write_behind_stats() -> dict:
+    return {queue.name: queue.stats() for queue in QUEUES}
+
+
+async def shutdown():
+    """Flush every write-behind queue (job shutdown).
+
+    The database pool is per worker process and outlives the job, so it's left open for the next one.
+    """
+    for queue in QUEUES:
+        await queue.close()
@@ -0,0 +1,95 @@
+"""
+Precomputed zone -> nearest listings tables.
+
+For every gazetteer place of a city (utils.gazetteer) and every categorical
+filter combination (agency, listing_type, property_type) in use, the nearest
+ZONE_LISTINGS_DEPTH listings are ranked once per snapshot. "zona Navigli,
+affitto, residenziale" is then one dict lookup: no geocoding, no distance
+ranking on the hot path. Budget / rooms ranges are applied on the stored
+ranking, as long as enough of it survives to fill k.
+
+Tables live on the ListingsSnapshot. When a new snapshot loads, each table
+whose filtered listings didn't move (same ids, coordinates and range fields)
+is carried over as is; only the combinations that changed are re-ranked. That
+happens in the snapshot's build thread (utils.listings_cache), off the event
+loop; a combination used for the first time is built on demand.
+"""
+import os
+from typing import Optional
+
+from utils.database import ListingFilters
+from utils.gazetteer import Place, gazetteer
+
+# Listings kept per zone, enough to apply budget / rooms filters and still fill top-k
+ZONE_LISTINGS_DEPTH = int(os.getenv("ZONE_LISTINGS_DEPTH", "20"))
+
+
+def _fingerprint(listings: list) -> int:
+    """Changes whenever anything the ranking or the range filters depend on changes"""
+    return hash(tuple(
+        (l.get('id'), l['latitude'], l['longitude'], l.get('price'), l.get('rooms'), l.get('size_sqm'))
+        for l in listings
+    ))
+
+
+class ZoneListings:
+    """(city, categorical filters) -> {place name: [(distance_km, listing id), ...]} for one snapshot"""
+
+    def __init__(self, snapshot, previous: Optional["ZoneListings"] = None):
+        self._snapshot = snapshot
+        self._by_id = {l.get('id'): l for l in snapshot.listings}
+        self._tables: dict = {}
+        self._fingerprints: dict = {}
+        self.carried_over = 0
+        self.rebuilt = 0
+        if previous is not None:
+            # Keep every combination that was in use warm, reusing unchanged tables. Copied first:
+            # this runs in a thread while live calls may still add tables to the previous snapshot
+            for key, old_fingerprint in list(previous._fingerprints.items()):
+                city_id, filters = key
+                fingerprint = _fingerprint(snapshot.with_coords(filters))
+                if fingerprint == old_fingerprint:
+                    self._tables[key] = previous._tables[key]
+                    self._fingerprints[key] = fingerprint
+                    self.carried_over += 1
+                else:
+                    self._build(city_id, filters, fingerprint)
+
+    def _build(self, city_id: str, filters: ListingFilters, fingerprint: Optional[int] = None) -> dict:
+        index = self._snapshot.spatial_index(filters)
+        table = {
+            place.name: [
+                (distance_km, listing.get('id'))
+                for distance_km, listing in index.nearest(place.latitude, place.longitude, k=ZONE_LISTINGS_DEPTH)
+            ]
+            for place in gazetteer.places(city_id)
+        }
+        key = (city_id, filters)
+        self._tables[key] = table
+        self._fingerprints[key] = fingerprint if fingerprint is not None else _fingerprint(self._snapshot.with_coords(filters))
+        self.rebuilt += 1
+        return table
+
+    def nearest(self, city_id: str, place: Place, filters: ListingFilters, k: int = 3) -> Optional[list]:
+        """Top-k [(distance_km, listing), ...] around a gazetteer place.
+
+        None when the stored ranking can't answer (ranges leave fewer than k
+        of the ZONE_LISTINGS_DEPTH stored listings while more exist).
+        """
+        categorical = filters.categorical()
+        table = self._tables.get((city_id, categorical))
+        if table is None:
+            table = self._build(city_id, categorical)
+        ranked = table.get(place.name, [])
+
+        result = []
+        for distance_km, listing_id in ranked:
+            listing = self._by_id[listing_id]
+            if filters.matches_ranges(listing):
+                result.append((distance_km, listing))
+                if len(result) == k:
+                    return result
+        # Short on results: fine only if nothing was left out by the depth limit
+        if len(ranked) < ZONE_LISTINGS_DEPTH:
+            return result
+        return None